@@ -13,6 +13,10 @@ DATABASES = {
         'user': 'test',
         'passwd': 'test',
         'db': 'example',
+        # Optional connection pool settings (see
+        # pylytics.library.connection.POOL_DEFAULTS), e.g.
+        # 'pool_size': 5,
+        # 'pool_idle_timeout': 600,
     }
 }
 
@@ -2,7 +2,11 @@
 
 import logging
 
+from codec import *
 from column import *
+from index import *
+from partition import *
+from producer import *
 from source import *
 
 
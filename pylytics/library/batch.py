@@ -0,0 +1,140 @@
+import logging
+
+
+__all__ = ['RecordBatch']
+log = logging.getLogger("pylytics")
+
+# The default number of records gathered into each batch.
+BATCH_SIZE = 1000
+
+
+class RecordBatch(object):
+    """ A block of records for a table class held column by column: one
+    list of values per column, in the order of the table's `__columns__`.
+
+    Batches can be passed to `Table.insert` in place of table instances,
+    letting values be converted to SQL a whole column at a time. Iterating
+    over a batch yields table instances for code that expects them.
+
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.columns = table.__columns__
+        self.__positions = {}
+        for position, column in enumerate(self.columns):
+            self.__positions.setdefault(column.name, position)
+        self.__values = [[] for _ in self.columns]
+        self.__length = 0
+
+    @classmethod
+    def of(cls, table, records):
+        """ Return a batch holding all the records supplied, which may be
+        table instances, dictionaries or other batches. A single batch
+        for the same table is returned as is.
+        """
+        if len(records) == 1 and isinstance(records[0], cls) and \
+                records[0].table is table:
+            return records[0]
+        batch = cls(table)
+        for record in records:
+            if isinstance(record, cls):
+                batch.merge(record)
+            else:
+                batch.append(record)
+        return batch
+
+    @classmethod
+    def chunked(cls, table, records, size):
+        """ Gather an iterable of records into batches of up to `size`
+        records each, yielding each batch as it fills up.
+        """
+        batch = cls(table)
+        for record in records:
+            batch.append(record)
+            if len(batch) >= size:
+                yield batch
+                batch = cls(table)
+        if batch:
+            yield batch
+
+    def __len__(self):
+        return self.__length
+
+    def __getitem__(self, column_name):
+        """ Get the list of values for a column by table column name.
+        """
+        try:
+            return self.__values[self.__positions[column_name]]
+        except KeyError:
+            raise KeyError("No such table column '%s'" % column_name)
+
+    def __setitem__(self, column_name, values):
+        """ Replace the list of values for a column by table column name.
+        """
+        if len(values) != self.__length:
+            raise ValueError("Expected %s values for column '%s'" % (
+                self.__length, column_name))
+        try:
+            self.__values[self.__positions[column_name]] = list(values)
+        except KeyError:
+            raise KeyError("No such table column '%s'" % column_name)
+
+    def __iter__(self):
+        """ Yield each record in the batch as a table instance.
+        """
+        table = self.table
+        keys = [table.__columnattrs__[column.name] for column in self.columns]
+        for row in zip(*self.__values):
+            inst = table.__new__(table)
+            for key, value in zip(keys, row):
+                setattr(inst, key, value)
+            yield inst
+
+    def append(self, record):
+        """ Add a record to the batch. This can be either an instance of
+        the table class or a dictionary mapping column names to values;
+        dictionary keys that don't match a column are ignored.
+        """
+        values = self.__values
+        if isinstance(record, self.table):
+            for position, column in enumerate(self.columns):
+                values[position].append(record[column.name])
+        else:
+            row = [None] * len(values)
+            positions = self.__positions
+            for key, value in record.items():
+                try:
+                    row[positions[key]] = value
+                except KeyError:
+                    log.debug("No column found for key '%s'", key)
+            for position, value in enumerate(row):
+                values[position].append(value)
+        self.__length += 1
+
+    def extend(self, records):
+        """ Add each of an iterable of records to the batch.
+        """
+        for record in records:
+            self.append(record)
+
+    def merge(self, other):
+        """ Add all the records from another batch to this one.
+        """
+        for position, column in enumerate(self.columns):
+            try:
+                values = other[column.name]
+            except KeyError:
+                values = [None] * len(other)
+            self.__values[position].extend(values)
+        self.__length += len(other)
+
+    def take(self, positions):
+        """ Return a new batch holding only the records at the positions
+        given, in that order.
+        """
+        batch = type(self)(self.table)
+        for values, taken in zip(self.__values, batch.__values):
+            taken.extend(values[position] for position in positions)
+        batch.__length = len(positions)
+        return batch
@@ -0,0 +1,106 @@
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+from warehouse import Warehouse
+
+
+__all__ = ['Batcher']
+log = logging.getLogger("pylytics")
+
+
+class Batcher(object):
+    """ Splits encoded rows into batches for insertion.
+
+    Each batch is kept below the warehouse `max_allowed_packet` (otherwise
+    the database will 'go away') and below a row limit which adapts to
+    the round-trip time measured for recent batches, aiming to keep each
+    statement close to `target_latency` seconds.
+
+    A batcher can be shared between threads: each thread records the
+    time taken for the batches it was given, while the row limit learnt
+    is shared by them all.
+
+    """
+
+    # Fraction of max_allowed_packet to fill, leaving room for protocol
+    # overheads.
+    packet_fill = 0.9
+
+    initial_rows = 1000
+    min_rows = 10
+    max_rows = 100000
+    target_latency = 1.0
+
+    def __init__(self, max_bytes=None, rows=None):
+        self.__max_bytes = max_bytes
+        self.rows = rows or self.initial_rows
+        # The size of the last batch yielded to each thread.
+        self.__last = threading.local()
+        self.__lock = threading.Lock()
+
+    @property
+    def max_bytes(self):
+        """ The maximum size of a statement in bytes; read from the
+        warehouse on first use unless given explicitly.
+        """
+        if self.__max_bytes is None:
+            self.__max_bytes = int(Warehouse.max_allowed_packet *
+                                   self.packet_fill)
+        return self.__max_bytes
+
+    def batches(self, items, size=len, overhead=0, limit=None):
+        """ Yield lists of items which fit into a single statement, where
+        `size` gives the encoded size of each item in bytes and `overhead`
+        is the size of the rest of the statement. An extra `limit` on the
+        number of items per batch can also be given.
+        """
+        max_bytes = self.max_bytes - overhead
+        batch = []
+        batch_bytes = 0
+        for item in items:
+            item_bytes = size(item) + 1
+            rows = self.rows if limit is None else min(self.rows, limit)
+            if batch and (len(batch) >= rows or
+                          batch_bytes + item_bytes > max_bytes):
+                self.__last.count = len(batch)
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(item)
+            batch_bytes += item_bytes
+        if batch:
+            self.__last.count = len(batch)
+            yield batch
+
+    def record(self, seconds):
+        """ Adjust the row limit given the time taken to send the last
+        batch yielded. The limit is halved when a batch takes longer than
+        `target_latency` and doubled when a full batch takes less than
+        half of that. Moving in whole steps keeps the number of distinct
+        statement sizes (and so prepared statements) small.
+        """
+        count = getattr(self.__last, "count", 0)
+        self.__last.count = 0
+        if not count or seconds <= 0:
+            return
+        with self.__lock:
+            rows = self.rows
+            if seconds > self.target_latency:
+                rows = max(self.min_rows, rows // 2)
+            elif seconds * 2 < self.target_latency and count >= rows:
+                rows = min(self.max_rows, rows * 2)
+            if rows != self.rows:
+                log.debug("Sent %s rows in %.3fs; batch limit now %s rows",
+                          count, seconds, rows)
+                self.rows = rows
+
+    @contextmanager
+    def timing(self):
+        """ Time the block of code sending the last batch yielded and
+        record it (see `record`).
+        """
+        started = time.time()
+        yield
+        self.record(time.time() - started)
@@ -0,0 +1,142 @@
+from contextlib import closing
+import hashlib
+import logging
+
+from column import APPLICABLE_FOREVER, ApplicableFrom, AutoColumn, RowHash
+from keycache import LOAD_CHUNK_SIZE, _normalised
+from utils import dump, escaped, tsv
+from warehouse import Warehouse
+
+
+__all__ = ['ChangeDetector']
+log = logging.getLogger("pylytics")
+
+
+class ChangeDetector(object):
+    """ Works out which incoming dimension records are new members or
+    changes to existing members, so only those are applied.
+
+    Each record is summarised by a hash of its values, which is stored
+    with each version in the dimension's RowHash column. Incoming records
+    are compared with the hashes of the current versions of their
+    members, looked up in bulk; a record with the same hash is unchanged
+    and is skipped without being sent to the warehouse.
+
+    The hash is made of two MD5 digests: one of the columns which are
+    versioned and one of those which are overwritten in place (see
+    `Dimension.overwrite_columns`), so the two kinds of change can be
+    told apart.
+
+    Members are identified by their first natural key.
+
+    """
+
+    def __init__(self, dimension):
+        self.dimension = dimension
+        self.key = dimension.__naturalkeys__[0]
+        overwrite_columns = dimension.overwrite_columns()
+        self.versioned_columns = [
+            column for column in dimension.__columns__
+            if not isinstance(column, (AutoColumn, ApplicableFrom, RowHash))
+            and column not in overwrite_columns]
+        self.hashed_columns = self.versioned_columns + overwrite_columns
+        self.hash_column = [column for column in dimension.__columns__
+                            if isinstance(column, RowHash)][0]
+
+    def hash(self, values):
+        """ Return the hash of a record, given its values for each of the
+        hashed columns (the versioned columns, then the overwritten ones).
+        """
+        fields = [tsv(_normalised(value)) for value in values]
+        split = len(self.versioned_columns)
+        return (hashlib.md5("\t".join(fields[:split])).hexdigest() +
+                hashlib.md5("\t".join(fields[split:])).hexdigest())
+
+    def hashes(self, batch):
+        """ Return the hash of each record in a RecordBatch.
+        """
+        return map(self.hash, zip(*[batch[column.name]
+                                    for column in self.hashed_columns]))
+
+    def compare(self, batch):
+        """ Set the hashes of the records in a RecordBatch and return the
+        positions of those which are new versions (new members, or changes
+        to versioned columns) and of those which only change overwritten
+        columns, as two lists. Of several records for the same member,
+        each is compared with the one before.
+        """
+        hashes = self.hashes(batch)
+        batch[self.hash_column.name] = hashes
+        members = map(_normalised, batch[self.key.name])
+        current = self.current_hashes(set(members))
+        versions = []
+        overwrites = []
+        for position, (member, hash_) in enumerate(zip(members, hashes)):
+            current_hash = current.get(member)
+            if current_hash is None or current_hash[:32] != hash_[:32]:
+                versions.append(position)
+            elif current_hash != hash_:
+                overwrites.append(position)
+            else:
+                continue
+            current[member] = hash_
+        return versions, overwrites
+
+    def current_hashes(self, members):
+        """ Return a dictionary of the hashes of the current versions of
+        the members given, by natural key. Members not in the dimension
+        are left out.
+
+        Versions stored before the RowHash column existed have no hash, so
+        it's worked out from their values and saved.
+        """
+        dimension = self.dimension
+        table_name = escaped(dimension.__tablename__)
+        primary_key = escaped(dimension.__primarykey__.name)
+        members = [member for member in members if member is not None]
+        hashes = {}
+        unhashed = {}
+
+        connection = Warehouse.get()
+        with closing(connection.cursor()) as cursor:
+            for start in xrange(0, len(members), LOAD_CHUNK_SIZE):
+                chunk = members[start:start + LOAD_CHUNK_SIZE]
+                cursor.execute(
+                    "SELECT %s, %s, %s FROM %s WHERE `applicable_to` = %s "
+                    "AND %s IN (%s)" % (
+                        escaped(self.key.name), escaped(self.hash_column.name),
+                        primary_key, table_name, dump(APPLICABLE_FOREVER),
+                        escaped(self.key.name), ",".join(map(dump, chunk))))
+                for member, hash_, id_ in cursor:
+                    if hash_ is None:
+                        unhashed[id_] = _normalised(member)
+                    else:
+                        hashes[_normalised(member)] = _normalised(hash_)
+
+            if unhashed:
+                log.debug("Saving hashes of %s existing rows", len(unhashed),
+                          extra={"table": dimension.__tablename__})
+                ids = list(unhashed)
+                saved = []
+                for start in xrange(0, len(ids), LOAD_CHUNK_SIZE):
+                    chunk = ids[start:start + LOAD_CHUNK_SIZE]
+                    cursor.execute("SELECT %s, %s FROM %s WHERE %s IN (%s)" % (
+                        primary_key, ", ".join(
+                            escaped(column.name)
+                            for column in self.hashed_columns),
+                        table_name, primary_key, ",".join(map(dump, chunk))))
+                    for row in cursor:
+                        hash_ = self.hash(row[1:])
+                        hashes[unhashed[row[0]]] = hash_
+                        saved.append((hash_, row[0]))
+                try:
+                    cursor.executemany(
+                        "UPDATE %s SET %s = %%s WHERE %s = %%s" % (
+                            table_name, escaped(self.hash_column.name),
+                            primary_key), saved)
+                except Exception as e:
+                    log.error(e)
+                    connection.rollback()
+                else:
+                    connection.commit()
+        return hashes
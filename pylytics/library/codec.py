@@ -0,0 +1,65 @@
+import json
+import marshal
+import zlib
+
+
+__all__ = ['JSONCodec', 'MarshalCodec']
+
+# Prefixes marking value maps encoded by MarshalCodec, uncompressed and
+# compressed. JSON text never starts with a NUL byte.
+MARSHAL_PREFIX = b"\x00PM1"
+COMPRESSED_PREFIX = b"\x00PZ1"
+
+
+class JSONCodec(object):
+    """ Encodes the value maps of staging events as compact JSON text,
+    which is the default.
+    """
+
+    column_type = unicode
+    column_size = 2048
+
+    def encode(self, value_map):
+        return json.dumps(value_map, separators=",:")
+
+    def decode(self, value):
+        if isinstance(value, (bytearray, str)):
+            # From a staging table whose column is a BLOB.
+            value = str(value).decode("utf-8")
+        return json.loads(value)
+
+
+class MarshalCodec(object):
+    """ Encodes the value maps of staging events in the compact binary
+    format of the `marshal` module, compressed with zlib when they're at
+    least `compress_above` bytes long (or never, if None), for a BLOB
+    column. Marshal is much quicker to decode than JSON and supports the
+    same basic types, but its format is specific to the Python version.
+
+    Values encoded as JSON are still decoded, so existing events can be
+    read after switching codec.
+    """
+
+    column_type = bytearray
+    column_size = None
+
+    def __init__(self, compress_above=256, level=1):
+        self.compress_above = compress_above
+        self.level = level
+
+    def encode(self, value_map):
+        encoded = marshal.dumps(value_map)
+        if self.compress_above is not None and \
+                len(encoded) >= self.compress_above:
+            return bytearray(COMPRESSED_PREFIX +
+                             zlib.compress(encoded, self.level))
+        return bytearray(MARSHAL_PREFIX + encoded)
+
+    def decode(self, value):
+        value = str(value)
+        prefix = value[:len(MARSHAL_PREFIX)]
+        if prefix == COMPRESSED_PREFIX:
+            return marshal.loads(zlib.decompress(value[len(prefix):]))
+        elif prefix == MARSHAL_PREFIX:
+            return marshal.loads(value[len(prefix):])
+        return json.loads(value.decode("utf-8"))
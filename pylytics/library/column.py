@@ -8,11 +8,13 @@ from utils import dump, escaped
 
 
 __all__ = ['Column', 'NaturalKey', 'DimensionKey', 'Metric', 'AutoColumn',
-           'PrimaryKey', 'CreatedTimestamp', 'ApplicableFrom']
+           'PrimaryKey', 'CreatedTimestamp', 'ApplicableFrom', 'ApplicableTo',
+           'RowHash', 'APPLICABLE_FOREVER']
 
 
 _type_map = {
    bool: "TINYINT",
+   bytearray: "BLOB",
    date: "DATE",
    datetime: "TIMESTAMP",
    Decimal: "DECIMAL(%s,%s)",
@@ -25,6 +27,10 @@ _type_map = {
    unicode: "VARCHAR(%s)",
 }
 
+# Dimension rows still current are applicable until this time; the latest
+# that fits into a TIMESTAMP column in any time zone.
+APPLICABLE_FOREVER = datetime(2038, 1, 1)
+
 
 class Column(object):
     """ A column in a table. This class has a number of subclasses
@@ -39,7 +45,8 @@ class Column(object):
         }
 
     def __init__(self, name, type, size=None, optional=False,
-                 default=NotImplemented, order=None, comment=None, null=None):
+                 default=NotImplemented, order=None, comment=None, null=None,
+                 overwrite=False):
         self.name = name
         self.type = type
         self.size = size
@@ -47,12 +54,38 @@ class Column(object):
         self.default = default
         self.order = order
         self.comment = comment
+        # Dimension columns which are overwritten in place when they
+        # change, rather than adding a new version (see `Dimension`).
+        self.overwrite = overwrite
 
     def __repr__(self):
         return self.expression
 
+    # Columns are data descriptors: record values are held in a compact
+    # list on each table instance (see TableMetaclass) rather than in an
+    # instance dictionary. Unset values read back as the column itself,
+    # just as a plain class attribute would.
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance._values[owner.__columnindex__[self]]
+
+    def __set__(self, instance, value):
+        instance._values[type(instance).__columnindex__[self]] = value
+
+    def __delete__(self, instance):
+        instance._values[type(instance).__columnindex__[self]] = self
+
     @property
     def expression(self):
+        return self.plain_expression
+
+    @property
+    def plain_expression(self):
+        """ The column definition alone, without any key or constraint
+        that subclasses declare along with it.
+        """
         s = [escaped(self.name), self.type_expression]
         if not self.optional:
             s.append("NOT NULL")
@@ -93,15 +126,13 @@ class Column(object):
 
 class NaturalKey(Column):
     """ A Dimension column that can be used as a natural key for record
-    selection. This column type necessarily has a unique constraint.
+    selection. Each version of a dimension member has the same natural
+    key, so the unique constraint is on the natural key together with
+    `applicable_from` (see `Dimension.indexes`).
     """
 
     __columnblock__ = 2
 
-    @property
-    def expression(self):
-        return super(NaturalKey, self).expression + " UNIQUE KEY"
-
 
 class DimensionKey(Column):
     """ A Fact column that is used to hold a foreign key referencing
@@ -173,6 +204,42 @@ class ApplicableFrom(Column):
         return "DEFAULT CURRENT_TIMESTAMP"
 
 
+class ApplicableTo(AutoColumn):
+    """ This is a special column which is only used in dimensions.
+
+    It holds the time a dimension row stops being applicable, which is
+    when the next version of the same dimension member is applicable from.
+    Current rows are applicable until APPLICABLE_FOREVER. Together with
+    `applicable_from` this allows the row applicable at a point in time to
+    be found with a range lookup. It's maintained by `Dimension.insert`.
+
+    """
+
+    __columnblock__ = 6
+
+    def __init__(self, name="applicable_to", order=None, comment=None):
+        Column.__init__(self, name, datetime, optional=False,
+                        default=APPLICABLE_FOREVER, order=order,
+                        comment=comment)
+
+
+class RowHash(Column):
+    """ This is a special column which is only used in dimensions.
+
+    It holds hashes of the values of each dimension row, so that incoming
+    records can be compared with the stored versions of their members
+    without fetching them (see `ChangeDetector`). It's set by
+    `Dimension.insert`.
+
+    """
+
+    __columnblock__ = 6
+
+    def __init__(self, name="row_hash", order=None, comment=None):
+        Column.__init__(self, name, str, size=64, optional=True, order=order,
+                        comment=comment)
+
+
 class CreatedTimestamp(AutoColumn):
     """ An auto-populated timestamp column for storing when the
     record was created.
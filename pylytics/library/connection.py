@@ -2,35 +2,209 @@
 Utilities for making database connections easier.
 """
 
+import logging
 import os
+import threading
+import time
 
 from mysql import connector
+from mysql.connector.errors import PoolError
 
 from settings import settings
 
 
-def get_named_connection(connection_name):
+log = logging.getLogger("pylytics")
+
+# Settings for the pool of connections to each database, which can be
+# given along with the connection details in settings.DATABASES:
+#
+#   pool_size             -- the most idle connections kept open
+#   pool_max_connections  -- the most connections open at once, or None
+#   pool_timeout          -- seconds to wait for a connection once the
+#                            most are open, before giving up
+#   pool_idle_timeout     -- seconds an idle connection is kept open
+#   pool_ping_after       -- seconds a connection can be idle before it's
+#                            checked to still be alive when used
+#
+POOL_DEFAULTS = {
+    "pool_size": 5,
+    "pool_max_connections": None,
+    "pool_timeout": 60,
+    "pool_idle_timeout": 600,
+    "pool_ping_after": 30,
+}
+
+
+def _connection_settings(connection_name):
     if connection_name not in (settings.DATABASES.keys()):
         raise ValueError("The database {} isn't recognised - check "
-                         "your settings in settings.py".format(database))
-    else:
-        kwargs = settings.DATABASES[connection_name]
-        client_config = settings.CLIENT_CONFIG
-        if client_config and os.path.exists(client_config):
-            kwargs['option_files'] = client_config
-        # TODO We can use settings.settings to get our defaults from there.
-        return connector.connect(
-            connection_timeout=3000,
-            use_unicode=True,
-            charset='utf8',
-            **kwargs
-            )
+                         "your settings in settings.py".format(
+                             connection_name))
+    return settings.DATABASES[connection_name]
+
+
+def get_named_connection(connection_name):
+    """ Open a new connection to a database defined in the settings, not
+    drawn from its pool.
+    """
+    kwargs = {key: value for key, value in
+              _connection_settings(connection_name).items()
+              if not key.startswith("pool_")}
+    client_config = settings.CLIENT_CONFIG
+    if client_config and os.path.exists(client_config):
+        kwargs['option_files'] = client_config
+    # TODO We can use settings.settings to get our defaults from there.
+    return connector.connect(
+        connection_timeout=3000,
+        use_unicode=True,
+        charset='utf8',
+        **kwargs
+        )
+
+
+class ConnectionPool(object):
+    """ A pool of connections to a database defined in the settings, so
+    that connections can be used again rather than opened afresh each
+    time. Pools are thread-safe; use `get_pool` to get the pool for a
+    database.
+
+    Idle connections are used most recently released first, checked to
+    be alive if they've been idle for a while, and closed once they've
+    been idle for too long. Connections are rolled back when released, so
+    that they don't carry a transaction over to their next use.
+
+    """
+
+    def __init__(self, connection_name):
+        self.connection_name = connection_name
+        options = dict(POOL_DEFAULTS)
+        options.update(
+            (key, value) for key, value in
+            _connection_settings(connection_name).items()
+            if key in POOL_DEFAULTS)
+        self.size = options["pool_size"]
+        self.max_connections = options["pool_max_connections"]
+        self.timeout = options["pool_timeout"]
+        self.idle_timeout = options["pool_idle_timeout"]
+        self.ping_after = options["pool_ping_after"]
+        # Idle connections with the time each was released.
+        self.__idle = []
+        self.__in_use = 0
+        self.__condition = threading.Condition()
+
+    def acquire(self):
+        """ Return a connection from the pool, opening a new one if none is
+        idle. Raises PoolError if the most connections allowed stay in use
+        for longer than the timeout.
+        """
+        deadline = time.time() + self.timeout
+        with self.__condition:
+            while True:
+                self._evict()
+                while self.__idle:
+                    connection, released = self.__idle.pop()
+                    if time.time() - released < self.ping_after or \
+                            self._alive(connection):
+                        self.__in_use += 1
+                        return connection
+                    log.debug("Discarding broken connection to %s",
+                              self.connection_name)
+                    self._close(connection)
+                if self.max_connections is None or \
+                        self.__in_use < self.max_connections:
+                    self.__in_use += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolError("No connection to {} available after "
+                                    "{} seconds".format(self.connection_name,
+                                                        self.timeout))
+                self.__condition.wait(remaining)
+
+        try:
+            return get_named_connection(self.connection_name)
+        except:
+            with self.__condition:
+                self.__in_use -= 1
+                self.__condition.notify()
+            raise
+
+    def release(self, connection):
+        """ Return a connection to the pool once finished with.
+        """
+        keep = True
+        try:
+            connection.rollback()
+        except Exception:
+            keep = False
+        with self.__condition:
+            self.__in_use -= 1
+            if keep and len(self.__idle) < self.size:
+                self.__idle.append((connection, time.time()))
+            else:
+                self._close(connection)
+            self.__condition.notify()
+
+    def close(self):
+        """ Close every idle connection.
+        """
+        with self.__condition:
+            while self.__idle:
+                connection, _ = self.__idle.pop()
+                self._close(connection)
+
+    def _evict(self):
+        """ Close connections which have been idle for too long. The
+        oldest are at the start of the list.
+        """
+        expired = time.time() - self.idle_timeout
+        while self.__idle and self.__idle[0][1] < expired:
+            connection, _ = self.__idle.pop(0)
+            self._close(connection)
+
+    @staticmethod
+    def _alive(connection):
+        try:
+            return connection.is_connected()
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except Exception as error:
+            log.debug("Unable to close connection: %s", error)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(connection_name):
+    """ Return the pool of connections to a database defined in the
+    settings.
+    """
+    with _pools_lock:
+        try:
+            return _pools[connection_name]
+        except KeyError:
+            pool = _pools[connection_name] = ConnectionPool(connection_name)
+            return pool
+
+
+def close_pools():
+    """ Close the idle connections of every pool.
+    """
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
 
 
 class NamedConnection(object):
     """
-    Returns a connection, using database parameters defined in the settings
-    file.
+    Returns a connection drawn from the pool for a database defined in the
+    settings file, returning it to the pool afterwards.
 
     Example usage:
         with NamedConnection('platform') as connection:
@@ -40,15 +214,13 @@ class NamedConnection(object):
 
     """
 
-    # Having use_connection_pool would be interesting here too.
-    # But we don't need connection pools for now. Unless it would allow us to
-    # pull and push data in parallel.
     def __init__(self, connection_name, *args, **kwargs):
         self.connection_name = connection_name
 
     def __enter__(self):
-        self.connection = get_named_connection(self.connection_name)
+        self.pool = get_pool(self.connection_name)
+        self.connection = self.pool.acquire()
         return self.connection
 
     def __exit__(self, type, value, traceback):
-        self.connection.close()
+        self.pool.release(self.connection)
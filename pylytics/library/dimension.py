@@ -1,8 +1,20 @@
+from contextlib import closing
 import datetime
+import logging
 
+from batch import RecordBatch
+from changes import ChangeDetector
 from column import *
+from exceptions import IncompleteUpdateError, classify_error
+from index import Index
+from keycache import LOAD_CHUNK_SIZE, DimensionKeyCache
+from ledger import RefreshLedger
 from table import Table
 from utils import dump, escaped
+from warehouse import Warehouse
+
+
+log = logging.getLogger("pylytics")
 
 
 class Dimension(Table):
@@ -16,30 +28,388 @@ class Dimension(Table):
 
     INSERT = "INSERT IGNORE"
 
+    # Size of the key cache used by facts resolving dimension keys on
+    # the client (see `Fact.__key_resolution__`). None loads the whole
+    # dimension; otherwise up to this many natural key values are loaded
+    # as needed.
+    __key_cache_size__ = None
+
+    # Whether all columns but the natural keys are overwritten in place
+    # when they change, rather than adding a new version of the member.
+    # Single columns can be declared with `overwrite=True` instead.
+    __overwrite__ = False
+
+    # How long after a dimension has been refreshed from its source that
+    # facts skip refreshing it again, in seconds or as a timedelta. None
+    # refreshes it every time.
+    __refresh_interval__ = None
+
     id = PrimaryKey()
     applicable_from = ApplicableFrom()
+    applicable_to = ApplicableTo()
+    row_hash = RowHash()
     created = CreatedTimestamp()
 
     @classmethod
-    def __subquery__(cls, value, timestamp):
-        """ Return a SQL SELECT query to use as a subquery within a
-        fact INSERT. Does not append parentheses or a LIMIT clause.
+    def indexes(cls):
+        """ Dimensions also have a unique index on each natural key
+        together with `applicable_from`, as each version of a member must
+        apply from a different time. It also serves the range lookups of
+        dimension rows for facts.
+        """
+        indexes = super(Dimension, cls).indexes()
+        for key in cls.__naturalkeys__:
+            indexes.append(Index(key.name, "applicable_from", unique=True))
+        return indexes
+
+    @classmethod
+    def refresh(cls, since=None):
+        """ Update the dimension from its source, unless it was refreshed
+        within `__refresh_interval__` by this or any other process, as
+        recorded in the RefreshLedger. Returns whether it was updated, or
+        raises IncompleteUpdateError if not every record could be
+        inserted, in which case the refresh isn't recorded.
+        """
+        interval = cls.__refresh_interval__
+        if interval is None:
+            if cls.update(since=since) is False:
+                raise IncompleteUpdateError(cls)
+            return True
+
+        if isinstance(interval, datetime.timedelta):
+            interval = interval.total_seconds()
+        age = RefreshLedger.age(cls.__tablename__)
+        if age is not None and age < interval:
+            log.info("Refreshed %s seconds ago, not refreshing again", age,
+                     extra={"table": cls.__tablename__})
+            return False
+        started = RefreshLedger.now()
+        if cls.update(since=since) is False:
+            raise IncompleteUpdateError(cls)
+        RefreshLedger.record(cls.__tablename__, started)
+        return True
+
+    @classmethod
+    def _natural_keys_for(cls, value_type):
+        """ Return the natural key columns whose type matches the type of
+        value being looked up.
         """
-        value_type = type(value)
         natural_keys = [key for key in cls.__naturalkeys__
                         if key.type is value_type]
         if not natural_keys:
             raise ValueError("Value type '%s' does not match type of any "
                              "natural key for dimension "
                              "'%s'" % (value_type.__name__, cls.__name__))
+        return natural_keys
 
-        sql = 'SELECT {primary_key} FROM {table_name} WHERE {selector} AND `applicable_from` = (SELECT max(`applicable_from`) FROM {table_name} WHERE {selector} AND `applicable_from` <= "{timestamp}")'.format(
+    @classmethod
+    def _selector(cls, natural_keys, value, table=None):
+        """ Return a SQL condition matching any of the natural keys given
+        to a value, which is a SQL expression. Columns are qualified with
+        the table alias, if one is given.
+        """
+        conditions = []
+        for key in natural_keys:
+            column = escaped(key.name)
+            if table:
+                column = "%s.%s" % (table, column)
+            conditions.append("%s = %s" % (column, value))
+        if len(conditions) == 1:
+            return conditions[0]
+        return "(%s)" % " OR ".join(conditions)
+
+    @classmethod
+    def __subquery__(cls, value, timestamp):
+        """ Return a SQL SELECT query to use as a subquery within a
+        fact INSERT. Does not append parentheses or a LIMIT clause.
+        """
+        natural_keys = cls._natural_keys_for(type(value))
+
+        sql = u'SELECT {primary_key} FROM {table_name} WHERE {selector} AND `applicable_from` <= "{timestamp}" AND `applicable_to` > "{timestamp}"'.format(
+            primary_key=escaped(cls.__primarykey__.name),
+            table_name=escaped(cls.__tablename__),
+            selector=cls._selector(natural_keys, dump(value)),
+            timestamp=timestamp
+            )
+        return sql
+
+    @classmethod
+    def __parameterized_subquery__(cls, value_type):
+        """ Return the same subquery as `__subquery__` for values of the
+        type given, but with `%s` placeholders in place of the value and
+        timestamp. The number of value placeholders is also returned; two
+        timestamp placeholders follow them.
+        """
+        natural_keys = cls._natural_keys_for(value_type)
+
+        sql = 'SELECT {primary_key} FROM {table_name} WHERE {selector} AND `applicable_from` <= %s AND `applicable_to` > %s'.format(
             primary_key=escaped(cls.__primarykey__.name),
             table_name=escaped(cls.__tablename__),
-            selector=" OR ".join("%s = %s" % (escaped(key.name), dump(value)) for key in natural_keys),
+            selector=cls._selector(natural_keys, "%s"),
+            )
+        return sql, len(natural_keys)
+
+    @classmethod
+    def __join__(cls, alias, value_type, value, timestamp):
+        """ Return SQL joining the dimension row which applies at a point
+        in time onto a query, as the table alias given; this is the set
+        based equivalent of `__subquery__`. The natural key value and
+        timestamp are given as SQL expressions, typically columns.
+        """
+        natural_keys = cls._natural_keys_for(value_type)
+        alias = escaped(alias)
+
+        sql = "LEFT JOIN {table_name} AS {alias} ON {selector} AND {alias}.`applicable_from` <= {timestamp} AND {alias}.`applicable_to` > {timestamp}".format(
+            table_name=escaped(cls.__tablename__),
+            alias=alias,
+            selector=cls._selector(natural_keys, value, alias),
             timestamp=timestamp
             )
         return sql
 
+    @classmethod
+    def key_cache(cls):
+        """ Return the DimensionKeyCache for this dimension, creating it
+        the first time it's needed.
+        """
+        cache = cls.__dict__.get("__keycache__")
+        if cache is None:
+            cache = DimensionKeyCache(cls, size=cls.__key_cache_size__)
+            cls.__keycache__ = cache
+        return cache
+
+    @classmethod
+    def insert(cls, *records, **kwargs):
+        """ Insert dimension records as new versions of their members,
+        then close the versions they replace (see `close_versions`) and
+        clear any cached keys as they may no longer be the latest.
+
+        Changes to overwritten columns are applied in place to every
+        version of their members instead (see `overwrite`).
+
+        Returns False if any records couldn't be inserted.
+        """
+        inserted = True
+        batch = RecordBatch.of(cls, records)
+        versions, overwrites = cls.change_detector().compare(batch)
+        skipped = len(batch) - len(versions) - len(overwrites)
+        if skipped:
+            log.debug("Skipping %s unchanged records", skipped,
+                      extra={"table": cls.__tablename__})
+        if versions:
+            new_versions = batch.take(versions)
+            inserted = super(Dimension, cls).insert(new_versions, **kwargs)
+            cls.close_versions(new_versions)
+        if overwrites or (versions and cls.overwrite_columns()):
+            # New versions may also change overwritten columns, which
+            # then need overwriting in the older versions.
+            inserted = cls.overwrite(batch.take(sorted(versions + overwrites)),
+                                     mode=kwargs.get("mode")) and inserted
+        cache = cls.__dict__.get("__keycache__")
+        if cache is not None:
+            cache.clear()
+        return inserted
+
+    @classmethod
+    def overwrite_columns(cls):
+        """ Return the columns whose values are overwritten in place when
+        they change, instead of adding a new version of the member (a
+        'type 1' change). These are columns declared with
+        `overwrite=True`, or all but the natural keys if the dimension
+        sets `__overwrite__`.
+        """
+        return [column for column in cls.__columns__
+                if type(column) is Column and
+                (column.overwrite or cls.__overwrite__)]
+
+    @classmethod
+    def _overwrite_table(cls):
+        """ Return a table class for the temporary table used to stage
+        overwritten values, created the first time it's needed.
+        """
+        overwrite_table = cls.__dict__.get("__overwritetable__")
+        if overwrite_table is None:
+            key = cls.__naturalkeys__[0]
+            attributes = {
+                "__tablename__": "%s_overwrite" % cls.__tablename__,
+                "__indexes__": [Index(key.name)],
+            }
+            for column in [key, cls.row_hash] + cls.overwrite_columns():
+                attributes[cls.__columnattrs__[column.name]] = column
+            overwrite_table = type(cls.__name__ + "Overwrite", (Table,),
+                                   attributes)
+            cls.__overwritetable__ = overwrite_table
+        return overwrite_table
+
+    @classmethod
+    def overwrite(cls, batch, mode=None):
+        """ Overwrite the values of the overwritten columns in every version
+        of the members in a RecordBatch. The values are loaded into a
+        temporary table and applied with a single UPDATE ... JOIN. Returns
+        False if they couldn't be.
+        """
+        columns = cls.overwrite_columns()
+        if not columns:
+            return True
+        key = escaped(cls.__naturalkeys__[0].name)
+        hash_column = escaped(cls.row_hash.name)
+        overwrite_table = cls._overwrite_table()
+        staged = RecordBatch(overwrite_table)
+        staged.merge(batch)
+
+        sql = """\
+UPDATE {table_name} AS `row`
+JOIN {overwrite_table} AS `new` ON `new`.{key} = `row`.{key}
+SET {assignments}
+WHERE {changed}""".format(
+            table_name=escaped(cls.__tablename__),
+            overwrite_table=escaped(overwrite_table.__tablename__),
+            key=key,
+            assignments=",\n    ".join(
+                ["`row`.{0} = `new`.{0}".format(escaped(column.name))
+                 for column in columns] +
+                # The versioned half of the hash stays the same.
+                ["`row`.{0} = CONCAT(LEFT(`row`.{0}, 32), "
+                 "RIGHT(`new`.{0}, 32))".format(hash_column)]),
+            changed=" OR ".join(
+                "NOT (`row`.{0} <=> `new`.{0})".format(escaped(column.name))
+                for column in columns))
+
+        log.debug("Overwriting %s records", len(staged),
+                  extra={"table": cls.__tablename__})
+        connection = Warehouse.get()
+        try:
+            overwrite_table.drop_table(if_exists=True, temporary=True)
+            overwrite_table.create_table(temporary=True)
+            if not overwrite_table.insert(staged, mode=mode):
+                raise ValueError("Unable to stage overwritten values")
+            with closing(connection.cursor()) as cursor:
+                cursor.execute(sql)
+        except Exception as e:
+            classify_error(e)
+            log.error(e)
+            connection.rollback()
+            return False
+        else:
+            connection.commit()
+            return True
+        finally:
+            overwrite_table.drop_table(if_exists=True, temporary=True)
+
+    @classmethod
+    def change_detector(cls):
+        """ Return the ChangeDetector for this dimension, creating it the
+        first time it's needed.
+        """
+        detector = cls.__dict__.get("__changedetector__")
+        if detector is None:
+            detector = ChangeDetector(cls)
+            cls.__changedetector__ = detector
+        return detector
+
+    @classmethod
+    def close_versions(cls, batch=None):
+        """ Set the `applicable_to` time of every version of the members in
+        a RecordBatch (or of all members) to the `applicable_from` time of
+        the next version, so that each version applies until the next one
+        does. Current versions apply until APPLICABLE_FOREVER.
+
+        Versions are members sharing any natural key value.
+        """
+        natural_keys = cls.__naturalkeys__
+        primary_key = escaped(cls.__primarykey__.name)
+        members = " OR ".join("`next`.%s = `version`.%s" % (
+            escaped(key.name), escaped(key.name)) for key in natural_keys)
+        sql = """\
+UPDATE {table_name} AS `row`
+JOIN (
+  SELECT `version`.{primary_key} AS `id`, COALESCE(MIN(`next`.`applicable_from`), {forever}) AS `applicable_to`
+  FROM {table_name} AS `version`
+  LEFT JOIN {table_name} AS `next` ON ({members}) AND `next`.`applicable_from` > `version`.`applicable_from`{where}
+  GROUP BY `version`.{primary_key}
+) AS `closed` ON `closed`.`id` = `row`.{primary_key}
+SET `row`.`applicable_to` = `closed`.`applicable_to`
+WHERE `row`.`applicable_to` <> `closed`.`applicable_to`"""
+
+        wheres = []
+        if batch is None:
+            wheres.append("")
+        else:
+            for start in xrange(0, len(batch), LOAD_CHUNK_SIZE):
+                end = start + LOAD_CHUNK_SIZE
+                conditions = []
+                for key in natural_keys:
+                    values = set(batch[key.name][start:end])
+                    values.discard(None)
+                    if values:
+                        conditions.append("`version`.%s IN (%s)" % (
+                            escaped(key.name), ",".join(map(dump, values))))
+                if conditions:
+                    wheres.append("\n  WHERE " + " OR ".join(conditions))
+
+        connection = Warehouse.get()
+        with closing(connection.cursor()) as cursor:
+            for where in wheres:
+                try:
+                    cursor.execute(sql.format(
+                        table_name=escaped(cls.__tablename__),
+                        primary_key=primary_key,
+                        forever=dump(APPLICABLE_FOREVER),
+                        members=members,
+                        where=where))
+                except Exception as e:
+                    classify_error(e)
+                    log.error(e)
+                    connection.rollback()
+                else:
+                    connection.commit()
+
+    @classmethod
+    def build(cls):
+        super(Dimension, cls).build()
+        cls._upgrade_versions()
+
+    @classmethod
+    def _upgrade_versions(cls):
+        """ Upgrade a dimension table created before members could have
+        several versions: add the `applicable_to` and `row_hash` columns
+        and drop unique keys on single natural keys. Row hashes are filled
+        in as members are next updated (see `ChangeDetector`).
+        """
+        table_name = escaped(cls.__tablename__)
+        natural_key_names = set(key.name for key in cls.__naturalkeys__)
+        connection = Warehouse.get()
+        with closing(connection.cursor()) as cursor:
+            try:
+                for column in (cls.applicable_to, cls.row_hash):
+                    cursor.execute("SHOW COLUMNS FROM %s LIKE %s" % (
+                        table_name, dump(column.name)))
+                    if cursor.fetchall():
+                        continue
+                    log.info("Adding %s column", column.name,
+                             extra={"table": cls.__tablename__})
+                    cursor.execute("ALTER TABLE %s ADD COLUMN %s" % (
+                        table_name, column.expression))
+                    if column is cls.applicable_to:
+                        cls.close_versions()
+
+                cursor.execute("SHOW INDEX FROM %s" % table_name)
+                unique_keys = {}
+                for row in cursor.fetchall():
+                    non_unique, key_name, column_name = row[1], row[2], row[4]
+                    if not non_unique and key_name != "PRIMARY":
+                        unique_keys.setdefault(key_name, []).append(
+                            column_name)
+                for key_name, column_names in unique_keys.items():
+                    if len(column_names) == 1 and \
+                            column_names[0] in natural_key_names:
+                        log.info("Dropping unique key %s", key_name,
+                                 extra={"table": cls.__tablename__})
+                        cursor.execute("ALTER TABLE %s DROP INDEX %s" % (
+                            table_name, escaped(key_name)))
+            except Exception as exception:
+                classify_error(exception)
+                raise exception
+
     def __repr__(self):
         return unicode(self[self.__naturalkeys__[0].name])
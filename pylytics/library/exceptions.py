@@ -55,6 +55,34 @@ class NoSuchTableError(ProgrammingError):
     code = 1146
 
 
+class IncompleteUpdateError(Exception):
+    """ Raised when a dimension is refreshed but not every record selected
+    could be inserted.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        super(IncompleteUpdateError, self).__init__(
+            "Not every record could be inserted into %s" % (
+                table.__tablename__))
+
+
+class DimensionUpdateError(Exception):
+    """ Raised when one or more dimensions couldn't be updated, with the
+    error raised for each dimension in `errors`.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(DimensionUpdateError, self).__init__(
+            "Unable to update %s: %s" % (
+                "dimension" if len(errors) == 1 else
+                "%s dimensions" % len(errors),
+                "; ".join("%s (%s: %s)" % (dimension.__tablename__,
+                                           error.__class__.__name__, error)
+                          for dimension, error in errors.items())))
+
+
 def classify_error(error):
     """ Alter the class of an error to something specific instead of the
     generic error raised. This enables errors to be caught more cleanly
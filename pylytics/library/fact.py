@@ -1,13 +1,17 @@
 from contextlib import closing
-import math
+from datetime import datetime
 import logging
+from multiprocessing.pool import ThreadPool
 
+from batch import RecordBatch
 from column import *
-from exceptions import classify_error
+from exceptions import DimensionUpdateError, classify_error
+from index import Index
 from schedule import Schedule
 from selector import DimensionSelector
+from plan import JOIN, JOIN_TIMESTAMP, PREPARED, SUBQUERY
 from table import Table
-from utils import dump, escaped
+from utils import escaped
 from warehouse import Warehouse
 
 
@@ -47,6 +51,21 @@ class Fact(Table):
     __schedule__ = Schedule()
     __historical_source__ = None
 
+    # How the table is partitioned, if at all; e.g. MonthlyPartitions.
+    __partitioning__ = None
+
+    # How dimension keys are resolved on insert; either SUBQUERY (by the
+    # server, for each value), CACHE (by the client, using each
+    # dimension's key cache and only falling back to a subquery for
+    # values not found there) or JOIN (by the server, joining each
+    # dimension onto a temporary table holding a whole batch of values).
+    __key_resolution__ = SUBQUERY
+
+    # How many dimensions are updated at once before the fact is; with
+    # more than one, each is updated by a thread with its own warehouse
+    # connection.
+    __dimension_workers__ = 1
+
     id = PrimaryKey()
     created = CreatedTimestamp()
 
@@ -55,6 +74,7 @@ class Fact(Table):
         for dimension_key in cls.__dimensionkeys__:
             dimension_key.dimension.build()
         super(Fact, cls).build()
+        cls.add_partitions()
         # TODO: copy view functionality to here
         # TODO: Fix the rolling view for when the same dimensions is used
         # twice. The problem is having multiple join clauses.
@@ -63,24 +83,110 @@ class Fact(Table):
         # cls.create_or_replace_midnight_view() -- only if a date column is defined
 
     @classmethod
-    def update(cls, since=None, historical=False):
+    def update(cls, since=None, historical=False, mode=None,
+               dimensions=True):
+        """ Update the dimensions referenced and then the fact itself.
+        Pass `dimensions=False` if the dimensions are known to be up to
+        date already, e.g. when a RunPlan has updated them.
+        """
         if not (cls.__historical_source__ if historical else cls.__source__):
             # Bail early before building dimensions.
             raise NotImplementedError("No data source defined")
 
-        # Remove any duplicate dimensions.
-        unique_dimensions = []
-        for dimension_key in cls.__dimensionkeys__:
-            if dimension_key.dimension not in unique_dimensions:
-                unique_dimensions.append(dimension_key.dimension)
+        if dimensions:
+            # Remove any duplicate dimensions.
+            unique_dimensions = []
+            for dimension_key in cls.__dimensionkeys__:
+                if dimension_key.dimension not in unique_dimensions:
+                    unique_dimensions.append(dimension_key.dimension)
+
+            cls.update_dimensions(unique_dimensions, since=since)
+        cls.add_partitions()
+        return super(Fact, cls).update(since=since, historical=historical,
+                                       mode=mode)
+
+    @classmethod
+    def update_dimensions(cls, dimensions, since=None):
+        """ Refresh each of the dimensions given (see
+        `Dimension.refresh`), `__dimension_workers__` at a time, and wait
+        for them all to finish. Raises a
+        DimensionUpdateError with the errors for any which failed.
+        """
+        workers = min(cls.__dimension_workers__, len(dimensions))
+        if workers > 1 and not Warehouse.pooled:
+            log.warning("Updating dimensions one at a time, as there's no "
+                        "connection pool", extra={"table": cls.__tablename__})
+            workers = 1
 
-        for dimension in unique_dimensions:
-            dimension.update(since=since)
-        return super(Fact, cls).update(since=since, historical=historical)
+        def update(dimension):
+            try:
+                if workers > 1:
+                    with Warehouse.local_connection():
+                        dimension.refresh(since=since)
+                else:
+                    dimension.refresh(since=since)
+            except Exception as error:
+                log.error("Unable to update dimension (%s: %s)",
+                          error.__class__.__name__, error,
+                          extra={"table": dimension.__tablename__})
+                return error
+
+        if workers > 1:
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(update, dimensions)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(update, dimensions)
+
+        errors = {dimension: error
+                  for dimension, error in zip(dimensions, results) if error}
+        if errors:
+            raise DimensionUpdateError(errors)
+
+    @classmethod
+    def definitions(cls):
+        """ Partitioned tables can't have foreign keys and need the
+        partitioning column in the primary key, so the definitions for
+        those columns are replaced.
+        """
+        partitioning = cls.__partitioning__
+        if not partitioning:
+            return super(Fact, cls).definitions()
+        definitions = []
+        for column in cls.__columns__:
+            if isinstance(column, PrimaryKey):
+                definitions.append(column.plain_expression + " AUTO_INCREMENT")
+            else:
+                definitions.append(column.plain_expression)
+        definitions.append("PRIMARY KEY (%s, %s)" % (
+            escaped(cls.__primarykey__.name), escaped(partitioning.column)))
+        definitions.extend(index.expression for index in cls.indexes())
+        return definitions
+
+    @classmethod
+    def indexes(cls):
+        """ Dimension keys of partitioned tables are indexed explicitly,
+        as there are no foreign keys to index them.
+        """
+        indexes = super(Fact, cls).indexes()
+        if cls.__partitioning__:
+            indexes.extend(Index(dimension_key.name)
+                           for dimension_key in cls.__dimensionkeys__)
+        return indexes
+
+    @classmethod
+    def add_partitions(cls):
+        """ Add partitions for the months ahead to a partitioned table.
+        """
+        if cls.__partitioning__:
+            cls.__partitioning__.add_partitions(cls)
 
     # TODO Consider adding historical to dimensions.
     @classmethod
-    def historical(cls):
+    def historical(cls, mode=None, dimensions=True):
         """ Historical is only intended to be run once to populate a fact
         table with historical data after creation.
 
@@ -88,8 +194,11 @@ class Fact(Table):
         historical data isn't available, or there is no interest in the
         historical data.
 
+        As this can be a lot of data, a faster insert mode such as LOAD
+        can be chosen for the historical load alone.
+
         """
-        cls.update(historical=True)
+        cls.update(historical=True, mode=mode, dimensions=dimensions)
 
     @classmethod
     def create_or_replace_rolling_view(cls):
@@ -137,56 +246,115 @@ class Fact(Table):
             connection.commit()
 
     @classmethod
-    def insert(cls, *instances):
+    def _join_table(cls, shape):
+        """ Return a table class for the temporary table used to JOIN
+        dimension keys for records of a given shape (see
+        `InsertPlan.groups`). It has the same columns as this fact, except
+        that dimension keys hold natural key values, plus a column for
+        the dimension selector timestamp.
+        """
+        join_tables = cls.__dict__.get("__jointables__")
+        if join_tables is None:
+            join_tables = cls.__jointables__ = {}
+        try:
+            return join_tables[shape]
+        except KeyError:
+            pass
+
+        plan = cls.insert_plan()
+        value_types = dict(
+            (position, value_type) for (position, _), value_type
+            in zip(plan.dimension_keys, shape))
+        attributes = {
+            "__tablename__": "%s_join_%s" % (cls.__tablename__,
+                                             len(join_tables)),
+            JOIN_TIMESTAMP: Column(JOIN_TIMESTAMP, datetime, optional=True),
+        }
+        for position, column in enumerate(plan.columns):
+            if position in value_types:
+                key = column.dimension._natural_keys_for(
+                    value_types[position])[0]
+                column = Column(column.name, key.type, size=key.size,
+                                optional=True)
+            attributes[cls.__columnattrs__[column.name]] = column
+        join_table = type(cls.__name__ + "Join", (Table,), attributes)
+        join_tables[shape] = join_table
+        return join_table
+
+    @classmethod
+    def _insert_joined(cls, batch, mode):
+        """ Insert a RecordBatch of facts by loading them, with natural
+        key values in place of dimension keys, into temporary tables and
+        then copying them across with a single INSERT ... SELECT, which
+        resolves every dimension key with a join. Returns False if any
+        records couldn't be inserted.
+        """
+        inserted = True
+        plan = cls.insert_plan()
+        names = [column.name for column in plan.columns]
+        connection = Warehouse.get()
+        for shape, rows in plan.groups(batch):
+            join_table = cls._join_table(shape)
+            joined = RecordBatch(join_table)
+            for row, timestamp in rows:
+                record = dict(zip(names, row))
+                record[JOIN_TIMESTAMP] = timestamp
+                joined.append(record)
+
+            log.debug('Inserting %s records by join' % len(joined),
+                      extra={"table": cls.__tablename__})
+            try:
+                join_table.drop_table(if_exists=True, temporary=True)
+                join_table.create_table(temporary=True)
+                if not join_table.insert(joined, mode=mode):
+                    raise ValueError("Unable to load records to join")
+                with closing(connection.cursor()) as cursor:
+                    cursor.execute(plan.join_statement(
+                        shape, join_table.__tablename__))
+            except Exception as e:
+                classify_error(e)
+                log.error(e)
+                # TODO We want to log the sql to file.
+                connection.rollback()
+                inserted = False
+            else:
+                connection.commit()
+            finally:
+                join_table.drop_table(if_exists=True, temporary=True)
+        return inserted
+
+    @classmethod
+    def insert(cls, *records, **kwargs):
         """ Insert fact instances (overridden to handle Dimensions correctly)
         """
-        if instances:
-            columns = [column for column in cls.__columns__
-                       if not isinstance(column, AutoColumn)]
-            sql = "INSERT INTO %s (\n  %s\n)\n" % (
-                escaped(cls.__tablename__),
-                ",\n  ".join(escaped(column.name) for column in columns))
+        inserted = True
+        batch = RecordBatch.of(cls, records)
+        if batch:
+            mode = kwargs.get("mode") or cls.__insert_mode__
+            if cls.__key_resolution__ == JOIN and cls.__dimensionkeys__:
+                return cls._insert_joined(batch, mode)
+
+            plan = cls.insert_plan()
 
             # We can't insert too many at once, otherwise the target
-            # database will 'go away'.
-            # TODO These should be dynamically sized based on the
-            # max_packet_size.
-            # TODO Move this batching into a separate method.
-            batch_size = 1000
-            batch_number = int(math.ceil(len(instances) / float(batch_size)))
-            batches = [instances[i * batch_size:(i + 1) * batch_size] for i in xrange(batch_number)]
-
-            for iteration, batch in enumerate(batches, start=1):
-                log.debug('Inserting batch %s' % (iteration),
-                          extra={"table": cls.__tablename__})
-
-                insert_statement = sql
-                link = "VALUES"
-
-                for instance in batch:
-                    values = []
-                    for column in columns:
-                        value = instance[column.name]
-                        if isinstance(column, DimensionKey):
-                            values.append(
-                                "(%s)" % column.dimension.__subquery__(
-                                    value,
-                                    instance.__dimension_selector__.timestamp(instance) # TODO This is a bit messy - shouldn't have to pass the instance back in.
-                                    )
-                                )
-                        else:
-                            values.append(dump(value))
-                    insert_statement += link + (" (\n  %s\n)" % ",\n  ".join(values))
-                    link = ","
-
-                connection = Warehouse.get()
-                try:
-                    with closing(connection.cursor()) as cursor:
-                        cursor.execute(insert_statement)
-                except Exception as e:
-                    classify_error(e)
-                    log.error(e)
-                    # TODO We want to log the sql to file.
-                    connection.rollback()
-                else:
-                    connection.commit()
+            # database will 'go away', so the plan's batcher splits the
+            # records between statements.
+            connection = Warehouse.get()
+            with closing(connection.cursor(prepared=(mode == PREPARED))) \
+                    as cursor:
+                for iteration, (statement, parameters) in enumerate(
+                        plan.statements(batch, mode), start=1):
+                    log.debug('Inserting batch %s' % (iteration),
+                              extra={"table": cls.__tablename__})
+                    try:
+                        with plan.batcher.timing():
+                            cursor.execute(statement, parameters)
+                    except Exception as e:
+                        classify_error(e)
+                        log.error(e)
+                        # TODO We want to log the sql to file.
+                        connection.rollback()
+                        inserted = False
+                    else:
+                        connection.commit()
+        return inserted
@@ -0,0 +1,70 @@
+from column import Column
+from utils import escaped
+
+
+__all__ = ['Index']
+
+# MySQL identifiers can't be any longer than this.
+MAX_NAME_LENGTH = 64
+
+
+class Index(object):
+    """ A secondary index on a table, declared in the `__indexes__` list of
+    a Table class, e.g.
+
+        __indexes__ = [
+            Index("date", "store"),
+            Index(("product_name", 10), unique=True),
+        ]
+
+    Columns are given by name (or as Column objects) in index order. A
+    column can be given as a (name, length) pair to index only a prefix
+    of its values, which keeps indexes on long strings small. MySQL has
+    no included columns, so a covering index just lists every column the
+    queries it serves need, with the filtered columns first.
+
+    """
+
+    def __init__(self, *columns, **kwargs):
+        if not columns:
+            raise ValueError("An index needs at least one column")
+        self.columns = []
+        for column in columns:
+            if isinstance(column, tuple):
+                column, length = column
+            else:
+                length = None
+            if isinstance(column, Column):
+                column = column.name
+            self.columns.append((column, length))
+        self.unique = kwargs.get("unique", False)
+        self.name = kwargs.get("name") or "ix_" + "_".join(
+            column for column, _ in self.columns)
+        self.name = self.name[:MAX_NAME_LENGTH]
+
+    def __repr__(self):
+        return self.expression
+
+    def __eq__(self, other):
+        return isinstance(other, Index) and \
+            (self.name, self.columns, self.unique) == \
+            (other.name, other.columns, other.unique)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.name)
+
+    @property
+    def expression(self):
+        """ The index definition, as used in CREATE and ALTER TABLE.
+        """
+        parts = []
+        for column, length in self.columns:
+            if length:
+                parts.append("%s(%s)" % (escaped(column), length))
+            else:
+                parts.append(escaped(column))
+        return "%s %s (%s)" % ("UNIQUE KEY" if self.unique else "KEY",
+                               escaped(self.name), ", ".join(parts))
@@ -0,0 +1,157 @@
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import closing
+import logging
+import threading
+
+from utils import dump, escaped
+from warehouse import Warehouse
+
+
+__all__ = ['DimensionKeyCache']
+log = logging.getLogger("pylytics")
+
+# The number of natural key values looked up per query when loading.
+LOAD_CHUNK_SIZE = 1000
+
+
+def _normalised(value):
+    """ Return a hashable version of a natural key value which compares
+    equal whether it came from Python or from the database (which returns
+    strings in binary collations as bytearrays).
+    """
+    if isinstance(value, (str, bytearray)):
+        try:
+            return str(value).decode("utf-8")
+        except UnicodeDecodeError:
+            return str(value)
+    return value
+
+
+class DimensionKeyCache(object):
+    """ Client-side cache of dimension primary keys, so that facts can be
+    inserted with dimension keys already resolved instead of looking each
+    one up with a subquery.
+
+    For each natural key value the cache holds every version of the
+    matching dimension rows as (applicable_from, id, applicable_to)
+    tuples sorted by the start of the interval they apply for. The
+    version applicable at the time being looked up is found with a binary
+    search of those intervals, just like `Dimension.__subquery__`.
+
+    With no size given, the whole dimension is loaded on first use.
+    Otherwise natural key values are loaded as they are needed and only
+    the most recently used `size` values are kept.
+
+    """
+
+    def __init__(self, dimension, size=None):
+        self.dimension = dimension
+        self.size = size
+        self.__versions = OrderedDict()
+        self.__loaded = False
+        self.__lock = threading.RLock()
+
+    def clear(self):
+        """ Forget everything cached, e.g. after the dimension changes.
+        """
+        with self.__lock:
+            self.__versions.clear()
+            self.__loaded = False
+
+    def resolve(self, values, timestamps):
+        """ Return a list of dimension ids for each natural key value and
+        timestamp pair supplied. None is returned for values that can't be
+        resolved from the cache and need looking up by the server instead.
+        """
+        with self.__lock:
+            keys = {}
+            for value in values:
+                value_type = type(value)
+                if value_type not in keys:
+                    keys[value_type] = [
+                        key.name for key in
+                        self.dimension._natural_keys_for(value_type)]
+            self._load(values, keys)
+            return [self._lookup(keys[type(value)], value, timestamp)
+                    for value, timestamp in zip(values, timestamps)]
+
+    def _lookup(self, key_names, value, timestamp):
+        value = _normalised(value)
+        versions = []
+        for key_name in key_names:
+            try:
+                versions.extend(self.__versions[key_name, value])
+            except KeyError:
+                continue
+            if self.size:
+                # Keep track of recent use.
+                self.__versions[key_name, value] = \
+                    self.__versions.pop((key_name, value))
+        if not versions:
+            return None
+        if len(key_names) > 1:
+            versions.sort()
+        index = bisect_right(versions, (timestamp, float("inf")))
+        if not index:
+            return None
+        _, id_, applicable_to = versions[index - 1]
+        return id_ if timestamp < applicable_to else None
+
+    def _load(self, values, keys):
+        """ Make sure the cache holds the versions for the values given.
+        """
+        if not self.size:
+            if not self.__loaded:
+                self._select(self._natural_key_names())
+                self.__loaded = True
+            return
+
+        missing = {}
+        for value in set(values):
+            normalised = _normalised(value)
+            for key_name in keys[type(value)]:
+                if (key_name, normalised) not in self.__versions:
+                    missing.setdefault(key_name, []).append(value)
+        for key_name, key_values in missing.items():
+            for start in xrange(0, len(key_values), LOAD_CHUNK_SIZE):
+                chunk = key_values[start:start + LOAD_CHUNK_SIZE]
+                # Remember values with no rows too, so they're not
+                # looked up again.
+                for value in chunk:
+                    self.__versions[key_name, _normalised(value)] = []
+                self._select([key_name], "%s IN (%s)" % (
+                    escaped(key_name), ",".join(map(dump, chunk))))
+        while len(self.__versions) > self.size:
+            self.__versions.popitem(last=False)
+
+    def _natural_key_names(self):
+        return [key.name for key in self.dimension.__naturalkeys__]
+
+    def _select(self, key_names, where=None):
+        """ Load the versions of the dimension rows matching a WHERE
+        clause (or all rows), indexed by each of the natural keys named.
+        """
+        dimension = self.dimension
+        sql = "SELECT %s, `applicable_from`, `applicable_to`, %s FROM %s" % (
+            ", ".join(map(escaped, key_names)),
+            escaped(dimension.__primarykey__.name),
+            escaped(dimension.__tablename__))
+        if where:
+            sql += " WHERE " + where
+
+        log.debug("Loading dimension keys", extra={
+            "table": dimension.__tablename__})
+        updated = set()
+        connection = Warehouse.get()
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(sql)
+            for row in cursor:
+                applicable_from, applicable_to, id_ = row[-3:]
+                for key_name, value in zip(key_names, row):
+                    key = (key_name, _normalised(value))
+                    self.__versions.setdefault(key, []).append(
+                        (applicable_from, id_, applicable_to))
+                    updated.add(key)
+        for key in updated:
+            self.__versions[key].sort()
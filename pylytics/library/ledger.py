@@ -0,0 +1,85 @@
+from contextlib import closing
+from datetime import datetime
+import logging
+
+from column import *
+from index import Index
+from table import Table
+from utils import dump, escaped
+from warehouse import Warehouse
+
+
+__all__ = ['RefreshLedger']
+log = logging.getLogger("pylytics")
+
+
+class RefreshLedger(Table):
+    """ When each table was last refreshed from its source, held in the
+    warehouse so that every process can see it. Times are taken from the
+    warehouse server's UTC clock, so processes on different hosts agree.
+    """
+
+    __tablename__ = "pylytics_refresh"
+    __indexes__ = [
+        Index("table_name", unique=True),
+    ]
+
+    id = PrimaryKey()
+    table_name = Column("table_name", unicode, size=64)
+    refreshed_at = Column("refreshed_at", datetime)
+    created = CreatedTimestamp()
+
+    # Whether the table is known to exist.
+    __built = False
+
+    @classmethod
+    def _build_once(cls):
+        if not cls.__built:
+            cls.create_table(if_not_exists=True)
+            cls.__built = True
+
+    @classmethod
+    def now(cls):
+        """ Return the current time on the warehouse server, in UTC.
+        """
+        connection = Warehouse.get()
+        with closing(connection.cursor()) as cursor:
+            cursor.execute("SELECT UTC_TIMESTAMP()")
+            return cursor.fetchall()[0][0]
+
+    @classmethod
+    def age(cls, table_name):
+        """ Return the number of seconds since a table was last refreshed,
+        or None if it never has been.
+        """
+        cls._build_once()
+        sql = "SELECT TIMESTAMPDIFF(SECOND, `refreshed_at`, " \
+              "UTC_TIMESTAMP()) FROM %s WHERE `table_name` = %s" % (
+                  escaped(cls.__tablename__), dump(table_name))
+        connection = Warehouse.get()
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(sql)
+            rows = cursor.fetchall()
+        return rows[0][0] if rows else None
+
+    @classmethod
+    def record(cls, table_name, refreshed_at):
+        """ Record that a table was refreshed from its source as of the
+        time given (usually when the refresh started).
+        """
+        cls._build_once()
+        sql = "INSERT INTO %s (`table_name`, `refreshed_at`)\n" \
+              "VALUES (%s, %s)\n" \
+              "ON DUPLICATE KEY UPDATE " \
+              "`refreshed_at` = VALUES(`refreshed_at`)" % (
+                  escaped(cls.__tablename__), dump(table_name),
+                  dump(refreshed_at))
+        connection = Warehouse.get()
+        with closing(connection.cursor()) as cursor:
+            try:
+                cursor.execute(sql)
+            except:
+                connection.rollback()
+                raise
+            else:
+                connection.commit()
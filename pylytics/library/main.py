@@ -9,6 +9,8 @@ from pytz import UTC
 import connection
 from log import ColourFormatter, bright_white
 from fact import Fact
+from plan import LOAD
+from planner import RunPlan
 from warehouse import Warehouse
 from settings import Settings, settings
 
@@ -115,13 +117,30 @@ class Commander(object):
     def __init__(self, db_name):
         self.db_name = db_name
 
-    def run(self, command, *facts):
-        """ Run command for each fact in facts.
-        """
-
-        _connection = connection.get_named_connection(settings.pylytics_db)
-        Warehouse.use(_connection)
+    def run(self, command, *facts, **kwargs):
+        """ Run command for each fact in facts. Any keyword arguments are
+        passed on to the command, apart from `jobs`.
 
+        The update and historical commands are run by a RunPlan, which
+        updates each dimension shared by the facts only once and runs up
+        to `jobs` dimensions and facts at a time.
+        """
+        jobs = kwargs.pop("jobs", 1)
+
+        pool = connection.get_pool(settings.pylytics_db)
+        _connection = pool.acquire()
+        Warehouse.use(_connection, pool=pool)
+        try:
+            self._run(command, facts, jobs, **kwargs)
+        finally:
+            # Return the Warehouse connection to the pool.
+            log.info('Releasing Warehouse connection.')
+            pool.release(_connection)
+
+    def _run(self, command, facts, jobs, **kwargs):
+        """ Run command for each fact in facts, exiting with an error status
+        if the facts run by a RunPlan raised any errors.
+        """
         all_fact_classes = get_all_fact_classes()
 
         # Normalise the collection of facts supplied to remove duplicates,
@@ -145,18 +164,20 @@ class Commander(object):
             facts_to_run = list(set(facts_to_run))
 
         # Execute the command on each fact class.
-        for fact_class in facts_to_run:
-            try:
-                command_function = getattr(fact_class, command)
-            except AttributeError:
-                log.error("Cannot find command %s for fact class %s",
-                          command, fact_class)
-            else:
-                command_function()
-
-        # Close the Warehouse connection.
-        log.info('Closing Warehouse connection.')
-        Warehouse.get().close()
+        if command in ("update", "historical"):
+            errors = RunPlan(facts_to_run, jobs=jobs).run(command, **kwargs)
+            print_summary(errors)
+            if errors:
+                sys.exit(1)
+        else:
+            for fact_class in facts_to_run:
+                try:
+                    command_function = getattr(fact_class, command)
+                except AttributeError:
+                    log.error("Cannot find command %s for fact class %s",
+                              command, fact_class)
+                else:
+                    command_function(**kwargs)
 
 
 def enable_logging():
@@ -185,6 +206,17 @@ def main():
         type = str,
         nargs = 1,
         )
+    parser.add_argument(
+        '--bulk-load',
+        help = 'Use LOAD DATA LOCAL INFILE to insert historical data.',
+        action = 'store_true',
+        )
+    parser.add_argument(
+        '--jobs',
+        help = 'The number of dimensions and facts to update at once.',
+        type = int,
+        default = 1,
+        )
     parser.add_argument(
         'command',
         help = 'The command you want to run.',
@@ -224,13 +256,19 @@ def main():
 
     if command == 'update':
         commander.run('build', *args['fact'])
-        commander.run('update', *args['fact'])
+        commander.run('update', *args['fact'], jobs=args['jobs'])
     elif command == 'historical':
-        commander.run('historical', *args['fact'])
+        if args['bulk_load']:
+            commander.run('historical', *args['fact'], mode=LOAD,
+                          jobs=args['jobs'])
+        else:
+            commander.run('historical', *args['fact'], jobs=args['jobs'])
     elif command == 'build':
         commander.run('build', *args['fact'])
     else:
         log.error("Unknown command: %s", command)
 
+    connection.close_pools()
+
     sys.stdout.write(bright_white("\nCompleted at {}\n\n".format(
         datetime.datetime.now())))
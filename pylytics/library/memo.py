@@ -0,0 +1,42 @@
+from collections import OrderedDict
+
+
+__all__ = ['Memo']
+
+# Marks a value not held in a memo.
+MISSING = object()
+
+
+class Memo(object):
+    """ A memo of the results of recent lookups, keeping only the most
+    recently used `size` of them. With a size of zero nothing is kept.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.__results = OrderedDict()
+
+    def __len__(self):
+        return len(self.__results)
+
+    def __contains__(self, key):
+        return key in self.__results
+
+    def get(self, key, default=MISSING):
+        """ Return the result for a key, or `default` if it isn't held.
+        """
+        try:
+            result = self.__results.pop(key)
+        except KeyError:
+            return default
+        # Keep track of recent use.
+        self.__results[key] = result
+        return result
+
+    def put(self, key, result):
+        if not self.size:
+            return
+        self.__results.pop(key, None)
+        self.__results[key] = result
+        while len(self.__results) > self.size:
+            self.__results.popitem(last=False)
@@ -0,0 +1,138 @@
+from contextlib import closing
+from datetime import date, datetime
+import logging
+import re
+
+from exceptions import classify_error
+from utils import dump, escaped
+from warehouse import Warehouse
+
+
+__all__ = ['MonthlyPartitions']
+log = logging.getLogger("pylytics")
+
+# The partition holding everything beyond the last month partitioned.
+FUTURE_PARTITION = "pfuture"
+
+_month_partition = re.compile(r"^p(\d{4})(\d{2})$")
+
+
+def _add_months(month, count):
+    """ Return the first day of the month `count` months after the month
+    of the date given.
+    """
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+class MonthlyPartitions(object):
+    """ RANGE partitioning of a fact table by month, for use as the
+    `__partitioning__` of a Fact, e.g.
+
+        __partitioning__ = MonthlyPartitions("date")
+
+    The column may be a date column or a datetime (TIMESTAMP) column, such
+    as `created`. Each month has a partition named pYYYYMM, and a final
+    catch-all partition holds anything later. Partitions are added so
+    that there are always `ahead` months partitioned beyond the current
+    month; anything before the month partitioning started (`start`, or
+    the month the table was created) goes into the first partition.
+
+    MySQL requires the partitioning column to be part of every unique key
+    of a partitioned table, and doesn't support foreign keys on one.
+
+    """
+
+    def __init__(self, column, ahead=3, start=None):
+        self.column = column
+        self.ahead = ahead
+        self.start = start
+
+    def _function(self, table):
+        """ Return the SQL function converting values of the partitioning
+        column into the integers MySQL partitions by.
+        """
+        for column in table.__columns__:
+            if column.name == self.column:
+                break
+        else:
+            raise ValueError("No partitioning column '%s' in table "
+                             "'%s'" % (self.column, table.__tablename__))
+        if column.type is date:
+            return "TO_DAYS"
+        elif column.type is datetime:
+            return "UNIX_TIMESTAMP"
+        else:
+            raise TypeError("Can't partition by month on a column of type "
+                            "'%s'" % column.type)
+
+    def _partition(self, table, month):
+        """ Return the definition of the partition for a month.
+        """
+        boundary = _add_months(month, 1)
+        if self._function(table) == "UNIX_TIMESTAMP":
+            boundary = datetime.combine(boundary, datetime.min.time())
+        return "PARTITION p%04d%02d VALUES LESS THAN (%s(%s))" % (
+            month.year, month.month, self._function(table), dump(boundary))
+
+    def _partitions(self, table, first, last):
+        """ Return definitions of the partitions for each month from
+        `first` to `last`, followed by the catch-all partition.
+        """
+        partitions = []
+        month = first
+        while month <= last:
+            partitions.append(self._partition(table, month))
+            month = _add_months(month, 1)
+        partitions.append("PARTITION %s VALUES LESS THAN MAXVALUE" %
+                          FUTURE_PARTITION)
+        return "(\n  %s\n)" % ",\n  ".join(partitions)
+
+    def _last_month(self):
+        return _add_months(date.today(), self.ahead)
+
+    def expression(self, table):
+        """ The PARTITION BY clause used when creating the table.
+        """
+        first = _add_months(self.start or date.today(), 0)
+        return "PARTITION BY RANGE (%s(%s)) %s" % (
+            self._function(table), escaped(self.column),
+            self._partitions(table, first, max(first, self._last_month())))
+
+    def add_partitions(self, table):
+        """ Make sure the table in the current data warehouse has
+        partitions for the months ahead, splitting them out of the
+        catch-all partition (which should be empty, so this is cheap).
+        """
+        connection = Warehouse.get()
+        with closing(connection.cursor()) as cursor:
+            try:
+                cursor.execute(
+                    "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+                    "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s" %
+                    dump(table.__tablename__))
+                months = []
+                for (name,) in cursor.fetchall():
+                    match = _month_partition.match(name or "")
+                    if match:
+                        months.append(date(int(match.group(1)),
+                                           int(match.group(2)), 1))
+                if not months:
+                    log.warning("Table isn't partitioned by month; "
+                                "rebuild it to partition it",
+                                extra={"table": table.__tablename__})
+                    return
+
+                first = _add_months(max(months), 1)
+                last = self._last_month()
+                if first <= last:
+                    log.info("Adding partitions up to %s",
+                             last.strftime("%Y-%m"),
+                             extra={"table": table.__tablename__})
+                    cursor.execute(
+                        "ALTER TABLE %s REORGANIZE PARTITION %s INTO %s" % (
+                            escaped(table.__tablename__), FUTURE_PARTITION,
+                            self._partitions(table, first, last)))
+            except Exception as exception:
+                classify_error(exception)
+                raise exception
@@ -0,0 +1,366 @@
+from collections import OrderedDict
+from itertools import chain
+import os
+import tempfile
+
+from batcher import Batcher
+from column import AutoColumn, ApplicableFrom, CreatedTimestamp, DimensionKey
+from utils import column_dumper, dump, escaped, tsv
+
+
+__all__ = ['InsertPlan', 'LITERAL', 'PREPARED', 'LOAD', 'SUBQUERY', 'CACHE',
+           'JOIN']
+
+# Insert modes.
+LITERAL = "literal"     # values inlined into the statement as SQL literals
+PREPARED = "prepared"   # values sent as prepared statement parameters
+LOAD = "load"           # values streamed from a file by LOAD DATA INFILE
+
+# Ways of resolving dimension keys.
+SUBQUERY = "subquery"   # by a subquery per value, run by the server
+CACHE = "cache"         # from dimension key caches, falling back to SUBQUERY
+JOIN = "join"           # by joining a temporary table of values, per batch
+
+# The column holding the dimension selector timestamp of each record in
+# the temporary tables used to JOIN dimension keys.
+JOIN_TIMESTAMP = "pylytics_timestamp"
+
+# MySQL won't prepare a statement with more placeholders than this.
+MAX_PARAMETERS = 65535
+
+# The number of distinct prepared statements kept by each plan.
+PREPARED_CACHE_SIZE = 8
+
+
+def _encoded_size(text):
+    """ Return the number of bytes taken to send a string, which for
+    unicode is its length once encoded in the connection charset (utf8).
+    """
+    if isinstance(text, unicode):
+        return len(text.encode("utf-8"))
+    else:
+        return len(text)
+
+
+def _parameters_size(parameters):
+    """ Estimate the number of bytes taken to send a list of parameters.
+    """
+    return sum(_encoded_size(value) if isinstance(value, basestring) else 8
+               for value in parameters)
+
+
+class InsertPlan(object):
+    """ Everything needed to turn records for a table class into INSERT
+    statements, worked out once per class (see `Table.insert_plan`).
+
+    The plan holds the statement header and one value converter per
+    inserted column, chosen up front for that column's type, so inserting
+    a batch needs no further inspection of the table's columns. For
+    prepared statements, recent statement text is cached too so that the
+    same server-side statement can be reused from one batch to the next.
+
+    Records are split between statements by the plan's Batcher, which
+    should be told how long each statement took to run.
+
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.columns = [column for column in table.__columns__
+                        if not isinstance(column, AutoColumn)]
+        self.statement = "%s INTO %s (\n  %s\n)\n" % (
+            table.INSERT, escaped(table.__tablename__),
+            ",\n  ".join(escaped(column.name) for column in self.columns))
+        self.key_resolution = getattr(table, "__key_resolution__", SUBQUERY)
+        self.converters = [(column.name, self._converter(column))
+                           for column in self.columns]
+        self.dimension_keys = [
+            (position, column.dimension)
+            for position, column in enumerate(self.columns)
+            if isinstance(column, DimensionKey)]
+        if self.dimension_keys:
+            self.selector = table.__dimension_selector__
+        else:
+            self.selector = None
+        self.batcher = Batcher()
+        self.__templates = {}
+        self.__prepared = OrderedDict()
+
+    def _converter(self, column):
+        """ Return a function converting a column of values to SQL, given
+        the dimension selector timestamps for the same records.
+        """
+        if isinstance(column, DimensionKey):
+            # Dimension keys become subqueries selecting the dimension
+            # row that applies at the timestamp chosen for each record,
+            # unless they can be resolved from the dimension key cache.
+            subquery = column.dimension.__subquery__
+            if self.key_resolution == CACHE:
+                cache = column.dimension.key_cache()
+
+                def convert(values, timestamps):
+                    ids = cache.resolve(values, timestamps)
+                    return [
+                        unicode(id_) if id_ is not None else
+                        "(%s)" % subquery(value, timestamp)
+                        for id_, value, timestamp in zip(ids, values,
+                                                         timestamps)]
+                return convert
+            else:
+                return lambda values, timestamps: [
+                    "(%s)" % subquery(value, timestamp)
+                    for value, timestamp in zip(values, timestamps)]
+        else:
+            dump_values = column_dumper(column.type)
+            return lambda values, timestamps: dump_values(values)
+
+    def timestamps(self, batch):
+        """ Return the dimension selector timestamps for a RecordBatch, or
+        a list of None values if this table has no dimension keys.
+        """
+        if self.selector:
+            return self.selector.timestamps(batch)
+        else:
+            return [None] * len(batch)
+
+    def rows(self, batch):
+        """ Convert a RecordBatch into a list of SQL row value lists, one
+        for each record and ready to follow the statement header.
+        """
+        timestamps = self.timestamps(batch)
+        values = [convert(batch[name], timestamps)
+                  for name, convert in self.converters]
+        return [" (\n  %s\n)" % ",\n  ".join(row) for row in zip(*values)]
+
+    def statements(self, batch, mode=LITERAL):
+        """ Yield (statement, parameters) pairs which together insert
+        every record in a RecordBatch.
+        """
+        if mode == LITERAL:
+            return self.literal_statements(batch)
+        elif mode == PREPARED:
+            return self.prepared_statements(batch)
+        elif mode == LOAD:
+            return self.load_statements(batch)
+        else:
+            raise ValueError("Unknown insert mode '%s'" % mode)
+
+    def literal_statements(self, batch):
+        """ Yield INSERT statements with values inlined as SQL literals.
+        As there are no parameters, each is paired with None.
+        """
+        header = self.statement + "VALUES"
+        for rows in self.batcher.batches(self.rows(batch),
+                                         size=_encoded_size,
+                                         overhead=_encoded_size(header)):
+            yield header + ",".join(rows), None
+
+    def prepared_statements(self, batch):
+        """ Yield multi-row INSERT statements with `%s` placeholders for
+        the values, each paired with its list of parameters.
+
+        The SQL needed for a dimension key depends on the type of value
+        being looked up, so each group of records from `groups` is
+        inserted separately.
+        """
+        header = self.statement + "VALUES"
+        for shape, rows in self.groups(batch):
+            template, expanders, width = self._template(shape)
+            parameter_rows = []
+            for row, timestamp in rows:
+                parameters = []
+                for expand, value in zip(expanders, row):
+                    parameters.extend(expand(value, timestamp))
+                parameter_rows.append(parameters)
+
+            row_size = _encoded_size(template)
+            for chunk in self.batcher.batches(
+                    parameter_rows,
+                    size=lambda parameters: (row_size +
+                                             _parameters_size(parameters)),
+                    overhead=_encoded_size(header),
+                    limit=max(1, MAX_PARAMETERS // width)):
+                statement = self._prepared_statement(shape, template,
+                                                     len(chunk))
+                yield statement, list(chain.from_iterable(chunk))
+
+    def load_statements(self, batch):
+        """ Yield LOAD DATA LOCAL INFILE statements, each paired with None,
+        which together load every record in a RecordBatch. The tab
+        separated file read by each statement is written just before it
+        is yielded and removed when the next statement is requested.
+
+        Dimension keys not already resolved are read into user variables
+        and resolved by a SET clause using the same subquery as the other
+        insert modes, so records are grouped as for `groups`.
+        """
+        for shape, rows in self.groups(batch):
+            handle, path = tempfile.mkstemp(prefix="pylytics_",
+                                            suffix=".tsv")
+            try:
+                with os.fdopen(handle, "wb") as tsv_file:
+                    for row, timestamp in rows:
+                        fields = map(tsv, row)
+                        if self.dimension_keys:
+                            fields.append(tsv(timestamp))
+                        tsv_file.write("\t".join(fields) + "\n")
+                yield self._load_statement(shape, path), None
+            finally:
+                os.remove(path)
+
+    def _load_statement(self, shape, path):
+        """ Return the LOAD DATA statement reading records with the given
+        shape from the file at `path`.
+        """
+        table = self.table
+        targets = []
+        assignments = []
+        unresolved = [position for (position, _), value_type
+                      in zip(self.dimension_keys, shape)
+                      if value_type is not None]
+        for position, column in enumerate(self.columns):
+            if position in unresolved or isinstance(column, ApplicableFrom):
+                targets.append("@value_%s" % position)
+            else:
+                targets.append(escaped(column.name))
+            if isinstance(column, ApplicableFrom):
+                assignments.append(
+                    "%s = COALESCE(@value_%s, CURRENT_TIMESTAMP)" % (
+                        escaped(column.name), position))
+        if self.dimension_keys:
+            targets.append("@timestamp")
+        for (position, dimension), value_type in zip(self.dimension_keys,
+                                                     shape):
+            if value_type is None:
+                continue
+            subquery, count = dimension.__parameterized_subquery__(
+                value_type)
+            variables = ("@value_%s" % position,) * count + ("@timestamp",) * 2
+            assignments.append("%s = (%s)" % (
+                escaped(self.columns[position].name), subquery % variables))
+        for column in table.__columns__:
+            if isinstance(column, CreatedTimestamp):
+                assignments.append("%s = NOW()" % escaped(column.name))
+
+        sql = "LOAD DATA LOCAL INFILE %s %sINTO TABLE %s\n" % (
+            dump(path), "IGNORE " if "IGNORE" in table.INSERT.upper() else "",
+            escaped(table.__tablename__))
+        sql += "CHARACTER SET utf8\n"
+        sql += "(\n  %s\n)" % ",\n  ".join(targets)
+        if assignments:
+            sql += "\nSET\n  %s" % ",\n  ".join(assignments)
+        return sql
+
+    def join_statement(self, shape, source):
+        """ Return an INSERT ... SELECT statement copying every row from
+        the table named `source`, which has the same columns as this
+        table but holds the natural key values of records with the given
+        shape in place of dimension keys, along with the dimension
+        selector timestamp of each record in `JOIN_TIMESTAMP`.
+
+        Each dimension key is resolved by joining its dimension (see
+        `Dimension.__join__`), so the server can resolve every row in one
+        pass rather than running a subquery per value.
+        """
+        value_types = dict(
+            (position, value_type) for (position, _), value_type
+            in zip(self.dimension_keys, shape))
+        timestamp = "`t`.%s" % escaped(JOIN_TIMESTAMP)
+        values = []
+        joins = []
+        for position, column in enumerate(self.columns):
+            value = "`t`.%s" % escaped(column.name)
+            if position in value_types:
+                dimension = column.dimension
+                alias = "d%s" % position
+                joins.append(dimension.__join__(
+                    alias, value_types[position], value, timestamp))
+                value = "%s.%s" % (escaped(alias),
+                                   escaped(dimension.__primarykey__.name))
+            values.append(value)
+
+        sql = self.statement + "SELECT\n  %s\nFROM %s AS `t`" % (
+            ",\n  ".join(values), escaped(source))
+        for join in joins:
+            sql += "\n" + join
+        return sql
+
+    def groups(self, batch):
+        """ Group the records in a RecordBatch by the SQL needed for their
+        dimension keys, returning a list of (shape, rows) pairs where each
+        row is paired with its dimension selector timestamp.
+
+        A shape holds, for each dimension key, the type of the value to be
+        looked up (which decides the natural keys matched), or None where
+        the key has already been resolved to an id from the key cache; in
+        that case the id replaces the value in the row.
+        """
+        timestamps = self.timestamps(batch)
+        values = [batch[column.name] for column in self.columns]
+        resolved = []
+        for position, dimension in self.dimension_keys:
+            if self.key_resolution == CACHE:
+                ids = dimension.key_cache().resolve(values[position],
+                                                    timestamps)
+                resolved.append((position, ids))
+            else:
+                resolved.append((position, None))
+
+        groups = OrderedDict()
+        for index, (timestamp, row) in enumerate(zip(timestamps,
+                                                     zip(*values))):
+            shape = []
+            for position, ids in resolved:
+                if ids is not None and ids[index] is not None:
+                    row = row[:position] + (ids[index],) + row[position + 1:]
+                    shape.append(None)
+                else:
+                    shape.append(type(row[position]))
+            groups.setdefault(tuple(shape), []).append((row, timestamp))
+        return groups.items()
+
+    def _template(self, shape):
+        """ Return the placeholder SQL for a single row, a list of
+        functions expanding each value into its parameters and the number
+        of parameters per row, for rows with the given shape.
+        """
+        try:
+            return self.__templates[shape]
+        except KeyError:
+            pass
+
+        placeholders = ["%s"] * len(self.columns)
+        expanders = [lambda value, timestamp: (value,)] * len(self.columns)
+        for (position, dimension), value_type in zip(self.dimension_keys,
+                                                     shape):
+            if value_type is None:
+                # Already resolved to an id.
+                continue
+            subquery, count = dimension.__parameterized_subquery__(
+                value_type)
+            placeholders[position] = "(%s)" % subquery
+            expanders[position] = (
+                lambda value, timestamp, count=count:
+                    (value,) * count + (timestamp, timestamp))
+        width = sum(len(expand(None, None)) for expand in expanders)
+
+        template = " (\n  %s\n)" % ",\n  ".join(placeholders)
+        self.__templates[shape] = (template, expanders, width)
+        return template, expanders, width
+
+    def _prepared_statement(self, shape, template, count):
+        """ Return the INSERT statement for `count` rows of the given
+        shape. Recently used statements are cached, so that the very same
+        string is passed to the cursor each time; the MySQL connector only
+        re-prepares a statement when that changes.
+        """
+        key = (shape, count)
+        try:
+            statement = self.__prepared.pop(key)
+        except KeyError:
+            statement = self.statement + "VALUES" + ",".join(
+                [template] * count)
+            if len(self.__prepared) >= PREPARED_CACHE_SIZE:
+                self.__prepared.popitem(last=False)
+        self.__prepared[key] = statement
+        return statement
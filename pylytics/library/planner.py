@@ -0,0 +1,131 @@
+import logging
+from multiprocessing.pool import ThreadPool
+from Queue import Empty, Queue
+
+from exceptions import DimensionUpdateError
+from warehouse import Warehouse
+
+
+__all__ = ['RunPlan']
+log = logging.getLogger("pylytics")
+
+# Seconds to wait for a task to finish before waiting again, so that
+# waiting can be interrupted.
+POLL_INTERVAL = 1.0
+
+
+class RunPlan(object):
+    """ Plans a run of a command, such as `update`, over several facts.
+
+    Facts depend on the dimensions they reference, so the plan is a DAG
+    of dimensions and facts: each dimension referenced is refreshed
+    exactly once (see `Dimension.refresh`), however many facts share it,
+    and each fact runs (without updating its dimensions again) as soon as
+    all of its dimensions have been updated. Up to `jobs` dimensions and
+    facts run at once, each on its own warehouse connection drawn from
+    the pool.
+
+    A fact isn't run if any of its dimensions couldn't be updated.
+
+    """
+
+    def __init__(self, facts, jobs=1):
+        self.facts = list(facts)
+        self.jobs = jobs
+        self.dimensions = []
+        # The facts referencing each dimension.
+        self.dependents = {}
+        for fact in self.facts:
+            for dimension_key in fact.__dimensionkeys__:
+                dimension = dimension_key.dimension
+                if dimension not in self.dependents:
+                    self.dimensions.append(dimension)
+                    self.dependents[dimension] = []
+                if fact not in self.dependents[dimension]:
+                    self.dependents[dimension].append(fact)
+
+    def run(self, command, **kwargs):
+        """ Run the command given for each fact, passing on any keyword
+        arguments, and return a dictionary of the errors raised by name
+        of the dimension or fact.
+        """
+        jobs = self.jobs
+        if jobs > 1 and not Warehouse.pooled:
+            log.warning("Running one fact at a time, as there's no "
+                        "connection pool")
+            jobs = 1
+
+        waiting = {fact: set(dimension_key.dimension
+                             for dimension_key in fact.__dimensionkeys__)
+                   for fact in self.facts}
+        failed = {}
+        errors = {}
+        finished = Queue()
+        pool = ThreadPool(jobs) if jobs > 1 else None
+
+        def start(task):
+            arguments = (task, command, kwargs, jobs > 1)
+            if pool:
+                pool.apply_async(self._run_task, arguments,
+                                 callback=finished.put)
+            else:
+                finished.put(self._run_task(*arguments))
+
+        try:
+            started = 0
+            for task in self.dimensions + [fact for fact in self.facts
+                                           if not waiting[fact]]:
+                start(task)
+                started += 1
+            while started:
+                try:
+                    task, error = finished.get(timeout=POLL_INTERVAL)
+                except Empty:
+                    continue
+                started -= 1
+                if error is not None and not isinstance(error, Exception):
+                    # e.g. KeyboardInterrupt or SystemExit, which should
+                    # stop the run rather than just this task.
+                    raise error
+                if error:
+                    errors[task.__name__] = error
+                for fact in self.dependents.get(task, ()):
+                    waiting[fact].discard(task)
+                    if error:
+                        failed.setdefault(fact, {})[task] = error
+                    if waiting[fact]:
+                        continue
+                    if fact in failed:
+                        log.error("Not running %s, as dimensions couldn't "
+                                  "be updated", command,
+                                  extra={"table": fact.__tablename__})
+                        errors[fact.__name__] = DimensionUpdateError(
+                            failed[fact])
+                    else:
+                        start(fact)
+                        started += 1
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        return errors
+
+    def _run_task(self, task, command, kwargs, local):
+        """ Update a dimension, or run the command for a fact, returning
+        the task along with any error raised. Errors which aren't
+        Exceptions are returned too, so that a task always finishes.
+        """
+        connection = Warehouse.local_connection if local else \
+            Warehouse.shared_connection
+        try:
+            with connection():
+                if task in self.dependents:
+                    task.refresh()
+                else:
+                    getattr(task, command)(dimensions=False, **kwargs)
+        except BaseException as error:
+            log.error("Unable to run %s (%s: %s)", command,
+                      error.__class__.__name__, error,
+                      extra={"table": task.__tablename__})
+            return task, error
+        return task, None
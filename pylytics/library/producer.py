@@ -0,0 +1,177 @@
+import logging
+from Queue import Empty, Queue
+import threading
+import time
+
+from connection import get_pool
+from source import Staging
+from warehouse import Warehouse
+
+
+__all__ = ['StagingProducer']
+log = logging.getLogger("pylytics")
+
+
+class StagingProducer(object):
+    """ Writes staging events in bulk for applications emitting many of
+    them, from any number of threads, e.g.
+
+        producer = StagingProducer(connection_name="warehouse")
+        producer.start()
+        producer.send("booking", {"booking_id": 123, "status": "new"})
+        ...
+        producer.close()
+
+    Events are encoded as they're sent and held in a queue of up to
+    `max_queued` events. Sending blocks while the queue is full, for up
+    to `timeout` seconds (or indefinitely if None) before raising
+    Queue.Full, so producers are held back when the warehouse can't keep
+    up.
+
+    Queued events are written by `flush`, which inserts up to
+    `batch_size` events at a time with multi-row statements (or prepared
+    statements, with `mode` PREPARED). Once `start` has been called, a
+    background thread flushes whenever `batch_size` events are waiting or
+    the oldest has waited for `flush_interval` seconds; otherwise sending
+    flushes once `batch_size` events are waiting, or the queue is full.
+
+    Events are written with a connection drawn from the pool for the
+    database `connection_name`, or from the warehouse's pool, or else
+    with the warehouse connection. As the warehouse connection can't be
+    shared with a background thread, `start` leaves events to be flushed
+    as they're sent when there's no pool. Events which can't be written
+    are logged and counted in `failed`.
+
+    """
+
+    def __init__(self, staging=Staging, batch_size=1000, flush_interval=1.0,
+                 max_queued=10000, timeout=None, mode=None,
+                 connection_name=None):
+        self.staging = staging
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.mode = mode
+        self.pool = get_pool(connection_name) if connection_name else None
+        self.sent = 0
+        self.written = 0
+        self.failed = 0
+        self.__queue = Queue(max_queued)
+        # Without a background thread, sending must flush before the
+        # queue is full, or it would wait for space forever.
+        if max_queued > 0:
+            self.__flush_at = min(batch_size, max_queued)
+        else:
+            self.__flush_at = batch_size
+        self.__write_lock = threading.Lock()
+        self.__count_lock = threading.Lock()
+        self.__stopping = threading.Event()
+        self.__thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def send(self, event_name, value_map):
+        """ Queue an event to be written to staging.
+        """
+        self.__queue.put(self.staging(event_name, value_map),
+                         timeout=self.timeout)
+        with self.__count_lock:
+            self.sent += 1
+        if self.__thread is None and \
+                self.__queue.qsize() >= self.__flush_at:
+            self.flush()
+
+    def start(self):
+        """ Start a background thread to flush events as they're sent,
+        if there's a connection pool to write them with.
+        """
+        if not (self.pool or Warehouse.pooled):
+            log.warning("Flushing staging events as they're sent, as "
+                        "there's no connection pool")
+            return
+        if self.__thread is None:
+            self.__stopping.clear()
+            self.__thread = threading.Thread(target=self._run,
+                                             name="pylytics-producer")
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def close(self):
+        """ Stop the background thread, if started, and write any events
+        still queued.
+        """
+        if self.__thread is not None:
+            self.__stopping.set()
+            self.__thread.join()
+            self.__thread = None
+        self.flush()
+
+    def flush(self):
+        """ Write every event queued so far.
+        """
+        while True:
+            events = self._take(block=False)
+            if not events:
+                break
+            self._write(events)
+
+    def _run(self):
+        while not self.__stopping.is_set():
+            events = self._take(block=True)
+            if events:
+                self._write(events)
+
+    def _take(self, block):
+        """ Take up to `batch_size` events from the queue. When blocking,
+        wait for the first event and then for the rest to arrive until
+        `flush_interval` has passed, checking now and then whether the
+        producer is stopping.
+        """
+        queue = self.__queue
+        events = []
+        deadline = None
+        while len(events) < self.batch_size:
+            try:
+                if not block:
+                    events.append(queue.get_nowait())
+                    continue
+                if deadline is None:
+                    events.append(queue.get(timeout=0.1))
+                    deadline = time.time() + self.flush_interval
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    events.append(queue.get(timeout=remaining))
+            except Empty:
+                if not block or self.__stopping.is_set():
+                    break
+        return events
+
+    def _write(self, events):
+        if self.pool:
+            connection = Warehouse.local_connection(self.pool)
+        elif Warehouse.pooled:
+            connection = Warehouse.local_connection()
+        else:
+            connection = Warehouse.shared_connection()
+        with self.__write_lock:
+            try:
+                with connection:
+                    inserted = self.staging.insert(*events, mode=self.mode)
+            except Exception as error:
+                log.error("Unable to write to staging (%s: %s)",
+                          error.__class__.__name__, error)
+                inserted = False
+            with self.__count_lock:
+                if inserted is False:
+                    log.error("Unable to write %s staging events",
+                              len(events))
+                    self.failed += len(events)
+                else:
+                    self.written += len(events)
@@ -31,3 +31,20 @@ class DimensionSelector(object):
             date = instance[self.date]
             time = instance[self.time]
             return datetime.datetime.combine(date, time)
+
+    def timestamps(self, batch):
+        """ Column-wise version of `timestamp`, returning a list with one
+        timestamp for each record in the batch.
+
+        Args:
+            batch - a RecordBatch of Fact records.
+        """
+        if not self.date and not self.time:
+            return [datetime.datetime.now()] * len(batch)
+        elif self.date and not self.time:
+            midnight = datetime.datetime.min.time()
+            return [datetime.datetime.combine(date, midnight)
+                    for date in batch[self.date]]
+        elif self.date and self.time:
+            return map(datetime.datetime.combine, batch[self.date],
+                       batch[self.time])
@@ -1,17 +1,35 @@
+from collections import OrderedDict, deque
 from contextlib import closing
-import json
+from hashlib import md5
 import logging
+import re
+from string import Formatter
 
+from batch import BATCH_SIZE, RecordBatch
+from codec import JSONCodec
 from column import *
 from connection import NamedConnection
+from keycache import _normalised
+from memo import MISSING, Memo
+from spool import Spool
 from table import Table
-from utils import dump
+from utils import dump, escaped
 from warehouse import Warehouse
+from watermark import EPOCH, Watermark
 
 
-__all__ = ['Source', 'DatabaseSource', 'Staging']
+__all__ = ['Source', 'DatabaseSource', 'Staging', 'expansion']
 log = logging.getLogger("pylytics")
 
+# The most staging rows deleted by one statement.
+DELETE_CHUNK_SIZE = 10000
+
+# The number of records expanded together.
+EXPANSION_CHUNK_SIZE = 1000
+
+# The number of results of each expansion remembered during a selection.
+EXPANSION_MEMO_SIZE = 10000
+
 
 def hydrated(cls, data):
     """ Inflate the data provided into an instance of a table class
@@ -28,21 +46,67 @@ def hydrated(cls, data):
     return inst
 
 
+def expansion(*fields):
+    """ Decorator declaring the fields of a record used by a callable
+    expansion, so that its results can be memoized: records with the same
+    values for those fields are given the same values as the last one
+    expanded, without calling it again, e.g.
+
+        @expansion("country_code")
+        def add_country_name(data):
+            data["country_name"] = COUNTRIES[data["country_code"]]
+
+    Only values set by the expansion are replayed for later records.
+    """
+    def decorator(function):
+        function.expansion_fields = fields
+        return function
+    return decorator
+
+
+def _expand_with(function, records, memo, failed):
+    """ Apply a callable expansion to a list of records, returning those
+    expanded (see `Source._apply_expansions`).
+    """
+    fields = getattr(function, "expansion_fields", None)
+    expanded = []
+    for record in records:
+        try:
+            if fields is None:
+                function(record)
+            else:
+                key = tuple(_normalised(record.get(field)) for field in fields)
+                changes = memo.get(key)
+                if changes is MISSING:
+                    before = dict(record)
+                    function(record)
+                    changes = {name: value for name, value in record.items()
+                               if name not in before or before[name] != value}
+                    memo.put(key, changes)
+                else:
+                    record.update(changes)
+        except Exception as error:
+            if failed is None:
+                raise
+            failed(record, error)
+        else:
+            expanded.append(record)
+    return expanded
+
+
 class Source(object):
     """ Base class for data sources used by `fetch`.
     """
 
+    # Whether the source is told as each chunk of records selected by
+    # `Table.update` is inserted, within the same transaction (see
+    # `acknowledge`).
+    acknowledges = False
+
     @classmethod
     def define(cls, **attributes):
         return type(cls.__name__, (cls,), attributes)
 
-    @classmethod
-    def select(cls, for_class, since=None):
-        """ Select data from this data source and yield each record as an
-        instance of the fact class provided.
-        """
-        raise NotImplementedError("No select method defined for this source")
-
     @classmethod
     def finish(cls, for_class):
         """ Mark a selection as finished, performing any necessary clean-up
@@ -51,29 +115,107 @@ class Source(object):
         """
         pass
 
+    @classmethod
+    def acknowledge(cls, for_class, inserted=True):
+        """ Called by `Table.update` for sources which acknowledge, within
+        the transaction inserting them, once the records selected so far
+        have been inserted (or, if `inserted` is False, couldn't be).
+        Anything done here is committed or rolled back along with them.
+        By default, this method takes no action but can be overridden by
+        subclasses.
+        """
+        pass
+
+    @classmethod
+    def loaded(cls, for_class):
+        """ Called once everything selected by `Table.update` has been
+        inserted successfully, e.g. to record how far the source has been
+        loaded. By default, this method takes no action but can be
+        overridden by subclasses.
+        """
+        pass
+
+    @classmethod
+    def records(cls, for_class, since=None):
+        """ Select data from this data source and yield each record as a
+        dictionary mapping column names of the class provided to values.
+        """
+        return cls._expanded(dict(record)
+                             for record in cls.execute(since=since))
+
     @classmethod
     def select(cls, for_class, since=None):
-        for record in cls.execute(since=since):
-            dict_record = dict(record)
-            cls._apply_expansions(dict_record)
-            yield hydrated(for_class, dict_record.items())
+        """ Select data from this data source and yield each record as an
+        instance of the fact class provided.
+        """
+        for record in cls.records(for_class, since=since):
+            yield hydrated(for_class, record)
 
     @classmethod
-    def _apply_expansions(cls, data):
-        try:
-            expansions = getattr(cls, "expansions")
-        except AttributeError:
-            pass
+    def select_batches(cls, for_class, since=None, batch_size=BATCH_SIZE):
+        """ Select data from this data source and yield it in RecordBatches
+        for the class provided, without hydrating an instance per record.
+        Sources which override `select` have their instances batched
+        instead, so that they're still used by `Table.update`.
+        """
+        if cls.select.__func__ is not Source.select.__func__:
+            records = cls.select(for_class, since=since)
         else:
-            for exp in expansions:
-                if isinstance(exp, type) and issubclass(exp, DatabaseSource):
-                    for record in exp.execute(**data):
-                        data.update(record)
-                elif hasattr(exp, "__call__"):
-                    exp(data)
-                else:
-                    log.debug("Unexpected expansion type: %s",
-                              exp.__class__.__name__)
+            records = cls.records(for_class, since=since)
+        return RecordBatch.chunked(for_class, records, batch_size)
+
+    @classmethod
+    def _expanded(cls, records, failed=None):
+        """ Apply the expansions of this source to each record, yielding
+        those expanded.
+
+        Records are expanded in chunks of EXPANSION_CHUNK_SIZE, so that a
+        DatabaseSource expansion with a `batch_key` selects the rows for a
+        whole chunk with one query. The results of each expansion are
+        memoized for the rest of the selection (see `expansion` and
+        `DatabaseSource.expansion_memo_size`).
+
+        Records which can't be expanded are given to `failed` along with
+        the error, and left out. Without `failed`, the error is raised.
+        """
+        expansions = getattr(cls, "expansions", [])
+        if not expansions:
+            for record in records:
+                yield record
+            return
+
+        memos = [Memo(getattr(exp, "expansion_memo_size",
+                              EXPANSION_MEMO_SIZE)) for exp in expansions]
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= EXPANSION_CHUNK_SIZE:
+                for expanded in cls._apply_expansions(chunk, memos, failed):
+                    yield expanded
+                chunk = []
+        for expanded in cls._apply_expansions(chunk, memos, failed):
+            yield expanded
+
+    @classmethod
+    def _apply_expansions(cls, records, memos, failed=None):
+        for exp, memo in zip(getattr(cls, "expansions"), memos):
+            if isinstance(exp, type) and issubclass(exp, DatabaseSource):
+                records = exp.expand(records, memo, failed)
+            elif hasattr(exp, "__call__"):
+                records = _expand_with(exp, records, memo, failed)
+            else:
+                log.debug("Unexpected expansion type: %s",
+                          exp.__class__.__name__)
+        return records
+
+
+def _dumped(value):
+    """ Convert a query parameter to SQL, giving a list of values as a
+    parenthesised list of literals, e.g. for use with IN.
+    """
+    if isinstance(value, (list, tuple)):
+        return "(%s)" % ",".join(map(dump, value))
+    return dump(value)
 
 
 class DatabaseSource(Source):
@@ -83,25 +225,211 @@ class DatabaseSource(Source):
 
     (See unit tests for example of usage)
 
+    For incremental loads, set `watermark` to the name of a column in the
+    query results which only ever increases, such as a modification time
+    or an auto-incrementing id, and filter the query with `{since}`, e.g.
+
+        query = "SELECT * FROM sales WHERE modified > {since}"
+        watermark = "modified"
+
+    The greatest value loaded is kept as a Watermark in the warehouse and
+    given as `{since}` next time. Until a table has been loaded from the
+    source, `since_default` is given instead; this is EPOCH unless
+    overridden, e.g. with 0 for an id. Sources are told apart by
+    `watermark_name`, which defaults to a hash of the query.
+
+    Rows are read from the database as soon as the query has run, so that
+    the connection is released quickly. Results of up to `spool_threshold`
+    rows are held in memory; larger ones are spooled to a temporary file
+    and read back from there, so memory use doesn't grow with the size of
+    the results. Set `spool_threshold` to None to always hold them in
+    memory.
+
+    As an expansion, a source selects rows for each record using the
+    record's values in its query, and adds their values to the record.
+    Rows are looked up once for each distinct set of values, and the most
+    recent `expansion_memo_size` results are remembered for the rest of
+    the selection. Set `batch_key` to the name of one of the fields in
+    the query to select rows for many records at once: the field is then
+    given as a list of values, and the query must select it too so that
+    rows can be matched up with records, e.g.
+
+        query = "SELECT id AS booking_id, status AS booking_status " \
+                "FROM booking WHERE id IN {booking_id}"
+        batch_key = "booking_id"
+
     """
 
+    batch_key = None
+    expansion_memo_size = EXPANSION_MEMO_SIZE
+    spool_threshold = 100000
+    watermark = None
+    watermark_name = None
+    since_default = EPOCH
+
+    # Marks reached by selections, by (source, table), saved once their
+    # records are loaded.
+    __pending = {}
+
+    @classmethod
+    def _watermark_name(cls):
+        return cls.watermark_name or "%s:%s" % (
+            cls.database, md5(cls.query.encode("utf-8")).hexdigest())
+
+    @classmethod
+    def records(cls, for_class, since=None):
+        """ Select data from this data source and yield each record as a
+        dictionary, as for `Source.records`. With a watermark set, `since`
+        defaults to the watermark for the class provided and the greatest
+        value selected is noted, to be saved by `loaded`.
+        """
+        if not cls.watermark:
+            return super(DatabaseSource, cls).records(for_class, since=since)
+        # Forget any mark from a selection which wasn't loaded.
+        cls.__pending.pop((cls, for_class), None)
+        if since is None:
+            since = Watermark.get(for_class.__tablename__,
+                                  cls._watermark_name())
+            if since is None:
+                since = cls.since_default
+        log.debug("Selecting records since %s", since,
+                  extra={"table": for_class.__tablename__})
+        return cls._marked(for_class, super(DatabaseSource, cls).records(
+            for_class, since=since))
+
+    @classmethod
+    def _marked(cls, for_class, records):
+        mark = None
+        for record in records:
+            value = record.get(cls.watermark)
+            if value is not None and (mark is None or value > mark):
+                mark = value
+            yield record
+        if mark is not None:
+            cls.__pending[cls, for_class] = mark
+
+    @classmethod
+    def loaded(cls, for_class):
+        mark = cls.__pending.pop((cls, for_class), None)
+        if mark is not None:
+            Watermark.set(for_class.__tablename__, cls._watermark_name(),
+                          mark)
+
+    @classmethod
+    def _fields(cls):
+        """ Return the names of the record fields used by the query.
+        """
+        return sorted(set(re.split(r"[.\[]", name)[0]
+                          for _, name, _, _ in Formatter().parse(cls.query)
+                          if name))
+
+    @classmethod
+    def expand(cls, records, memo=None, failed=None):
+        """ Expand a list of records with the rows selected for them,
+        returning those expanded (see `Source._apply_expansions`).
+        """
+        if memo is None:
+            memo = Memo(0)
+        fields = cls._fields()
+        keys = []
+        results = {}
+        for record in records:
+            try:
+                key = tuple(_normalised(record[field]) for field in fields)
+            except KeyError as error:
+                key = error
+            else:
+                if key not in results:
+                    results[key] = memo.get(key)
+            keys.append(key)
+
+        missing = [key for key, rows in results.items() if rows is MISSING]
+        if cls.batch_key in fields:
+            results.update(cls._select_batched(fields, missing))
+        else:
+            for key in missing:
+                try:
+                    results[key] = list(cls.execute(**dict(zip(fields, key))))
+                except Exception as error:
+                    results[key] = error
+        for key in missing:
+            if not isinstance(results[key], Exception):
+                memo.put(key, results[key])
+
+        expanded = []
+        for record, key in zip(records, keys):
+            rows = key if isinstance(key, Exception) else results[key]
+            if isinstance(rows, Exception):
+                if failed is None:
+                    raise rows
+                failed(record, rows)
+                continue
+            for row in rows:
+                record.update(row)
+            expanded.append(record)
+        return expanded
+
+    @classmethod
+    def _select_batched(cls, fields, keys):
+        """ Select the rows for records with each of the keys given,
+        using one query for each chunk of values of the batch key, and
+        return them in a dictionary by key. The batch key is left out of
+        the rows, so that records keep their own values.
+        """
+        position = fields.index(cls.batch_key)
+        groups = OrderedDict()
+        for key in keys:
+            others = key[:position] + key[position + 1:]
+            groups.setdefault(others, []).append(key[position])
+
+        results = {}
+        for others, values in groups.items():
+            params = dict(zip(fields[:position] + fields[position + 1:],
+                              others))
+            for start in xrange(0, len(values), EXPANSION_CHUNK_SIZE):
+                chunk = values[start:start + EXPANSION_CHUNK_SIZE]
+                # Match rows up by text, as records may hold values of
+                # a different type, e.g. numbers given as strings.
+                by_text = {}
+                for value in chunk:
+                    key = others[:position] + (value,) + others[position:]
+                    by_text[unicode(value)] = key
+                    results[key] = []
+                params[cls.batch_key] = chunk
+                try:
+                    for row in cls.execute(**params):
+                        value = row.pop(cls.batch_key)
+                        key = by_text.get(unicode(_normalised(value)))
+                        if key is not None:
+                            results[key].append(row)
+                except Exception as error:
+                    for key in by_text.values():
+                        results[key] = error
+        return results
+
     @classmethod
     def execute(cls, **params):
         database = getattr(cls, "database")
         query = getattr(cls, "query").format(
-            **{key: dump(value) for key, value in params.items()})
+            **{key: _dumped(value) for key, value in params.items()})
 
         with NamedConnection(database) as connection:
-            with closing(connection.cursor(dictionary=True)) as cursor:
+            with closing(connection.cursor()) as cursor:
                 cursor.execute(query)
-                rows = []
-                for row in cursor:
-                    # Dump the rows immediately into memory, otherwise
-                    # the connection might timeout.
-                    rows.append(row)
-
-        for row in rows:
-            yield row
+                # Read the rows immediately, otherwise the connection
+                # might timeout.
+                spool = Spool(cursor.column_names or (),
+                              threshold=cls.spool_threshold)
+                try:
+                    for row in cursor:
+                        spool.append(row)
+                except:
+                    spool.close()
+                    raise
+
+        with closing(spool):
+            for row in spool:
+                yield row
 
 
 class CallableSource(Source):
@@ -123,13 +451,69 @@ class CallableSource(Source):
             yield list(row)
 
 
+class _Consumption(object):
+    """ The staging rows read for a class, as runs of consecutive ids, and
+    the id of the last row consumed; rows up to there can be acknowledged.
+    """
+
+    def __init__(self):
+        self.runs = deque()
+        self.position = None
+
+    def read(self, id_):
+        if self.runs and self.runs[-1][1] == id_ - 1:
+            self.runs[-1][1] = id_
+        else:
+            self.runs.append([id_, id_])
+
+    def take(self):
+        """ Return the runs of ids up to the last consumed, as (first,
+        last) tuples, forgetting them.
+        """
+        taken = []
+        position = self.position
+        while position is not None and self.runs and \
+                self.runs[0][0] <= position:
+            first, last = self.runs[0]
+            if last <= position:
+                self.runs.popleft()
+            else:
+                self.runs[0][0] = position + 1
+            taken.append((first, min(last, position)))
+        return taken
+
+
 class Staging(Source, Table):
     """ Staging is both a table and a data source.
+
+    Rows are read a page of `page_size` rows at a time, in order of id,
+    so memory use doesn't grow with the number of rows waiting. As each
+    chunk of records is inserted by `Table.update`, the rows they came
+    from (and any which couldn't be hydrated) are deleted by ranges of
+    ids in the same transaction, so rows are only removed from staging
+    once their records are in the warehouse. Rows whose records couldn't
+    be inserted are left in staging for the next update.
+
+    Value maps are encoded by `__codec__`, as JSON text by default. Use
+    `with_codec` for staging with another codec, e.g.
+
+        BinaryStaging = Staging.with_codec(MarshalCodec())
+
+    and use that class both to write events and to select them. Building
+    such a class changes the `value_map` column of an existing staging
+    table into a BLOB (see `_upgrade_value_map`), which any codec can
+    read from.
+
     """
     __tablename__ = "staging"
+    __codec__ = JSONCodec()
+
+    acknowledges = True
+    page_size = 10000
 
-    # Keep details of records to be deleted.
-    __recycling = set()
+    # The rows read, by the class they were selected for, as several may
+    # be updated at once.
+    __consumption = {}
 
     id = PrimaryKey()
     event_name = Column("event_name", unicode, size=80)
@@ -137,55 +521,162 @@ class Staging(Source, Table):
     created = CreatedTimestamp()
 
     @classmethod
-    def select(cls, for_class, since=None):
+    def records(cls, for_class, since=None):
         extra = {"table": for_class.__tablename__}
 
         log.debug("Fetching rows from staging table", extra=extra)
 
-        events = list(getattr(cls, "events"))
-        sql = """\
-        SELECT id, event_name, value_map FROM staging
-        WHERE event_name IN (%s)
-        ORDER BY created, id
-        """ % ",".join(map(dump, events))
-        log.debug(sql)
-
-        connection = Warehouse.get()
-        with closing(connection.cursor(raw=False)) as cursor:
-            cursor.execute(sql)
-            results = cursor.fetchall()
+        events = ",".join(map(dump, getattr(cls, "events")))
+        consumption = cls.__consumption[for_class] = _Consumption()
+
+        def failed(data, error):
+            log.error("Unable to hydrate %s record (%s: %s) -- %s",
+                      for_class.__name__, error.__class__.__name__, error,
+                      data, extra=extra)
+
+        def decoded():
+            last_id = 0
+            while True:
+                sql = """\
+                SELECT id, event_name, value_map FROM staging
+                WHERE event_name IN (%s) AND id > %s
+                ORDER BY id
+                LIMIT %s
+                """ % (events, last_id, cls.page_size)
+                log.debug(sql)
+
+                connection = Warehouse.get()
+                with closing(connection.cursor(raw=False)) as cursor:
+                    cursor.execute(sql)
+                    page = cursor.fetchall()
+
+                for id_, event_name, value_map in page:
+                    # We'll recycle the row regardless of whether or
+                    # not we've been able to hydrate and yield it. If
+                    # broken, it gets logged anyway.
+                    consumption.read(id_)
+                    try:
+                        data = {"__event__": event_name}
+                        data.update(cls.__codec__.decode(value_map))
+                    except Exception as error:
+                        failed(value_map, error)
+                    else:
+                        data["__staging_id__"] = id_
+                        yield data
+                if len(page) < cls.page_size:
+                    break
+                last_id = page[-1][0]
+
+        for data in cls._expanded(decoded(), failed):
+            consumption.position = data.pop("__staging_id__")
+            yield data
+        # Every row read has now been consumed, including any at the end
+        # which couldn't be hydrated.
+        if consumption.runs:
+            consumption.position = consumption.runs[-1][1]
 
-        for id_, event_name, value_map in results:
-            try:
-                data = {"__event__": event_name}
-                data.update(json.loads(unicode(value_map)))
-                cls._apply_expansions(data)
-                inst = hydrated(for_class, data)
-            except Exception as error:
-                log.error("Unable to hydrate %s record (%s: %s) -- %s",
-                          for_class.__name__, error.__class__.__name__, error,
-                          value_map, extra=extra)
-            else:
-                yield inst
-            finally:
-                # We'll recycle the row regardless of whether or
-                # not we've been able to hydrate and yield it. If
-                # broken, it gets logged anyway.
-                cls.__recycling.add(id_)
+    @classmethod
+    def acknowledge(cls, for_class, inserted=True):
+        consumption = cls.__consumption.get(for_class)
+        if consumption is None:
+            return
+        runs = consumption.take()
+        if not inserted:
+            log.warning("Leaving %s rows in staging to be loaded again",
+                        sum(last - first + 1 for first, last in runs),
+                        extra={"table": for_class.__tablename__})
+        elif runs:
+            cls._delete(runs)
 
     @classmethod
     def finish(cls, for_class):
-        if cls.__recycling:
-            sql = "DELETE FROM staging WHERE id in (%s)" % (
-                ",".join(map(str, cls.__recycling)))
+        consumption = cls.__consumption.pop(for_class, None)
+        if consumption is None:
+            return
+        runs = consumption.take()
+        if runs:
             connection = Warehouse.get()
             try:
-                with closing(connection.cursor()) as cursor:
-                    cursor.execute(sql)
+                cls._delete(runs)
             except:
+                connection.rollback()
                 log.error('Unable to clear staging.')
-            cls.__recycling.clear()
+            else:
+                connection.commit()
+
+    @classmethod
+    def _delete(cls, runs):
+        """ Delete the rows with ids in each of the (first, last) runs
+        given, in statements deleting up to DELETE_CHUNK_SIZE rows each.
+        The deletes aren't committed here.
+        """
+        statements = []
+        conditions = []
+        count = 0
+        for first, last in runs:
+            while first <= last:
+                end = min(last, first + DELETE_CHUNK_SIZE - count - 1)
+                if first == end:
+                    conditions.append("id = %s" % first)
+                else:
+                    conditions.append("id BETWEEN %s AND %s" % (first, end))
+                count += end - first + 1
+                first = end + 1
+                if count >= DELETE_CHUNK_SIZE:
+                    statements.append(conditions)
+                    conditions = []
+                    count = 0
+        if conditions:
+            statements.append(conditions)
+
+        connection = Warehouse.get()
+        with closing(connection.cursor()) as cursor:
+            for conditions in statements:
+                cursor.execute("DELETE FROM staging WHERE %s" %
+                               " OR ".join(conditions))
+
+    @classmethod
+    def with_codec(cls, codec, **attributes):
+        """ Return a Staging class encoding value maps with the codec
+        given, in a column of the type the codec needs.
+        """
+        return cls.define(__codec__=codec, value_map=Column(
+            "value_map", codec.column_type, size=codec.column_size),
+            **attributes)
+
+    @classmethod
+    def build(cls):
+        super(Staging, cls).build()
+        cls._upgrade_value_map()
+
+    @classmethod
+    def _upgrade_value_map(cls):
+        """ Change the `value_map` column of a staging table created for
+        text value maps into a BLOB, if this class's codec needs one. The
+        value maps already staged are kept as UTF-8 bytes, which binary
+        codecs still decode as JSON. A BLOB column is left alone for a
+        text codec, as text codecs read bytes too.
+        """
+        column = cls.value_map
+        if column.type is not bytearray:
+            return
+        table_name = escaped(cls.__tablename__)
+        connection = Warehouse.get()
+        with closing(connection.cursor()) as cursor:
+            cursor.execute("SHOW COLUMNS FROM %s LIKE %s" % (
+                table_name, dump(column.name)))
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            column_type = str(rows[0][1]).lower()
+            if column_type.endswith("blob"):
+                return
+            log.info("Changing %s column from %s to %s", column.name,
+                     column_type, column.type_expression,
+                     extra={"table": cls.__tablename__})
+            cursor.execute("ALTER TABLE %s MODIFY COLUMN %s" % (
+                table_name, column.expression))
 
     def __init__(self, event_name, value_map):
         self.event_name = event_name
-        self.value_map = json.dumps(value_map, separators=",:")
+        self.value_map = self.__codec__.encode(value_map)
@@ -0,0 +1,87 @@
+import cPickle as pickle
+from contextlib import closing
+import logging
+import mmap
+import os
+import tempfile
+
+
+__all__ = ['Spool']
+log = logging.getLogger("pylytics")
+
+# The number of rows pickled together in a spool file.
+BLOCK_SIZE = 1000
+
+
+class Spool(object):
+    """ Holds the rows read from a cursor so that the connection can be
+    released before they're processed.
+
+    Rows are kept in memory up to `threshold` rows, beyond which they're
+    spilled to a temporary file as blocks of pickled tuples and read back
+    through a memory map, so memory use stays flat however many rows are
+    read. With no threshold, every row is kept in memory.
+
+    Iterating over a spool yields each row as a dictionary mapping the
+    column names given to values.
+
+    """
+
+    def __init__(self, columns, threshold=None):
+        self.columns = tuple(columns)
+        self.threshold = threshold
+        self.__rows = []
+        self.__file = None
+        self.__path = None
+        self.__length = 0
+
+    def __len__(self):
+        return self.__length
+
+    def append(self, row):
+        """ Add a row, given as a sequence of values in column order.
+        """
+        self.__rows.append(tuple(row))
+        self.__length += 1
+        if self.__file:
+            if len(self.__rows) >= BLOCK_SIZE:
+                self._spill()
+        elif self.threshold is not None and self.__length > self.threshold:
+            handle, self.__path = tempfile.mkstemp(prefix="pylytics_",
+                                                   suffix=".spool")
+            self.__file = os.fdopen(handle, "w+b")
+            log.debug("Spooling rows to %s", self.__path)
+            self._spill()
+
+    def _spill(self):
+        for start in xrange(0, len(self.__rows), BLOCK_SIZE):
+            pickle.dump(self.__rows[start:start + BLOCK_SIZE], self.__file,
+                        pickle.HIGHEST_PROTOCOL)
+        self.__rows = []
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def __iter__(self):
+        columns = self.columns
+        if self.__file:
+            self._spill()
+            self.__file.flush()
+            with closing(mmap.mmap(self.__file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)) as spooled:
+                while spooled.tell() < spooled.size():
+                    for row in pickle.load(spooled):
+                        yield dict(zip(columns, row))
+        else:
+            for row in self.__rows:
+                yield dict(zip(columns, row))
+
+    def close(self):
+        """ Discard the rows, removing any spool file.
+        """
+        self.__rows = []
+        if self.__file:
+            self.__file.close()
+            os.remove(self.__path)
+            self.__file = None
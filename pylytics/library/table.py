@@ -3,10 +3,12 @@ from datetime import date
 from distutils.version import StrictVersion
 import logging
 
+from batch import BATCH_SIZE, RecordBatch
 from column import *
 from exceptions import classify_error
+from plan import LITERAL, PREPARED, InsertPlan
 from settings import settings
-from utils import _camel_to_snake, dump, escaped
+from utils import _camel_to_snake, escaped
 from warehouse import Warehouse
 
 
@@ -64,10 +66,20 @@ class TableMetaclass(type):
     def __new__(mcs, name, bases, attributes):
         attributes.setdefault("__tablename__", _camel_to_snake(name))
 
+        # Records keep their values in the `_values` slot defined on
+        # Table, so subclasses don't need an instance dictionary. A
+        # subclass can opt back in with `__slots__ = ("__dict__",)`.
+        attributes.setdefault("__slots__", ())
+
+        # Columns are inherited from every class in the hierarchy, with
+        # those of subclasses replacing any of the same name.
+        inherited = {}
+        for base in reversed(bases):
+            for ancestor in reversed(base.__mro__):
+                inherited.update(ancestor.__dict__)
+        inherited.update(attributes)
         column_set = _ColumnSet()
-        for base in bases:
-            column_set.update(base.__dict__)
-        column_set.update(attributes)
+        column_set.update(inherited)
 
         attributes["__columns__"] = column_set.columns
         attributes["__primarykey__"] = column_set.primary_key
@@ -85,6 +97,31 @@ class TableMetaclass(type):
         if "__naturalkeys__" in dir(cls):
             cls.__naturalkeys__ = column_set.natural_keys
 
+        # Index columns by name (and attributes by column) once, so that
+        # record access doesn't have to search the class for every value.
+        column_attributes = {}
+        attribute_columns = {}
+        for key in dir(cls):
+            if not key.startswith("_"):
+                column = getattr(cls, key, None)
+                if isinstance(column, Column):
+                    column_attributes.setdefault(column.name, key)
+                    attribute_columns[key] = column
+        cls.__columnattrs__ = column_attributes
+        cls.__attrcolumns__ = attribute_columns
+
+        # Give each column a position within the record value list. An
+        # empty record holds each column itself, which is what reading an
+        # unset attribute used to return.
+        column_index = {}
+        empty_record = []
+        for key, column in sorted(attribute_columns.items()):
+            if column not in column_index:
+                column_index[column] = len(empty_record)
+                empty_record.append(column)
+        cls.__columnindex__ = column_index
+        cls.__emptyrecord__ = empty_record
+
         return cls
 
 
@@ -101,6 +138,12 @@ class Table(object):
     __columns__ = NotImplemented
     __primarykey__ = NotImplemented
     __tablename__ = NotImplemented
+    __columnattrs__ = NotImplemented
+    __attrcolumns__ = NotImplemented
+    __columnindex__ = NotImplemented
+    __emptyrecord__ = NotImplemented
+
+    __slots__ = ("_values",)
 
     # These attributes aren't touched by the metaclass.
     __source__ = None
@@ -110,8 +153,19 @@ class Table(object):
         "COLLATE": "utf8_bin",
     }
 
+    # Secondary indexes; a list of Index instances.
+    __indexes__ = ()
+
     INSERT = "INSERT"
 
+    # How values are sent when inserting records; either LITERAL (as SQL
+    # literals), PREPARED (as parameters of prepared statements) or LOAD
+    # (from a file using LOAD DATA LOCAL INFILE).
+    __insert_mode__ = LITERAL
+
+    # The number of records fetched and inserted at a time by `update`.
+    __chunk_size__ = 10000
+
     @classmethod
     def create_trigger(cls):
         """ There's a constraint in earlier versions of MySQL where only one
@@ -158,20 +212,66 @@ class Table(object):
         except AttributeError:
             pass
         cls.create_table(if_not_exists=True)
+        cls.create_indexes()
         cls.create_trigger()
 
     @classmethod
-    def create_table(cls, if_not_exists=False):
-        """ Create this table in the current data warehouse.
+    def indexes(cls):
+        """ Return the secondary indexes this table should have. Override
+        this method to add indexes every subclass needs.
         """
+        return list(cls.__indexes__)
+
+    @classmethod
+    def definitions(cls):
+        """ Return the column, key and index definitions used to create
+        this table.
+        """
+        definitions = [col.expression for col in cls.__columns__]
+        definitions.extend(index.expression for index in cls.indexes())
+        return definitions
+
+    @classmethod
+    def create_indexes(cls):
+        """ Add any indexes declared for this table which the table in the
+        current data warehouse is missing, e.g. if they were declared after
+        the table was created.
+        """
+        connection = Warehouse.get()
+        with closing(connection.cursor()) as cursor:
+            try:
+                cursor.execute("SHOW INDEX FROM %s" % escaped(
+                    cls.__tablename__))
+                existing = set(row[2] for row in cursor.fetchall())
+                missing = [index for index in cls.indexes()
+                           if index.name not in existing]
+                if missing:
+                    log.info("Adding indexes %s", ", ".join(
+                        index.name for index in missing),
+                        extra={"table": cls.__tablename__})
+                    cursor.execute("ALTER TABLE %s %s" % (
+                        escaped(cls.__tablename__),
+                        ", ".join("ADD " + index.expression
+                                  for index in missing)))
+            except Exception as exception:
+                classify_error(exception)
+                raise exception
+
+    @classmethod
+    def create_table(cls, if_not_exists=False, temporary=False):
+        """ Create this table in the current data warehouse. A temporary
+        table only exists for the current connection.
+        """
+        verb = "CREATE TEMPORARY TABLE" if temporary else "CREATE TABLE"
         if if_not_exists:
-            verb = "CREATE TABLE IF NOT EXISTS"
-        else:
-            verb = "CREATE TABLE"
-        columns = ",\n  ".join(col.expression for col in cls.__columns__)
-        sql = "%s %s (\n  %s\n)" % (verb, cls.__tablename__, columns)
+            verb += " IF NOT EXISTS"
+        sql = "%s %s (\n  %s\n)" % (verb, cls.__tablename__,
+                                    ",\n  ".join(cls.definitions()))
         for key, value in cls.__tableargs__.items():
             sql += " %s=%s" % (key, value)
+        partitioning = getattr(cls, "__partitioning__", None)
+        if partitioning and not temporary:
+            sql += "\n" + partitioning.expression(cls)
 
         connection = Warehouse.get()
         with closing(connection.cursor()) as cursor:
@@ -182,13 +282,12 @@ class Table(object):
                 raise exception
 
     @classmethod
-    def drop_table(cls, if_exists=False):
+    def drop_table(cls, if_exists=False, temporary=False):
         """ Drop this table from the current data warehouse.
         """
+        verb = "DROP TEMPORARY TABLE" if temporary else "DROP TABLE"
         if if_exists:
-            verb = "DROP TABLE IF EXISTS"
-        else:
-            verb = "DROP TABLE"
+            verb += " IF EXISTS"
         sql = "%s %s" % (verb, cls.__tablename__)
 
         connection = Warehouse.get()
@@ -206,6 +305,23 @@ class Table(object):
         """
         return cls.__tablename__ in Warehouse.table_names
 
+    @classmethod
+    def _drain(cls, source, selection):
+        """ Yield everything from a source selection, logging any error
+        raised and only marking the source as finished on success.
+        """
+        try:
+            for item in selection:
+                yield item
+        except Exception as error:
+            log.error("Error raised while fetching data: (%s: %s)",
+                      error.__class__.__name__, error,
+                      extra={"table": cls.__tablename__})
+            raise
+        else:
+            # Only mark as finished if we've not had errors.
+            source.finish(cls)
+
     @classmethod
     def fetch(cls, since=None, historical=False):
         """ Fetch data from the source defined for this table and
@@ -213,76 +329,152 @@ class Table(object):
         """
         source = cls.__historical_source__ if historical else cls.__source__
         if source:
-            try:
-                for inst in source.select(cls, since=since):
-                    yield inst
-            except Exception as error:
-                log.error("Error raised while fetching data: (%s: %s)",
-                          error.__class__.__name__, error,
-                          extra={"table": cls.__tablename__})
-                raise
-            else:
-                # Only mark as finished if we've not had errors.
-                source.finish(cls)
+            for inst in cls._drain(source, source.select(cls, since=since)):
+                yield inst
         else:
             raise NotImplementedError("No data source defined")
 
     @classmethod
-    def insert(cls, *instances):
+    def fetch_batches(cls, since=None, historical=False,
+                      batch_size=BATCH_SIZE):
+        """ Fetch data from the source defined for this table and yield
+        it as RecordBatches of up to `batch_size` records.
+        """
+        source = cls.__historical_source__ if historical else cls.__source__
+        if source:
+            batches = cls._drain(source, source.select_batches(
+                cls, since=since, batch_size=batch_size))
+        else:
+            # Some tables generate their own records by overriding `fetch`.
+            batches = RecordBatch.chunked(
+                cls, cls.fetch(since=since, historical=historical),
+                batch_size)
+        for batch in batches:
+            yield batch
+
+    @classmethod
+    def insert_plan(cls):
+        """ Return the InsertPlan for this table, compiling it the first
+        time it's needed and caching it on the class.
+        """
+        plan = cls.__dict__.get("__insertplan__")
+        if plan is None:
+            plan = InsertPlan(cls)
+            cls.__insertplan__ = plan
+        return plan
+
+    @classmethod
+    def insert(cls, *records, **kwargs):
         """ Insert one or more instances into the table as records.
+        RecordBatches may be passed in place of instances.
+
+        The insert mode can be chosen with the `mode` keyword argument,
+        otherwise the `__insert_mode__` of the table is used.
+
+        Returns False if the records couldn't be inserted.
         """
-        if instances:
-            columns = [column for column in cls.__columns__
-                       if not isinstance(column, AutoColumn)]
-            sql = "%s INTO %s (\n  %s\n)\n" % (
-                cls.INSERT, escaped(cls.__tablename__),
-                ",\n  ".join(escaped(column.name) for column in columns))
-            link = "VALUES"
-            for instance in instances:
-                values = []
-                for column in columns:
-                    value = instance[column.name]
-                    values.append(dump(value))
-                sql += link + (" (\n  %s\n)" % ",\n  ".join(values))
-                link = ","
+        batch = RecordBatch.of(cls, records)
+        if batch:
+            mode = kwargs.get("mode") or cls.__insert_mode__
+            plan = cls.insert_plan()
 
             connection = Warehouse.get()
-            with closing(connection.cursor()) as cursor:
+            with closing(connection.cursor(prepared=(mode == PREPARED))) \
+                    as cursor:
                 try:
-                    cursor.execute(sql)
+                    for statement, parameters in plan.statements(batch,
+                                                                 mode):
+                        with plan.batcher.timing():
+                            cursor.execute(statement, parameters)
                 except:
                     connection.rollback()
+                    return False
                 else:
                     connection.commit()
+        return True
 
     @classmethod
-    def update(cls, since=None, historical=False):
-        """ Fetch some data from source and insert it directly into the table.
+    def update(cls, since=None, historical=False, mode=None):
+        """ Fetch some data from source and insert it directly into the
+        table. Records are fetched and inserted a chunk at a time, so
+        memory use doesn't grow with the size of the source. An insert
+        mode can be given to override the table's `__insert_mode__`.
+        Returns whether every record was inserted.
+
+        For sources which acknowledge records (such as Staging), each
+        chunk is inserted and acknowledged in one transaction.
         """
-        instances = list(cls.fetch(since=since, historical=historical))
-        count = len(instances)
-        log.info("Fetched %s record%s", count, "" if count == 1 else "s",
-                 extra={"table": cls.__tablename__})
-        cls.insert(*instances)
+        extra = {"table": cls.__tablename__}
+        source = cls.__historical_source__ if historical else cls.__source__
+        total = 0
+        inserted = True
+        for batch in cls.fetch_batches(since=since, historical=historical,
+                                       batch_size=cls.__chunk_size__):
+            count = len(batch)
+            total += count
+            log.info("Fetched %s record%s (%s so far)", count,
+                     "" if count == 1 else "s", total, extra=extra)
+            if source and source.acknowledges:
+                with Warehouse.transaction() as transaction:
+                    chunk_inserted = cls.insert(batch, mode=mode) is not False
+                    try:
+                        source.acknowledge(cls, inserted=chunk_inserted)
+                    except Exception as error:
+                        log.error("Unable to acknowledge records (%s: %s)",
+                                  error.__class__.__name__, error,
+                                  extra=extra)
+                        chunk_inserted = False
+                    if not chunk_inserted:
+                        transaction.rollback()
+                # Anything rolled back undoes the whole chunk.
+                chunk_inserted = not transaction.rolled_back
+            else:
+                chunk_inserted = cls.insert(batch, mode=mode) is not False
+            inserted = chunk_inserted and inserted
+        log.info("Fetched %s record%s", total, "" if total == 1 else "s",
+                 extra=extra)
+
+        if source:
+            if inserted:
+                source.loaded(cls)
+            else:
+                log.error("Not every record could be inserted",
+                          extra=extra)
+        return inserted
+
+    def __new__(cls, *args, **kwargs):
+        inst = super(Table, cls).__new__(cls)
+        inst._values = list(cls.__emptyrecord__)
+        return inst
+
+    def __getstate__(self):
+        state = {}
+        for key, column in self.__attrcolumns__.items():
+            value = getattr(self, key)
+            if value is not column:
+                state[key] = value
+        return state
+
+    def __setstate__(self, state):
+        self._values = list(self.__emptyrecord__)
+        for key, value in state.items():
+            setattr(self, key, value)
 
     def __getitem__(self, column_name):
         """ Get a value by table column name.
         """
-        for key in dir(self):
-            if not key.startswith("_"):
-                column = getattr(self.__class__, key, None)
-                if isinstance(column, Column) and column.name == column_name:
-                    value = getattr(self, key)
-                    return None if value is column else value
-        raise KeyError("No such table column '%s'" % column_name)
+        try:
+            key = self.__columnattrs__[column_name]
+        except KeyError:
+            raise KeyError("No such table column '%s'" % column_name)
+        value = getattr(self, key)
+        return None if value is self.__attrcolumns__[key] else value
 
     def __setitem__(self, column_name, value):
         """ Set a value by table column name.
         """
-        for key in dir(self):
-            if not key.startswith("_"):
-                column = getattr(self.__class__, key, None)
-                if isinstance(column, Column) and column.name == column_name:
-                    setattr(self, key, value)
-                    return
-        raise KeyError("No such table column '%s'" % column_name)
+        try:
+            key = self.__columnattrs__[column_name]
+        except KeyError:
+            raise KeyError("No such table column '%s'" % column_name)
+        setattr(self, key, value)
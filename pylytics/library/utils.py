@@ -1,4 +1,6 @@
+from binascii import hexlify
 from datetime import date, datetime, time, timedelta
+from decimal import Decimal
 import re
 import string
 
@@ -43,3 +45,87 @@ def dump(value):
         return "'%s'" % value.decode("utf-8").replace("'", "''")
     else:
         return unicode(value)
+
+
+# Characters which must be escaped in fields read by LOAD DATA INFILE.
+_tsv_escapes = {"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r",
+                "\0": "\\0"}
+_tsv_special = re.compile(r"[\\\t\n\r\0]")
+
+
+def tsv(value):
+    """ Convert the supplied value to a UTF-8 encoded field for a tab
+    separated file loaded with LOAD DATA INFILE (using the default field
+    and line terminators and escape character).
+    """
+    if value is None:
+        return "\\N"
+    elif value is True:
+        return "1"
+    elif value is False:
+        return "0"
+    elif isinstance(value, unicode):
+        text = value.encode("utf-8")
+    elif isinstance(value, bytearray):
+        text = str(value)
+    elif isinstance(value, float):
+        text = repr(value)
+    else:
+        text = str(value)
+    return _tsv_special.sub(lambda match: _tsv_escapes[match.group()], text)
+
+
+def _quoted(value):
+    return "'%s'" % value
+
+
+# SQL literal conversions for values known to be of exactly these types.
+_literals = {
+    bool: lambda value: "1" if value else "0",
+    bytearray: lambda value: "X'%s'" % hexlify(value),
+    date: _quoted,
+    datetime: _quoted,
+    Decimal: unicode,
+    float: unicode,
+    int: unicode,
+    long: unicode,
+    str: lambda value: "'%s'" % value.encode("utf-8").replace("'", "''"),
+    time: _quoted,
+    timedelta: _quoted,
+    unicode: lambda value: "'%s'" % value.replace("'", "''"),
+}
+
+
+def column_dumper(type_):
+    """ Return a function that converts a list of values for a column of
+    the supplied type to SQL literals. The types of the values are checked
+    once for the whole list; if they all match the column type (or are
+    None), each value is converted directly instead of going through
+    `dump` one at a time.
+    """
+    try:
+        literal = _literals[type_]
+    except (KeyError, TypeError):
+        return lambda values: map(dump, values)
+
+    expected = {type_}
+    optional = {type_, type(None)}
+
+    def dump_values(values):
+        types = set(map(type, values))
+        if types == expected:
+            return map(literal, values)
+        elif types == optional:
+            return [literal(value) if value is not None else "NULL"
+                    for value in values]
+        else:
+            return map(dump, values)
+
+    return dump_values
+
+
+def dump_column(type_, values):
+    """ Convert a list of values for a column of the supplied type to
+    SQL literals (see `column_dumper`).
+    """
+    return column_dumper(type_)(values)
@@ -1,5 +1,6 @@
-from contextlib import closing
+from contextlib import closing, contextmanager
 import logging
+import threading
 
 
 log = logging.getLogger("pylytics")
@@ -14,34 +15,131 @@ class classproperty(object):
         return self.func(cls)
 
 
+class Transaction(object):
+    """ A warehouse connection within `Warehouse.transaction`, which
+    defers commits to the end of the transaction and notes rollbacks.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rolled_back = False
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self.rolled_back = True
+        self.connection.rollback()
+
+
 class Warehouse(object):
     """ Global data warehouse pointer singleton. This class avoids
     having to pass a data warehouse connection into every table
     operation at the expense of the ability to easily work with
     multiple data warehouses simultaneously.
+
+    Threads can use connections of their own instead, drawn from a pool
+    of connections to the same data warehouse (see `local_connection`).
+
+    Several table operations can be made into one transaction (see
+    `transaction`).
     """
 
     __connection = None
+    __pool = None
+    __local = threading.local()
     __version = None
+    __max_allowed_packet = None
 
     @classmethod
     def get(cls):
         """ Get the current data warehouse connection, warning if
         none has been defined.
         """
-        if cls.__connection is None:
+        transaction = getattr(cls.__local, "transaction", None)
+        if transaction is not None:
+            return transaction
+        connection = getattr(cls.__local, "connection", None) or \
+            cls.__connection
+        if connection is None:
             log.warning("No data warehouse connection defined")
-        if not cls.__connection.is_connected():
-            cls.__connection.reconnect(attempts=5)
-        return cls.__connection
+        if not connection.is_connected():
+            connection.reconnect(attempts=5)
+        return connection
 
     @classmethod
-    def use(cls, connection):
+    def use(cls, connection, pool=None):
         """ Register a new data warehouse connection for use by all
-        table operations.
+        table operations, optionally along with the ConnectionPool it
+        came from.
         """
         cls.__connection = connection
+        cls.__pool = pool
         cls.__version = None
+        cls.__max_allowed_packet = None
+
+    @classproperty
+    def pooled(cls):
+        """ Whether threads can draw connections of their own.
+        """
+        return cls.__pool is not None
+
+    @classmethod
+    @contextmanager
+    def local_connection(cls, pool=None):
+        """ Use a connection drawn from the pool (or another pool given)
+        for the table operations of the current thread within the block,
+        returning it afterwards.
+        """
+        pool = pool or cls.__pool
+        connection = pool.acquire()
+        cls.__local.connection = connection
+        try:
+            yield connection
+        finally:
+            cls.__local.connection = None
+            pool.release(connection)
+
+    @classmethod
+    @contextmanager
+    def shared_connection(cls):
+        """ Use the warehouse connection shared by every thread within the
+        block; the counterpart of `local_connection` for code which may
+        run either way.
+        """
+        yield cls.__connection
+
+    @classmethod
+    @contextmanager
+    def transaction(cls):
+        """ Make the table operations of the current thread within the
+        block into one transaction: commits are deferred to the end of the
+        block, when everything is committed unless anything was rolled
+        back or an error was raised, in which case it's all rolled back.
+        A transaction opened within another is part of the outer one.
+        """
+        outer = getattr(cls.__local, "transaction", None)
+        if outer is not None:
+            yield outer
+            return
+        connection = cls.get()
+        transaction = Transaction(connection)
+        cls.__local.transaction = transaction
+        try:
+            yield transaction
+        except:
+            connection.rollback()
+            raise
+        else:
+            if transaction.rolled_back:
+                connection.rollback()
+            else:
+                connection.commit()
+        finally:
+            cls.__local.transaction = None
 
     @classproperty
     def table_names(cls):
@@ -60,3 +158,16 @@ class Warehouse(object):
             cls.__version = "{}.{}.{}".format(*cls.get().get_server_version())
 
         return cls.__version
+
+    @classproperty
+    def max_allowed_packet(cls):
+        """ Returns the largest packet (and so statement) in bytes that
+        the MySQL server will accept.
+        """
+        if not cls.__max_allowed_packet:
+            connection = cls.get()
+            with closing(connection.cursor()) as cursor:
+                cursor.execute("SELECT @@max_allowed_packet")
+                cls.__max_allowed_packet = int(cursor.fetchall()[0][0])
+
+        return cls.__max_allowed_packet
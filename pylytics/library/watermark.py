@@ -0,0 +1,118 @@
+from contextlib import closing
+from datetime import date, datetime
+import logging
+
+from column import *
+from index import Index
+from keycache import _normalised
+from table import Table
+from utils import dump, escaped
+from warehouse import Warehouse
+
+
+__all__ = ['Watermark', 'EPOCH']
+log = logging.getLogger("pylytics")
+
+# The watermark used for a source which hasn't been loaded from before,
+# unless it sets a `since_default`.
+EPOCH = datetime(1970, 1, 1)
+
+# How each type of watermark value is read back from the table.
+_decoders = {
+    "datetime": lambda value: datetime.strptime(
+        value, "%Y-%m-%d %H:%M:%S.%f" if "." in value else
+        "%Y-%m-%d %H:%M:%S"),
+    "date": lambda value: datetime.strptime(value, "%Y-%m-%d").date(),
+    "int": int,
+    "unicode": unicode,
+}
+
+
+def _value_type(value):
+    if isinstance(value, datetime):
+        return "datetime"
+    elif isinstance(value, date):
+        return "date"
+    elif isinstance(value, (int, long)) and not isinstance(value, bool):
+        return "int"
+    elif isinstance(value, basestring):
+        return "unicode"
+    else:
+        raise TypeError("Can't use a value of type '%s' as a "
+                        "watermark" % type(value).__name__)
+
+
+class Watermark(Table):
+    """ The high-water marks of incremental loads, held in the warehouse.
+
+    Each mark is the greatest value of a column (such as a timestamp or
+    an auto-incrementing id) loaded into a table from a source, so that
+    the next load from that source can start after it.
+
+    """
+
+    __tablename__ = "pylytics_watermark"
+    __indexes__ = [
+        Index("table_name", "source_name", unique=True),
+    ]
+
+    id = PrimaryKey()
+    table_name = Column("table_name", unicode, size=64)
+    source_name = Column("source_name", unicode, size=128)
+    value_type = Column("value_type", tuple(sorted(_decoders)))
+    value = Column("value", unicode, size=128)
+    created = CreatedTimestamp()
+
+    # Whether the table is known to exist.
+    __built = False
+
+    @classmethod
+    def _build_once(cls):
+        if not cls.__built:
+            cls.create_table(if_not_exists=True)
+            cls.__built = True
+
+    @classmethod
+    def get(cls, table_name, source_name):
+        """ Return the mark for a table and source, or None if there
+        isn't one yet.
+        """
+        cls._build_once()
+        sql = "SELECT `value_type`, `value` FROM %s " \
+              "WHERE `table_name` = %s AND `source_name` = %s" % (
+                  escaped(cls.__tablename__), dump(table_name),
+                  dump(source_name))
+        connection = Warehouse.get()
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(sql)
+            rows = cursor.fetchall()
+        if not rows:
+            return None
+        value_type, value = rows[0]
+        return _decoders[str(value_type)](_normalised(value))
+
+    @classmethod
+    def set(cls, table_name, source_name, value):
+        """ Record a new mark for a table and source.
+        """
+        # Strings in binary collations are read as bytearrays.
+        value = _normalised(value)
+        cls._build_once()
+        log.debug("Advancing watermark for %s to %s", source_name, value,
+                  extra={"table": table_name})
+        sql = "INSERT INTO %s (`table_name`, `source_name`, `value_type`, " \
+              "`value`)\nVALUES (%s, %s, %s, %s)\n" \
+              "ON DUPLICATE KEY UPDATE `value_type` = VALUES(`value_type`), " \
+              "`value` = VALUES(`value`)" % (
+                  escaped(cls.__tablename__), dump(table_name),
+                  dump(source_name), dump(_value_type(value)),
+                  dump(unicode(value)))
+        connection = Warehouse.get()
+        with closing(connection.cursor()) as cursor:
+            try:
+                cursor.execute(sql)
+            except:
+                connection.rollback()
+                raise
+            else:
+                connection.commit()
@@ -0,0 +1,49 @@
+"""
+Comparing the decode throughput of staging value map codecs.
+
+"""
+
+import time
+
+from pylytics.library.codec import JSONCodec, MarshalCodec
+
+
+EVENTS = 100000
+
+VALUE_MAP = {
+    "when": "2015-07-16T12:34:56",
+    "where": "MOON",
+    "num_people": 3,
+    "duration": 10.7,
+    "very_boring": False,
+    "booking_id": 123456789,
+    "channel": "mobile",
+    "tags": ["alpha", "beta", "gamma"],
+}
+
+
+def _decode_rate(codec, encoded):
+    decode = codec.decode
+    start = time.time()
+    for value in encoded:
+        decode(value)
+    return len(encoded) / (time.time() - start)
+
+
+def test_binary_codec_decodes_faster_than_json():
+    """
+    Decodes EVENTS value maps stored by each codec (as they're returned
+    by the database) and reports the throughput and size of each.
+    """
+    rates = {}
+    for name, codec in [("JSON", JSONCodec()),
+                        ("marshal", MarshalCodec(compress_above=None)),
+                        ("marshal+zlib", MarshalCodec(compress_above=0))]:
+        encoded = [bytearray(codec.encode(dict(VALUE_MAP, id=i)))
+                   for i in xrange(EVENTS)]
+        size = sum(map(len, encoded)) / float(EVENTS)
+        rates[name] = _decode_rate(codec, encoded)
+        print '%s: %.0f events/s, %.1f bytes/event' % (name, rates[name],
+                                                       size)
+
+    assert rates["marshal"] > rates["JSON"]
@@ -0,0 +1,78 @@
+"""
+Comparing the memory held per record by table instances.
+
+"""
+
+import sys
+
+from pylytics.library.column import DimensionKey, Metric, NaturalKey
+from pylytics.library.dimension import Dimension
+from pylytics.library.fact import Fact
+
+
+ROWS = 100000
+
+
+class Store(Dimension):
+    __source__ = NotImplemented
+
+    store_id = NaturalKey('store_id', int, size=10)
+
+
+class Sales(Fact):
+    __source__ = NotImplemented
+
+    store = DimensionKey('store', Store)
+    units = Metric('units', int)
+    price = Metric('price', float)
+    discount = Metric('discount', float)
+
+
+class LegacySales(object):
+    """ Stand-in for a record held in an instance dictionary, which is
+    how table instances were stored before records became compact.
+    """
+
+    def __init__(self, store, units, price, discount):
+        self.store = store
+        self.units = units
+        self.price = price
+        self.discount = discount
+
+
+def _record_size(obj):
+    size = sys.getsizeof(obj)
+    for attribute in ("__dict__", "_values"):
+        try:
+            size += sys.getsizeof(object.__getattribute__(obj, attribute))
+        except AttributeError:
+            pass
+    return size
+
+
+def _total_size(records):
+    return sum(_record_size(record) for record in records)
+
+
+def test_compact_records_use_less_memory():
+    """
+    Holds ROWS records of each kind and reports the per-row saving.
+    """
+    legacy = [LegacySales(i, 3, 9.99, 0.5) for i in xrange(ROWS)]
+    compact = []
+    for i in xrange(ROWS):
+        obj = Sales()
+        obj.store = i
+        obj.units = 3
+        obj.price = 9.99
+        obj.discount = 0.5
+        compact.append(obj)
+
+    legacy_size = _total_size(legacy) / float(ROWS)
+    compact_size = _total_size(compact) / float(ROWS)
+
+    print 'Legacy record = %.1f bytes' % legacy_size
+    print 'Compact record = %.1f bytes' % compact_size
+    print 'Saving per row = %.1f bytes' % (legacy_size - compact_size)
+
+    assert compact_size < legacy_size
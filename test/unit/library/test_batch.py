@@ -0,0 +1,98 @@
+# -*- encoding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from datetime import date
+
+import pytest
+
+from pylytics.library.batch import RecordBatch
+from pylytics.library.column import Column, NaturalKey
+from pylytics.library.dimension import Dimension
+from pylytics.library.utils import dump, dump_column, tsv
+
+
+class Planet(Dimension):
+
+    name = NaturalKey("planet_name", unicode, size=20)
+    moons = Column("moons", int)
+    discovered = Column("discovered", date, optional=True)
+
+
+def _planet(name, moons):
+    planet = Planet()
+    planet.name = name
+    planet.moons = moons
+    return planet
+
+
+def test_batch_holds_values_by_column():
+    batch = RecordBatch.of(Planet, [_planet("Mars", 2), _planet("Earth", 1)])
+    assert len(batch) == 2
+    assert batch["planet_name"] == ["Mars", "Earth"]
+    assert batch["moons"] == [2, 1]
+    assert batch["discovered"] == [None, None]
+
+
+def test_batch_accepts_dictionaries_and_ignores_unknown_keys():
+    batch = RecordBatch(Planet)
+    batch.append({"planet_name": "Venus", "moons": 0, "colour": "yellow"})
+    assert batch["planet_name"] == ["Venus"]
+    assert batch["moons"] == [0]
+
+
+def test_batch_of_a_single_batch_is_that_batch():
+    batch = RecordBatch.of(Planet, [_planet("Mars", 2)])
+    assert RecordBatch.of(Planet, [batch]) is batch
+
+
+def test_batches_can_be_merged():
+    batch = RecordBatch.of(Planet, [
+        _planet("Mars", 2), RecordBatch.of(Planet, [_planet("Earth", 1)])])
+    assert batch["planet_name"] == ["Mars", "Earth"]
+
+
+def test_iterating_over_batch_yields_instances():
+    batch = RecordBatch.of(Planet, [_planet("Mars", 2)])
+    planets = list(batch)
+    assert isinstance(planets[0], Planet)
+    assert planets[0]["planet_name"] == "Mars"
+    assert planets[0].moons == 2
+
+
+def test_records_can_be_chunked_into_batches():
+    planets = [_planet("Planet %s" % i, i) for i in range(5)]
+    batches = list(RecordBatch.chunked(Planet, planets, 2))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+
+
+def test_unknown_column_raises_key_error():
+    with pytest.raises(KeyError):
+        RecordBatch(Planet)["colour"]
+
+
+@pytest.mark.parametrize("type_,values", [
+    (int, [1, 2, 3]),
+    (int, [1, None, 3]),
+    (int, [1, "2", 3.5]),
+    (unicode, ["it's", None]),
+    (bool, [True, False]),
+    (date, [date(2000, 1, 1), None]),
+    (("a", "b"), ["a", "b"]),
+])
+def test_dump_column_matches_dump(type_, values):
+    assert dump_column(type_, values) == map(dump, values)
+
+
+@pytest.mark.parametrize("value, field", [
+    (None, b"\\N"),
+    (True, b"1"),
+    (3, b"3"),
+    ("tab\tseparated", b"tab\\tseparated"),
+    ("two\nlines\r", b"two\\nlines\\r"),
+    ("back\\slash", b"back\\\\slash"),
+    ("nul\0", b"nul\\0"),
+    ("caf\xe9", b"caf\xc3\xa9"),
+])
+def test_tsv_escapes_special_characters(value, field):
+    assert tsv(value) == field
@@ -0,0 +1,66 @@
+import threading
+
+from pylytics.library.batcher import Batcher
+
+
+def test_batches_are_limited_by_rows():
+    batcher = Batcher(max_bytes=10 ** 6, rows=3)
+    batches = list(batcher.batches(["a"] * 7))
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+
+
+def test_batches_are_limited_by_bytes():
+    batcher = Batcher(max_bytes=25, rows=100)
+    batches = list(batcher.batches(["x" * 9] * 5, overhead=5))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+
+
+def test_oversized_items_are_sent_on_their_own():
+    batcher = Batcher(max_bytes=10, rows=100)
+    batches = list(batcher.batches(["x" * 20, "y" * 20]))
+    assert [len(batch) for batch in batches] == [1, 1]
+
+
+def test_extra_limit_caps_batch_rows():
+    batcher = Batcher(max_bytes=10 ** 6, rows=100)
+    batches = list(batcher.batches(["a"] * 5, limit=2))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+
+
+def test_slow_batches_halve_row_limit():
+    batcher = Batcher(max_bytes=10 ** 6, rows=100)
+    for batch in batcher.batches(["a"] * 100):
+        batcher.record(batcher.target_latency * 3)
+    assert batcher.rows == 50
+
+
+def test_fast_full_batches_double_row_limit():
+    batcher = Batcher(max_bytes=10 ** 6, rows=100)
+    for batch in batcher.batches(["a"] * 100):
+        batcher.record(batcher.target_latency / 10.0)
+    assert batcher.rows == 200
+
+
+def test_fast_partial_batches_leave_row_limit_alone():
+    batcher = Batcher(max_bytes=10 ** 6, rows=100)
+    for batch in batcher.batches(["a"] * 10):
+        batcher.record(batcher.target_latency / 10.0)
+    assert batcher.rows == 100
+
+
+def test_batches_are_timed_separately_in_each_thread():
+    batcher = Batcher(max_bytes=10 ** 6, rows=100)
+    full = iter(batcher.batches(["a"] * 100))
+    next(full)
+
+    def send_partial_batch():
+        for batch in batcher.batches(["a"] * 10):
+            batcher.record(batcher.target_latency / 10.0)
+
+    thread = threading.Thread(target=send_partial_batch)
+    thread.start()
+    thread.join()
+    # The partial batch sent by the other thread doesn't stand in for the
+    # full batch sent by this one.
+    batcher.record(batcher.target_latency / 10.0)
+    assert batcher.rows == 200
@@ -0,0 +1,74 @@
+# -*- encoding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from mock import MagicMock, patch
+
+from pylytics.library.codec import JSONCodec, MarshalCodec
+from pylytics.library.source import Staging
+from pylytics.library.utils import dump_column
+
+
+VALUE_MAP = {"when": "2015-01-01", "where": "Zürich", "num_people": 3,
+             "duration": 10.7, "very_boring": False, "notes": "x" * 300}
+
+
+def test_value_maps_survive_encoding():
+    for codec in (JSONCodec(), MarshalCodec(), MarshalCodec(None)):
+        assert codec.decode(codec.encode(VALUE_MAP)) == VALUE_MAP
+
+
+def test_large_value_maps_are_compressed():
+    codec = MarshalCodec(compress_above=256)
+    assert len(codec.encode(VALUE_MAP)) < len(MarshalCodec(None).encode(
+        VALUE_MAP))
+
+
+def test_json_value_maps_are_read_by_the_binary_codec():
+    encoded = bytearray(JSONCodec().encode(VALUE_MAP), "utf-8")
+    assert MarshalCodec().decode(encoded) == VALUE_MAP
+
+
+def test_staging_with_a_binary_codec_uses_a_blob():
+    BinaryStaging = Staging.with_codec(MarshalCodec())
+    assert BinaryStaging.__tablename__ == "staging"
+    column = BinaryStaging.value_map
+    assert column.type_expression == "BLOB"
+    assert [c.name for c in BinaryStaging.__columns__].count("value_map") == 1
+    event = BinaryStaging("boring", VALUE_MAP)
+    assert BinaryStaging.__codec__.decode(event.value_map) == VALUE_MAP
+    assert dump_column(bytearray, [bytearray(b"\x00P")]) == ["X'0050'"]
+
+
+def test_json_value_maps_are_read_from_a_blob():
+    encoded = bytearray(JSONCodec().encode(VALUE_MAP), "utf-8")
+    assert JSONCodec().decode(encoded) == VALUE_MAP
+
+
+def _upgraded(staging, column_type):
+    """ Upgrade a staging table whose value_map column has the type given,
+    returning the statements executed.
+    """
+    connection = MagicMock()
+    cursor = connection.cursor.return_value
+    cursor.fetchall.return_value = [("value_map", column_type, "YES", "",
+                                     None, "")]
+    with patch("pylytics.library.warehouse.Warehouse._Warehouse__connection",
+               connection):
+        staging._upgrade_value_map()
+    return [args[0] for args, _ in cursor.execute.call_args_list]
+
+
+def test_text_value_map_column_becomes_a_blob_for_a_binary_codec():
+    BinaryStaging = Staging.with_codec(MarshalCodec())
+    statements = _upgraded(BinaryStaging, "varchar(2048)")
+    assert statements == [
+        "SHOW COLUMNS FROM `staging` LIKE 'value_map'",
+        "ALTER TABLE `staging` MODIFY COLUMN `value_map` BLOB NOT NULL",
+    ]
+    assert _upgraded(BinaryStaging, "blob") == statements[:1]
+
+
+def test_value_map_column_is_left_alone_for_a_text_codec():
+    assert _upgraded(Staging, "varchar(2048)") == []
+    assert _upgraded(Staging, "blob") == []
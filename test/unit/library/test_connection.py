@@ -0,0 +1,85 @@
+# -*- encoding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from mock import MagicMock, patch
+from mysql.connector.errors import PoolError
+import pytest
+
+from pylytics.library.connection import ConnectionPool, NamedConnection
+
+
+DATABASES = {
+    "platform": {
+        "host": "localhost",
+        "db": "platform",
+        "pool_size": 2,
+        "pool_max_connections": 3,
+        "pool_timeout": 0,
+        "pool_ping_after": 0,
+    },
+}
+
+
+@pytest.fixture
+def connect():
+    with patch("pylytics.library.connection.settings") as settings, \
+            patch("pylytics.library.connection.connector.connect",
+                  side_effect=lambda **kwargs: MagicMock()) as connect, \
+            patch.dict("pylytics.library.connection._pools", clear=True):
+        settings.DATABASES = DATABASES
+        settings.CLIENT_CONFIG = None
+        yield connect
+
+
+def test_pool_settings_are_not_passed_to_the_connector(connect):
+    ConnectionPool("platform").acquire()
+    kwargs = connect.call_args[1]
+    assert kwargs["db"] == "platform"
+    assert not [key for key in kwargs if key.startswith("pool_")]
+
+
+def test_released_connections_are_used_again(connect):
+    pool = ConnectionPool("platform")
+    connection = pool.acquire()
+    pool.release(connection)
+    assert connection.rollback.called
+    assert pool.acquire() is connection
+    assert connect.call_count == 1
+
+
+def test_broken_connections_are_discarded(connect):
+    pool = ConnectionPool("platform")
+    connection = pool.acquire()
+    pool.release(connection)
+    connection.is_connected.return_value = False
+    assert pool.acquire() is not connection
+    assert connection.close.called
+
+
+def test_idle_connections_are_limited_and_evicted(connect):
+    pool = ConnectionPool("platform")
+    connections = [pool.acquire() for _ in range(3)]
+    for connection in connections:
+        pool.release(connection)
+    assert connections[2].close.called
+    pool.idle_timeout = -1
+    pool.acquire()
+    assert connections[0].close.called and connections[1].close.called
+
+
+def test_in_use_connections_are_limited(connect):
+    pool = ConnectionPool("platform")
+    for _ in range(3):
+        pool.acquire()
+    with pytest.raises(PoolError):
+        pool.acquire()
+
+
+def test_named_connections_are_drawn_from_the_pool(connect):
+    with NamedConnection("platform") as first:
+        pass
+    with NamedConnection("platform") as second:
+        pass
+    assert first is second
+    assert not first.close.called
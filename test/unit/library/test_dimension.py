@@ -0,0 +1,113 @@
+# -*- encoding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from datetime import datetime, timedelta
+
+from mock import MagicMock, patch
+import pytest
+
+from pylytics.library.batch import RecordBatch
+from pylytics.library.column import Column, NaturalKey
+from pylytics.library.dimension import Dimension
+from pylytics.library.exceptions import IncompleteUpdateError
+from pylytics.library.ledger import RefreshLedger
+
+
+class Region(Dimension):
+
+    code = NaturalKey("region_code", unicode, size=10)
+    zone = Column("region_zone", unicode, size=10, optional=True)
+    name = Column("region_name", unicode, size=40, optional=True,
+                  overwrite=True)
+
+
+def test_subquery_is_a_range_lookup():
+    sql = Region.__subquery__("N", datetime(2015, 1, 1))
+    assert sql == ("SELECT `id` FROM `region` WHERE `region_code` = 'N' "
+                   "AND `applicable_from` <= \"2015-01-01 00:00:00\" "
+                   "AND `applicable_to` > \"2015-01-01 00:00:00\"")
+
+
+def test_records_are_compared_with_current_versions():
+    detector = Region.change_detector()
+    stored = [
+        (bytearray(b"N"), bytearray(detector.hash(["N", None, "North"])), 1),
+        (bytearray(b"S"), bytearray(detector.hash(["S", None, "Sud"])), 2),
+        (bytearray(b"E"), bytearray(detector.hash(["E", None, "East"])), 3),
+    ]
+    cursor = MagicMock()
+    cursor.__iter__.side_effect = lambda: iter(stored)
+    connection = MagicMock()
+    connection.cursor.return_value = cursor
+    batch = RecordBatch.of(Region, [
+        {"region_code": "N", "region_name": "North"},
+        {"region_code": "S", "region_name": "South"},
+        {"region_code": "E", "region_zone": "Z1", "region_name": "East"},
+        {"region_code": "W"},
+        {"region_code": "W"},
+    ])
+    with patch("pylytics.library.changes.Warehouse.get",
+               return_value=connection):
+        versions, overwrites = detector.compare(batch)
+    # New members and changes to versioned columns are new versions.
+    assert versions == [2, 3]
+    # Changes to overwritten columns alone are not.
+    assert overwrites == [1]
+    assert batch["row_hash"][1] == detector.hash(["S", None, "South"])
+    assert batch["row_hash"][1][:32] == stored[1][1][:32]
+
+
+def test_overwrite_updates_every_version_from_a_temporary_table():
+    cursor = MagicMock()
+    connection = MagicMock()
+    connection.cursor.return_value = cursor
+    batch = RecordBatch.of(Region, [
+        {"region_code": "S", "region_name": "South"},
+    ])
+    with patch("pylytics.library.dimension.Warehouse.get",
+               return_value=connection), \
+            patch("pylytics.library.table.Warehouse.get",
+                  return_value=connection), \
+            patch("pylytics.library.table.Table.insert") as insert:
+        Region.overwrite(batch)
+    staged = insert.call_args[0][0]
+    assert staged["region_name"] == ["South"]
+    statements = [call[0][0] for call in cursor.execute.call_args_list]
+    assert statements[1].startswith("CREATE TEMPORARY TABLE region_overwrite")
+    assert statements[2].startswith(
+        "UPDATE `region` AS `row`\n"
+        "JOIN `region_overwrite` AS `new` "
+        "ON `new`.`region_code` = `row`.`region_code`\n"
+        "SET `row`.`region_name` = `new`.`region_name`,")
+    assert statements[2].endswith(
+        "WHERE NOT (`row`.`region_name` <=> `new`.`region_name`)")
+
+
+def test_fresh_dimensions_are_not_refreshed():
+    started = datetime(2015, 1, 1, 12)
+    with patch.object(Region, "__refresh_interval__", timedelta(hours=1)), \
+            patch.object(RefreshLedger, "now", return_value=started), \
+            patch.object(RefreshLedger, "record") as record, \
+            patch.object(Region, "update", return_value=True) as update:
+        with patch.object(RefreshLedger, "age", return_value=600):
+            assert Region.refresh() is False
+        assert not update.called
+        with patch.object(RefreshLedger, "age", return_value=3600):
+            assert Region.refresh() is True
+        update.assert_called_once_with(since=None)
+        record.assert_called_once_with("region", started)
+
+
+def test_failed_refreshes_are_not_recorded():
+    with patch.object(Region, "__refresh_interval__", timedelta(hours=1)), \
+            patch.object(RefreshLedger, "age", return_value=None), \
+            patch.object(RefreshLedger, "now"), \
+            patch.object(RefreshLedger, "record") as record, \
+            patch.object(Region, "update", return_value=False):
+        with pytest.raises(IncompleteUpdateError):
+            Region.refresh()
+        assert not record.called
+    with patch.object(Region, "update", return_value=False):
+        with pytest.raises(IncompleteUpdateError):
+            Region.refresh()
@@ -0,0 +1,101 @@
+# -*- encoding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from mock import MagicMock, patch
+
+from pylytics.library.source import (
+    CallableSource, DatabaseSource, _dumped, expansion)
+
+
+BOOKINGS = {1: "confirmed", 2: "cancelled"}
+
+
+def select_bookings(booking_id):
+    # The database compares numbers given as strings numerically.
+    return [{"booking_id": int(id_), "booking_status": BOOKINGS[int(id_)]}
+            for id_ in booking_id if int(id_) in BOOKINGS]
+
+
+class Bookings(DatabaseSource):
+
+    database = "bookings"
+    query = "SELECT id AS booking_id, status AS booking_status " \
+            "FROM booking WHERE id IN {booking_id}"
+    batch_key = "booking_id"
+
+
+class Booking(DatabaseSource):
+
+    database = "bookings"
+    query = "SELECT status AS booking_status FROM booking " \
+            "WHERE id = {booking_id}"
+
+
+RECORDS = [{"booking_id": 1}, {"booking_id": "2"}, {"booking_id": 1},
+           {"booking_id": 3}]
+
+
+def _source(*expansions):
+    return CallableSource.define(
+        _callable=staticmethod(lambda: [record.items() for record in RECORDS]),
+        expansions=list(expansions))
+
+
+def test_lists_are_dumped_for_in():
+    assert _dumped([1, "a'b"]) == "(1,'a''b')"
+
+
+def test_batched_expansion_selects_once_per_chunk():
+    with patch.object(Bookings, "execute",
+                      side_effect=select_bookings) as execute:
+        records = list(_source(Bookings).records(None))
+    assert execute.call_count == 1
+    assert sorted(execute.call_args[1]["booking_id"]) == [1, 3, "2"]
+    assert records == [
+        {"booking_id": 1, "booking_status": "confirmed"},
+        {"booking_id": "2", "booking_status": "cancelled"},
+        {"booking_id": 1, "booking_status": "confirmed"},
+        {"booking_id": 3},
+    ]
+
+
+def test_unbatched_expansion_selects_once_per_distinct_value():
+    def select_booking(booking_id):
+        return [{"booking_status": BOOKINGS.get(int(booking_id))}]
+
+    with patch.object(Booking, "execute",
+                      side_effect=select_booking) as execute:
+        records = list(_source(Booking).records(None))
+    assert execute.call_count == 3
+    assert [record["booking_status"] for record in records] == \
+        ["confirmed", "cancelled", "confirmed", None]
+
+
+def test_failed_records_are_reported_and_left_out():
+    failed = MagicMock()
+
+    def select_booking(booking_id):
+        if booking_id == 3:
+            raise ValueError("No such booking")
+        return []
+
+    with patch.object(Booking, "execute", side_effect=select_booking):
+        records = list(_source(Booking)._expanded(
+            (dict(record) for record in RECORDS), failed))
+    assert len(records) == 3
+    assert failed.call_args[0][0] == {"booking_id": 3}
+
+
+def test_callable_expansions_are_memoized_on_their_fields():
+    calls = []
+
+    @expansion("booking_id")
+    def add_reference(data):
+        calls.append(data["booking_id"])
+        data["reference"] = "B%s" % data["booking_id"]
+
+    records = list(_source(add_reference).records(None))
+    assert calls == [1, "2", 3]
+    assert [record["reference"] for record in records] == \
+        ["B1", "B2", "B1", "B3"]
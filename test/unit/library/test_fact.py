@@ -6,6 +6,7 @@ from contextlib import closing
 from datetime import date, time, timedelta
 import logging
 
+from mock import MagicMock, patch
 import pytest
 
 from pylytics.library.warehouse import Warehouse
@@ -15,7 +16,9 @@ from pylytics.library.column import (Column, DimensionKey, Metric,
 from pylytics.library.dimension import Dimension
 from pylytics.library.fact import Fact
 from pylytics.library.utils import escaped
-from pylytics.library.exceptions import TableExistsError
+from pylytics.library.exceptions import (DimensionUpdateError,
+                                         IncompleteUpdateError,
+                                         TableExistsError)
 
 
 log = logging.getLogger("pylytics")
@@ -304,3 +307,41 @@ def test_can_insert_fact_record_from_staging_source(empty_warehouse):
     # mysql returns unicode as bytearrays.
     assert datum["colour_of_stuff"].decode('utf8') == u"grün"
     assert datum["size_of_stuff"].decode('utf8') == "37kg"
+
+
+def test_dimensions_not_fully_inserted_are_reported():
+    with patch.object(Date, "update", return_value=True), \
+            patch.object(Place, "update", return_value=False):
+        with pytest.raises(DimensionUpdateError) as error:
+            BoringEvent.update_dimensions([Date, Place])
+    assert list(error.value.errors) == [Place]
+    assert isinstance(error.value.errors[Place], IncompleteUpdateError)
+
+
+def test_dimensions_are_updated_concurrently_on_their_own_connections():
+    pool = MagicMock()
+    pool.acquire.side_effect = lambda: MagicMock()
+    # Mock call counts aren't thread-safe, so note releases separately.
+    released = []
+    pool.release.side_effect = released.append
+    used = {}
+
+    def update(dimension):
+        def record_connection(since=None):
+            used[dimension] = Warehouse.get()
+            if dimension is Place:
+                raise ValueError("Source unavailable")
+        return record_connection
+
+    Warehouse.use(MagicMock(), pool=pool)
+    try:
+        with patch.object(Date, "update", side_effect=update(Date)), \
+                patch.object(Place, "update", side_effect=update(Place)), \
+                patch.object(BoringEvent, "__dimension_workers__", 2):
+            with pytest.raises(DimensionUpdateError) as error:
+                BoringEvent.update_dimensions([Date, Place])
+    finally:
+        Warehouse.use(None)
+    assert list(error.value.errors) == [Place]
+    assert used[Date] is not used[Place]
+    assert len(released) == 2
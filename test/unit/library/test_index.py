@@ -0,0 +1,56 @@
+# -*- encoding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from mock import MagicMock, patch
+
+from pylytics.library.column import NaturalKey
+from pylytics.library.dimension import Dimension
+from pylytics.library.index import Index
+
+
+class Store(Dimension):
+
+    __indexes__ = [
+        Index("region", ("store_name", 10)),
+    ]
+
+    code = NaturalKey("store_code", unicode, size=10)
+    name = NaturalKey("store_name", unicode, size=200)
+
+
+def test_index_expression():
+    assert Index("a", "b").expression == "KEY `ix_a_b` (`a`, `b`)"
+    assert Index(("a", 10), unique=True, name="a_prefix").expression == \
+        "UNIQUE KEY `a_prefix` (`a`(10))"
+
+
+def test_index_names_are_truncated():
+    assert len(Index("x" * 40, "y" * 40).name) == 64
+
+
+def test_dimensions_are_indexed_on_natural_key_and_applicable_from():
+    assert Store.indexes() == [
+        Index("region", ("store_name", 10)),
+        Index("store_code", "applicable_from", unique=True),
+        Index("store_name", "applicable_from", unique=True),
+    ]
+
+
+def test_only_missing_indexes_are_added():
+    cursor = MagicMock()
+    cursor.fetchall.return_value = [
+        ("store", 0, "PRIMARY"),
+        ("store", 1, "ix_region_store_name"),
+    ]
+    connection = MagicMock()
+    connection.cursor.return_value = cursor
+    with patch("pylytics.library.table.Warehouse.get",
+               return_value=connection):
+        Store.create_indexes()
+    sql = cursor.execute.call_args[0][0]
+    assert sql == ("ALTER TABLE `store` "
+                   "ADD UNIQUE KEY `ix_store_code_applicable_from` "
+                   "(`store_code`, `applicable_from`), "
+                   "ADD UNIQUE KEY `ix_store_name_applicable_from` "
+                   "(`store_name`, `applicable_from`)")
@@ -0,0 +1,78 @@
+# -*- encoding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from datetime import datetime
+
+from mock import MagicMock, patch
+
+from pylytics.library.column import NaturalKey
+from pylytics.library.dimension import Dimension
+from pylytics.library.keycache import DimensionKeyCache
+
+
+class Shop(Dimension):
+
+    code = NaturalKey("shop_code", unicode, size=10)
+
+
+ROWS = [
+    (bytearray(b"LDN"), datetime(2000, 1, 1), datetime(2010, 1, 1), 1),
+    (bytearray(b"LDN"), datetime(2010, 1, 1), datetime(2038, 1, 1), 2),
+    (bytearray(b"NYC"), datetime(2005, 1, 1), datetime(2012, 1, 1), 3),
+]
+
+
+def _warehouse(rows):
+    cursor = MagicMock()
+    cursor.__iter__.side_effect = lambda: iter(rows)
+    connection = MagicMock()
+    connection.cursor.return_value = cursor
+    return connection, cursor
+
+
+def test_cache_picks_latest_applicable_version():
+    connection, cursor = _warehouse(ROWS)
+    with patch("pylytics.library.keycache.Warehouse.get",
+               return_value=connection):
+        cache = DimensionKeyCache(Shop)
+        ids = cache.resolve(
+            ["LDN", "LDN", "NYC", "NYC", "NYC", "PAR"],
+            [datetime(2005, 1, 1), datetime(2015, 1, 1),
+             datetime(2006, 1, 1), datetime(2001, 1, 1),
+             datetime(2015, 1, 1), datetime(2015, 1, 1)])
+    # NYC no longer applies after 2012.
+    assert ids == [1, 2, 3, None, None, None]
+
+
+def test_cache_preloads_once():
+    connection, cursor = _warehouse(ROWS)
+    with patch("pylytics.library.keycache.Warehouse.get",
+               return_value=connection):
+        cache = DimensionKeyCache(Shop)
+        cache.resolve(["LDN"], [datetime(2015, 1, 1)])
+        cache.resolve(["NYC"], [datetime(2015, 1, 1)])
+    assert cursor.execute.call_count == 1
+
+
+def test_sized_cache_loads_values_as_needed():
+    connection, cursor = _warehouse(ROWS[:2])
+    with patch("pylytics.library.keycache.Warehouse.get",
+               return_value=connection):
+        cache = DimensionKeyCache(Shop, size=10)
+        assert cache.resolve(["LDN"], [datetime(2015, 1, 1)]) == [2]
+        assert cache.resolve(["LDN"], [datetime(2015, 1, 1)]) == [2]
+    assert cursor.execute.call_count == 1
+    sql = cursor.execute.call_args[0][0]
+    assert "WHERE `shop_code` IN ('LDN')" in sql
+
+
+def test_cleared_cache_is_reloaded():
+    connection, cursor = _warehouse(ROWS)
+    with patch("pylytics.library.keycache.Warehouse.get",
+               return_value=connection):
+        cache = DimensionKeyCache(Shop)
+        cache.resolve(["LDN"], [datetime(2015, 1, 1)])
+        cache.clear()
+        cache.resolve(["LDN"], [datetime(2015, 1, 1)])
+    assert cursor.execute.call_count == 2
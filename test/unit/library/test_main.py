@@ -1,6 +1,9 @@
 from datetime import time, timedelta
 
-from pylytics.library.main import valid_time_range
+from mock import MagicMock, patch
+import pytest
+
+from pylytics.library.main import Commander, valid_time_range
 
 
 def test_valid_time_range():
@@ -18,3 +21,45 @@ def test_valid_time_range():
     assert time(hour=6) in values
     assert time(hour=23, minute=30) in values
     assert len(values) == 48
+
+
+class Sales(object):
+
+    @classmethod
+    def build(cls):
+        raise ValueError("Unable to build")
+
+
+def _commander(errors):
+    pool = MagicMock()
+    plan = MagicMock()
+    plan.return_value.run.return_value = errors
+    patches = [patch("pylytics.library.connection.get_pool",
+                     return_value=pool),
+               patch("pylytics.library.main.get_all_fact_classes",
+                     return_value=[Sales]),
+               patch("pylytics.library.main.RunPlan", plan),
+               patch("pylytics.library.main.Warehouse")]
+    return pool, patches
+
+
+@pytest.mark.parametrize("command, errors, raised", [
+    ("update", {"Sales": ValueError("Source unavailable")}, SystemExit),
+    ("update", {}, None),
+    ("build", {}, ValueError),
+])
+def test_failed_commands_raise_and_release_the_connection(command, errors,
+                                                          raised):
+    pool, patches = _commander(errors)
+    for patched in patches:
+        patched.start()
+    try:
+        if raised:
+            with pytest.raises(raised):
+                Commander("test").run(command, "all")
+        else:
+            Commander("test").run(command, "all")
+    finally:
+        for patched in patches:
+            patched.stop()
+    pool.release.assert_called_once_with(pool.acquire.return_value)
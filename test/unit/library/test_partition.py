@@ -0,0 +1,60 @@
+# -*- encoding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from datetime import date
+
+from mock import MagicMock, patch
+
+from pylytics.library.column import DimensionKey, Metric, NaturalKey
+from pylytics.library.dimension import Dimension
+from pylytics.library.fact import Fact
+from pylytics.library.partition import MonthlyPartitions
+
+
+class Till(Dimension):
+
+    code = NaturalKey("till_code", unicode, size=10)
+
+
+class Sale(Fact):
+
+    __partitioning__ = MonthlyPartitions("date", ahead=1,
+                                         start=date(2100, 1, 1))
+
+    till = DimensionKey("till", Till)
+    day = Metric("date", date)
+    amount = Metric("amount", float)
+
+
+def test_partitioned_facts_have_no_foreign_keys():
+    with patch("pylytics.library.column.Warehouse") as warehouse:
+        warehouse.version = "5.6.20"
+        definitions = Sale.definitions()
+    assert "`id` INT NOT NULL AUTO_INCREMENT" in definitions
+    assert "PRIMARY KEY (`id`, `date`)" in definitions
+    assert "KEY `ix_till` (`till`)" in definitions
+    assert not [d for d in definitions if "FOREIGN KEY" in d]
+
+
+def test_partitioning_expression():
+    assert Sale.__partitioning__.expression(Sale) == (
+        "PARTITION BY RANGE (TO_DAYS(`date`)) (\n"
+        "  PARTITION p210001 VALUES LESS THAN (TO_DAYS('2100-02-01')),\n"
+        "  PARTITION pfuture VALUES LESS THAN MAXVALUE\n"
+        ")")
+
+
+def test_future_partitions_are_split_from_the_catch_all_partition():
+    cursor = MagicMock()
+    cursor.fetchall.return_value = [("p200001",), ("pfuture",)]
+    connection = MagicMock()
+    connection.cursor.return_value = cursor
+    with patch("pylytics.library.partition.Warehouse.get",
+               return_value=connection):
+        Sale.add_partitions()
+    sql = cursor.execute.call_args[0][0]
+    assert sql.startswith("ALTER TABLE `sale` REORGANIZE PARTITION pfuture "
+                          "INTO (\n  PARTITION p200002 VALUES LESS THAN "
+                          "(TO_DAYS('2000-03-01')),")
+    assert sql.endswith("PARTITION pfuture VALUES LESS THAN MAXVALUE\n)")
@@ -0,0 +1,125 @@
+# -*- encoding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from mock import MagicMock, patch
+import pytest
+
+from pylytics.library.column import DimensionKey, Metric, NaturalKey
+from pylytics.library.dimension import Dimension
+from pylytics.library.exceptions import (DimensionUpdateError,
+                                         IncompleteUpdateError)
+from pylytics.library.fact import Fact
+from pylytics.library.planner import RunPlan
+from pylytics.library.warehouse import Warehouse
+
+
+class Store(Dimension):
+    __source__ = NotImplemented
+
+    code = NaturalKey("code", unicode, size=10)
+
+
+class Product(Dimension):
+    __source__ = NotImplemented
+
+    sku = NaturalKey("sku", unicode, size=10)
+
+
+class Sales(Fact):
+    __source__ = NotImplemented
+
+    store = DimensionKey("store", Store)
+    product = DimensionKey("product", Product)
+    units = Metric("units", int)
+
+
+class Stock(Fact):
+    __source__ = NotImplemented
+
+    store = DimensionKey("store", Store)
+    units = Metric("units", int)
+
+
+@pytest.fixture(params=[1, 3])
+def jobs(request):
+    pool = MagicMock()
+    pool.acquire.side_effect = lambda: MagicMock()
+    Warehouse.use(MagicMock(), pool=pool)
+    yield request.param
+    Warehouse.use(None)
+
+
+def _patched(*tables, **errors):
+    calls = []
+
+    def run(table):
+        def called(**kwargs):
+            calls.append((table, kwargs))
+            if table.__name__ in errors:
+                raise errors[table.__name__]
+        return patch.object(table, "update", side_effect=called)
+
+    return calls, [run(table) for table in tables]
+
+
+def test_shared_dimensions_are_updated_once_before_facts(jobs):
+    calls, patches = _patched(Store, Product, Sales, Stock)
+    for patched in patches:
+        patched.start()
+    try:
+        errors = RunPlan([Sales, Stock], jobs=jobs).run("update")
+    finally:
+        for patched in patches:
+            patched.stop()
+    assert errors == {}
+    tables = [table for table, _ in calls]
+    assert sorted(tables) == sorted([Store, Product, Sales, Stock])
+    assert tables.index(Sales) > max(tables.index(Store),
+                                     tables.index(Product))
+    assert tables.index(Stock) > tables.index(Store)
+    assert dict(calls)[Sales] == {"dimensions": False}
+
+
+def test_facts_are_skipped_when_a_dimension_fails(jobs):
+    calls, patches = _patched(Store, Product, Sales, Stock,
+                              Product=ValueError("Source unavailable"))
+    for patched in patches:
+        patched.start()
+    try:
+        errors = RunPlan([Sales, Stock], jobs=jobs).run("update")
+    finally:
+        for patched in patches:
+            patched.stop()
+    assert sorted(errors) == ["Product", "Sales"]
+    assert isinstance(errors["Sales"], DimensionUpdateError)
+    assert Stock in dict(calls) and Sales not in dict(calls)
+
+
+def test_facts_are_skipped_when_a_dimension_is_not_fully_inserted(jobs):
+    calls, patches = _patched(Store, Sales, Stock)
+    patches.append(patch.object(Product, "update", return_value=False))
+    for patched in patches:
+        patched.start()
+    try:
+        errors = RunPlan([Sales, Stock], jobs=jobs).run("update")
+    finally:
+        for patched in patches:
+            patched.stop()
+    assert sorted(errors) == ["Product", "Sales"]
+    assert isinstance(errors["Product"], IncompleteUpdateError)
+    assert Stock in dict(calls) and Sales not in dict(calls)
+
+
+def test_errors_other_than_exceptions_stop_the_run(jobs):
+    calls, patches = _patched(Store, Product, Sales, Stock,
+                              Product=SystemExit(1))
+    for patched in patches:
+        patched.start()
+    try:
+        with pytest.raises(SystemExit):
+            RunPlan([Sales, Stock], jobs=jobs).run("update")
+    finally:
+        for patched in patches:
+            patched.stop()
+    assert Sales not in dict(calls)
@@ -0,0 +1,103 @@
+# -*- encoding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import json
+from Queue import Full
+import threading
+import time
+
+from mock import MagicMock, patch
+import pytest
+
+from pylytics.library.producer import StagingProducer
+from pylytics.library.source import Staging
+from pylytics.library.warehouse import Warehouse
+
+
+@pytest.fixture
+def written():
+    batches = []
+
+    def insert(*events, **kwargs):
+        batches.append([(event.event_name, json.loads(event.value_map))
+                        for event in events])
+        return True
+
+    Warehouse.use(None)
+    with patch.object(Staging, "insert", side_effect=insert):
+        yield batches
+
+
+def test_events_are_flushed_by_size(written):
+    producer = StagingProducer(batch_size=2)
+    for n in range(5):
+        producer.send("visit", {"n": n})
+    assert [len(batch) for batch in written] == [2, 2]
+    producer.close()
+    assert written[-1] == [("visit", {"n": 4})]
+    assert producer.written == 5
+
+
+@pytest.fixture
+def pooled():
+    pool = MagicMock()
+    Warehouse.use(MagicMock(), pool=pool)
+    yield pool
+    Warehouse.use(None)
+
+
+def test_events_are_flushed_by_time_in_the_background(written, pooled):
+    with StagingProducer(batch_size=100, flush_interval=0.05) as producer:
+        producer.send("visit", {"n": 1})
+        time.sleep(0.5)
+        assert written == [[("visit", {"n": 1})]]
+
+
+def test_sending_flushes_when_the_queue_is_full(written):
+    producer = StagingProducer(batch_size=10, max_queued=2, timeout=0.01)
+    for n in range(5):
+        producer.send("visit", {"n": n})
+    assert [len(batch) for batch in written] == [2, 2]
+    producer.close()
+    assert producer.written == 5
+
+
+def test_sending_is_held_back_when_the_queue_is_full(written, pooled):
+    writing = threading.Event()
+    resume = threading.Event()
+
+    def insert(*events, **kwargs):
+        writing.set()
+        resume.wait()
+
+    producer = StagingProducer(batch_size=1, max_queued=1, timeout=0.01)
+    with patch.object(Staging, "insert", side_effect=insert):
+        producer.start()
+        producer.send("visit", {"n": 1})
+        writing.wait()
+        # The first event is being written, and the second fills the queue.
+        producer.send("visit", {"n": 2})
+        with pytest.raises(Full):
+            producer.send("visit", {"n": 3})
+        resume.set()
+        producer.close()
+    assert producer.written == 2
+
+
+def test_events_are_flushed_as_sent_without_a_pool(written):
+    with StagingProducer(batch_size=2, flush_interval=0.05) as producer:
+        for n in range(3):
+            producer.send("visit", {"n": n})
+        time.sleep(0.2)
+        # Only full batches have been written, by the sending thread.
+        assert [len(batch) for batch in written] == [2]
+    assert [len(batch) for batch in written] == [2, 1]
+
+
+def test_failed_writes_are_counted(written):
+    producer = StagingProducer()
+    with patch.object(Staging, "insert", return_value=False):
+        producer.send("visit", {"n": 1})
+        producer.close()
+    assert producer.failed == 1
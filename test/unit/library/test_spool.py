@@ -0,0 +1,59 @@
+# -*- encoding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from datetime import datetime
+import os
+
+from mock import MagicMock, patch
+
+from pylytics.library.source import DatabaseSource
+from pylytics.library.spool import Spool
+
+
+COLUMNS = ("code", "name", "modified")
+ROWS = [(n, "Région %s" % n, datetime(2015, 1, 1, n % 24)) for n in range(2500)]
+
+
+def test_small_results_are_held_in_memory():
+    spool = Spool(COLUMNS, threshold=10)
+    spool.extend(ROWS[:10])
+    with patch("pylytics.library.spool.tempfile.mkstemp") as mkstemp:
+        assert list(spool) == [dict(zip(COLUMNS, row)) for row in ROWS[:10]]
+    assert not mkstemp.called
+    spool.close()
+
+
+def test_large_results_are_spooled_to_a_file_and_removed():
+    spool = Spool(COLUMNS, threshold=10)
+    spool.extend(ROWS)
+    path = spool._Spool__path
+    assert os.path.exists(path)
+    assert len(spool) == len(ROWS)
+    assert list(spool) == [dict(zip(COLUMNS, row)) for row in ROWS]
+    # A spool can be read more than once.
+    assert len(list(spool)) == len(ROWS)
+    spool.close()
+    assert not os.path.exists(path)
+
+
+class Regions(DatabaseSource):
+
+    database = "geography"
+    query = "SELECT code, name, modified FROM region"
+    spool_threshold = 100
+
+
+def test_execute_releases_the_connection_before_yielding():
+    cursor = MagicMock()
+    cursor.column_names = COLUMNS
+    cursor.__iter__.side_effect = lambda: iter(ROWS)
+    connection = MagicMock()
+    connection.cursor.return_value = cursor
+    with patch("pylytics.library.source.NamedConnection") as named:
+        named.return_value.__enter__.return_value = connection
+        records = Regions.execute()
+        assert next(records) == dict(zip(COLUMNS, ROWS[0]))
+        assert named.return_value.__exit__.called
+        assert cursor.close.called
+        assert len(list(records)) == len(ROWS) - 1
@@ -0,0 +1,93 @@
+# -*- encoding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import json
+
+from mock import MagicMock, patch
+
+from pylytics.library.column import Metric
+from pylytics.library.source import Staging
+from pylytics.library.table import Table
+
+
+class Visit(Table):
+
+    __source__ = Staging.define(events=["visit"], page_size=3)
+    __chunk_size__ = 2
+
+    pages = Metric("pages", int)
+
+
+ROWS = [
+    (1, "visit", json.dumps({"pages": 1})),
+    (2, "visit", "{broken"),
+    (3, "visit", json.dumps({"pages": 3})),
+    (5, "visit", json.dumps({"pages": 5})),
+    (6, "visit", json.dumps({"pages": 6})),
+]
+
+
+def _warehouse():
+    """ A warehouse connection returning pages of ROWS for staging
+    selections and recording every other statement.
+    """
+    statements = []
+    cursor = MagicMock()
+
+    def execute(sql, *args):
+        if "SELECT" in sql:
+            after = int(sql.split("id > ")[1].split()[0])
+            cursor.fetchall.return_value = [
+                row for row in ROWS if row[0] > after][:3]
+        else:
+            statements.append(sql)
+
+    cursor.execute.side_effect = execute
+    connection = MagicMock()
+    connection.cursor.return_value = cursor
+    return connection, statements
+
+
+def test_rows_are_paged_and_deleted_by_range_with_each_chunk():
+    connection, statements = _warehouse()
+    inserted = []
+
+    def insert(batch, mode=None):
+        inserted.append(list(batch["pages"]))
+        # The delete for the previous chunk has been committed by now.
+        assert connection.commit.call_count == len(inserted) - 1
+        return True
+
+    with patch("pylytics.library.warehouse.Warehouse._Warehouse__connection",
+               connection), \
+            patch.object(Visit, "insert", side_effect=insert):
+        assert Visit.update()
+    assert inserted == [[1, 3], [5, 6]]
+    deletes = [sql for sql in statements if sql.startswith("DELETE")]
+    assert deletes == ["DELETE FROM staging WHERE id BETWEEN 1 AND 3",
+                       "DELETE FROM staging WHERE id BETWEEN 5 AND 6"]
+    assert connection.commit.call_count == 2
+
+
+def test_rows_are_left_when_their_records_cannot_be_inserted():
+    connection, statements = _warehouse()
+    with patch("pylytics.library.warehouse.Warehouse._Warehouse__connection",
+               connection), \
+            patch.object(Visit, "insert", side_effect=[False, True]):
+        assert not Visit.update()
+    deletes = [sql for sql in statements if sql.startswith("DELETE")]
+    assert deletes == ["DELETE FROM staging WHERE id BETWEEN 5 AND 6"]
+    assert connection.rollback.called
+
+
+def test_deletes_are_chunked():
+    connection, statements = _warehouse()
+    with patch("pylytics.library.warehouse.Warehouse._Warehouse__connection",
+               connection), \
+            patch("pylytics.library.source.DELETE_CHUNK_SIZE", 2):
+        Staging._delete([(1, 3), (5, 5)])
+    assert statements == [
+        "DELETE FROM staging WHERE id BETWEEN 1 AND 2",
+        "DELETE FROM staging WHERE id = 3 OR id = 5",
+    ]
@@ -0,0 +1,218 @@
+# -*- encoding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import re
+
+from mock import Mock, patch
+import pytest
+
+from pylytics.library.batch import RecordBatch
+from pylytics.library.batcher import Batcher
+
+from pylytics.library.column import Column, DimensionKey, Metric, NaturalKey
+from pylytics.library.dimension import Dimension
+from pylytics.library.fact import Fact
+from pylytics.library.source import Source
+
+
+class Colour(Dimension):
+
+    name = NaturalKey("colour_name", unicode, size=20)
+    hex_code = Column("hex", unicode, size=7)
+
+
+class Paint(Fact):
+
+    colour = DimensionKey("colour", Colour)
+    litres = Metric("volume_in_litres", float)
+
+
+class Shade(Dimension):
+
+    name = NaturalKey("shade_name", unicode, size=20)
+    code = NaturalKey("shade_code", int)
+
+
+class Sample(Fact):
+
+    shade = DimensionKey("shade", Shade)
+    note = Column("note", unicode, size=40)
+
+
+def test_column_index_maps_column_names_to_attributes():
+    assert Colour.__columnattrs__["colour_name"] == "name"
+    assert Colour.__columnattrs__["hex"] == "hex_code"
+    assert Colour.__attrcolumns__["hex_code"] is Colour.hex_code
+
+
+def test_column_index_includes_inherited_columns():
+    assert Paint.__columnattrs__["id"] == "id"
+    assert Paint.__columnattrs__["created"] == "created"
+    assert Paint.__columnattrs__["volume_in_litres"] == "litres"
+
+
+def test_can_get_and_set_values_by_column_name():
+    paint = Paint()
+    assert paint["volume_in_litres"] is None
+    paint["volume_in_litres"] = 2.5
+    assert paint.litres == 2.5
+    assert paint["volume_in_litres"] == 2.5
+
+
+def test_unknown_column_name_raises_key_error():
+    paint = Paint()
+    with pytest.raises(KeyError):
+        paint["nope"]
+    with pytest.raises(KeyError):
+        paint["nope"] = 1
+
+
+def test_insert_plan_is_compiled_once_per_class():
+    plan = Paint.insert_plan()
+    assert Paint.insert_plan() is plan
+    assert Colour.insert_plan() is not plan
+    assert [column.name for column in plan.columns] == [
+        "colour", "volume_in_litres"]
+    assert plan.statement.startswith("INSERT INTO `paint`")
+
+
+def test_insert_plan_converts_records_to_sql_rows():
+    paint = Paint()
+    paint.colour = "red"
+    paint.litres = 2.5
+    rows = Paint.insert_plan().rows(RecordBatch.of(Paint, [paint]))
+    assert len(rows) == 1
+    assert "(SELECT `id` FROM `colour` WHERE `colour_name` = 'red'" in rows[0]
+    assert rows[0].endswith("2.5\n)")
+
+
+def test_insert_plan_can_build_prepared_statements():
+    paints = []
+    for colour in ("red", "blue", "green"):
+        paint = Paint()
+        paint.colour = colour
+        paint.litres = 1.0
+        paints.append(paint)
+    batch = RecordBatch.of(Paint, paints)
+    plan = Paint.insert_plan()
+    with patch.object(plan, "batcher", Batcher(max_bytes=10 ** 6, rows=2)):
+        statements = list(plan.statements(batch, "prepared"))
+        assert len(statements) == 2
+        (first, first_parameters), (second, second_parameters) = statements
+        assert "'" not in first and "%s" in first
+        assert first_parameters[0] == "red"
+        assert first_parameters[1] == first_parameters[2]
+        assert first_parameters[3] == 1.0
+        assert len(first_parameters) == 8
+        assert len(second_parameters) == 4
+        # Recent statements are reused with the very same text.
+        again = list(plan.statements(batch, "prepared"))
+        assert again[0][0] is first
+
+
+def test_insert_plan_sizes_literal_statements_in_bytes():
+    paints = []
+    for colour in ("红色", "蓝色"):
+        paint = Paint()
+        paint.colour = colour * 5
+        paint.litres = 1.0
+        paints.append(paint)
+    batch = RecordBatch.of(Paint, paints)
+    plan = Paint.insert_plan()
+    header = plan.statement + "VALUES"
+    # Both rows fit into the limit if counted in characters, but not once
+    # encoded as UTF-8.
+    max_bytes = len(header) + sum(len(row) + 1 for row in plan.rows(batch))
+    with patch.object(plan, "batcher", Batcher(max_bytes=max_bytes)):
+        statements = [statement for statement, _ in
+                      plan.statements(batch, "literal")]
+    assert len(statements) == 2
+    for statement in statements:
+        assert len(statement.encode("utf-8")) <= max_bytes
+
+
+def test_insert_plan_can_resolve_dimension_keys_by_join():
+    plan = Paint.insert_plan()
+    sql = plan.join_statement((unicode,), "paint_join_0")
+    assert sql.startswith("INSERT INTO `paint` (")
+    assert "FROM `paint_join_0` AS `t`" in sql
+    assert "LEFT JOIN `colour` AS `d0` ON `d0`.`colour_name` = " \
+           "`t`.`colour`" in sql
+    assert "`d0`.`applicable_to` > `t`.`pylytics_timestamp`" in sql
+
+
+def test_insert_plan_loads_each_group_of_records_from_a_file():
+    samples = []
+    for shade, note in (("teal", "tab\there"), (7, "new\nline"),
+                        ("navy", "back\\slash"), (8, None)):
+        sample = Sample()
+        sample.shade = shade
+        sample.note = note
+        samples.append(sample)
+    batch = RecordBatch.of(Sample, samples)
+    statements = Sample.insert_plan().statements(batch, "load")
+
+    paths = []
+    for statement, parameters in statements:
+        assert parameters is None
+        assert statement.startswith("LOAD DATA LOCAL INFILE ")
+        assert "INTO TABLE `sample`" in statement
+        assert "@value_0" in statement and "@timestamp" in statement
+        path = re.search(r"INFILE '([^']+)'", statement).group(1)
+        # Only the file for the current statement is kept.
+        assert os.path.exists(path)
+        assert not any(os.path.exists(earlier) for earlier in paths)
+        with open(path, "rb") as tsv_file:
+            paths.append(path)
+            lines = tsv_file.read().splitlines()
+        assert len(lines) == 2
+        if "shade_name" in statement:
+            assert lines[0].startswith(b"teal\ttab\\there\t")
+            assert lines[1].startswith(b"navy\tback\\\\slash\t")
+        else:
+            assert lines[0].startswith(b"7\tnew\\nline\t")
+            assert lines[1].startswith(b"8\t\\N\t")
+    assert len(paths) == 2
+    assert not any(os.path.exists(path) for path in paths)
+
+
+class PaintSource(Source):
+
+    @classmethod
+    def records(cls, for_class, since=None):
+        for litres in range(5):
+            yield {"colour": "red", "volume_in_litres": float(litres)}
+
+
+def test_update_inserts_records_a_chunk_at_a_time():
+    insert = Mock(side_effect=[None, False, None])
+    with patch.object(Paint, "__source__", PaintSource), \
+            patch.object(Paint, "__chunk_size__", 2), \
+            patch.object(Paint, "insert", insert), \
+            patch.object(PaintSource, "loaded") as loaded:
+        inserted = Paint.update(dimensions=False)
+    # A chunk which couldn't be inserted doesn't stop the rest.
+    assert [len(args[0]) for args, _ in insert.call_args_list] == [2, 2, 1]
+    assert inserted is False
+    assert not loaded.called
+
+
+def test_update_uses_source_select_when_overridden():
+
+    class SelectingSource(Source):
+
+        @classmethod
+        def select(cls, for_class, since=None):
+            for colour in ("red", "blue", "green"):
+                paint = for_class()
+                paint.colour = colour
+                yield paint
+
+    insert = Mock(return_value=None)
+    with patch.object(Paint, "__source__", SelectingSource), \
+            patch.object(Paint, "insert", insert):
+        assert Paint.update(dimensions=False) is True
+    batch, = [args[0] for args, _ in insert.call_args_list]
+    assert batch["colour"] == ["red", "blue", "green"]
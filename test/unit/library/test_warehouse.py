@@ -0,0 +1,45 @@
+from mock import MagicMock, patch
+import pytest
+
+from pylytics.library.warehouse import Warehouse
+
+
+@pytest.fixture
+def connection():
+    connection = MagicMock()
+    connection.is_connected.return_value = True
+    with patch("pylytics.library.warehouse.Warehouse._Warehouse__connection",
+               connection):
+        yield connection
+
+
+def test_nested_transactions_are_part_of_the_outer_one(connection):
+    with Warehouse.transaction() as outer:
+        with Warehouse.transaction() as inner:
+            Warehouse.get().commit()
+        assert inner is outer
+        # Still within the outer transaction.
+        assert Warehouse.get() is outer
+        Warehouse.get().commit()
+        assert not connection.commit.called
+    assert connection.commit.call_count == 1
+    assert Warehouse.get() is connection
+
+
+def test_rolling_back_a_nested_transaction_rolls_back_the_outer_one(
+        connection):
+    with Warehouse.transaction() as outer:
+        with Warehouse.transaction() as inner:
+            inner.rollback()
+        assert outer.rolled_back
+    assert not connection.commit.called
+
+
+def test_errors_in_a_nested_transaction_roll_back_the_outer_one(connection):
+    with pytest.raises(ValueError):
+        with Warehouse.transaction():
+            with Warehouse.transaction():
+                raise ValueError("Unable to insert")
+    assert connection.rollback.called
+    assert not connection.commit.called
+    assert Warehouse.get() is connection
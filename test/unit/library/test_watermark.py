@@ -0,0 +1,72 @@
+# -*- encoding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+from datetime import datetime
+
+from mock import MagicMock, patch
+
+from pylytics.library.column import Column
+from pylytics.library.source import DatabaseSource
+from pylytics.library.table import Table
+from pylytics.library.watermark import EPOCH, Watermark
+
+
+class Order(Table):
+
+    reference = Column("reference", unicode, size=10)
+    modified = Column("modified", datetime)
+
+
+class Orders(DatabaseSource):
+
+    database = "shop"
+    query = "SELECT * FROM orders WHERE modified > {since}"
+    watermark = "modified"
+
+
+Order.__source__ = Orders
+
+ROWS = [
+    {"reference": "A", "modified": datetime(2015, 1, 2)},
+    {"reference": "B", "modified": datetime(2015, 1, 1)},
+]
+
+
+def test_watermark_is_given_as_since_and_advanced_once_loaded():
+    with patch.object(Watermark, "get", return_value=None), \
+            patch.object(Watermark, "set") as set_watermark, \
+            patch.object(Orders, "execute", return_value=ROWS) as execute, \
+            patch.object(Order, "insert", return_value=True):
+        Order.update()
+        execute.assert_called_once_with(since=EPOCH)
+        set_watermark.assert_called_once_with(
+            "order", Orders._watermark_name(), datetime(2015, 1, 2))
+
+        # The next load starts from the stored watermark.
+        Watermark.get.return_value = datetime(2015, 1, 2)
+        list(Orders.records(Order))
+        execute.assert_called_with(since=datetime(2015, 1, 2))
+
+
+def test_watermark_is_not_advanced_if_insert_fails():
+    with patch.object(Watermark, "get", return_value=None), \
+            patch.object(Watermark, "set") as set_watermark, \
+            patch.object(Orders, "execute", return_value=ROWS), \
+            patch.object(Order, "insert", return_value=False):
+        Order.update()
+    assert not set_watermark.called
+
+
+def test_binary_string_watermarks_are_stored_as_text():
+    connection = MagicMock()
+    connection.is_connected.return_value = True
+    with patch("pylytics.library.warehouse.Warehouse._Warehouse__connection",
+               connection), \
+            patch.object(Watermark, "_build_once"):
+        Watermark.set("order", "orders", bytearray("Zürich-2".encode("utf-8")))
+    sql, = connection.cursor.return_value.execute.call_args[0]
+    assert sql.endswith("VALUES ('order', 'orders', 'unicode', 'Zürich-2')\n"
+                        "ON DUPLICATE KEY UPDATE `value_type` = "
+                        "VALUES(`value_type`), `value` = VALUES(`value`)")
+    assert connection.commit.called